@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+# Write-behind tracker for contacts.lastActivity and groups.lastActivity.
+#
+# lastActivity only drives the order of the contact and group lists, so
+# message sends record the latest activity per (user, contact) pair and per
+# group in memory; a background thread writes everything that changed with
+# one bulk_write per collection every ACTIVITY_FLUSH_INTERVAL seconds (and
+# once more on shutdown). Updates use $max, so a late flush never moves a
+# timestamp back. Reading a conversation does not count as activity.
+
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv('ACTIVITY_FLUSH_INTERVAL', 5))
+
+
+class ActivityTracker:
+    """Thread-safe latest activity per contact pair and per group, flushed periodically"""
+
+    def __init__(self, interval=ACTIVITY_FLUSH_INTERVAL):
+        self.interval = interval
+        self._contacts_collection = None
+        self._groups_collection = None
+        self._contacts = {}
+        self._groups = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.recorded = 0
+        self.written = 0
+        self.flushes = 0
+        self.errors = 0
+        self.last_flush_at = None
+        self.last_flush_ms = 0.0
+
+    def record_contacts(self, user_id, peer_id, when):
+        """Activity between two users: both of their contact entries move up"""
+        with self._lock:
+            for key in ((str(user_id), str(peer_id)), (str(peer_id), str(user_id))):
+                self._contacts[key] = max(when, self._contacts.get(key, when))
+            self.recorded += 1
+
+    def record_group(self, group_id, when):
+        with self._lock:
+            group_id = str(group_id)
+            self._groups[group_id] = max(when, self._groups.get(group_id, when))
+            self.recorded += 1
+
+    def flush(self):
+        """Write every pending timestamp; returns the number of documents updated"""
+        with self._flush_lock:
+            with self._lock:
+                contacts, self._contacts = self._contacts, {}
+                groups, self._groups = self._groups, {}
+            if self._contacts_collection is None:
+                self._requeue(contacts, groups)
+                return 0
+
+            started = time.monotonic()
+            contact_operations = [
+                UpdateOne(
+                    {"userId": ObjectId(user_id), "contactId": ObjectId(peer_id)},
+                    {"$max": {"lastActivity": when}}
+                )
+                for (user_id, peer_id), when in contacts.items()
+            ]
+            group_operations = [
+                UpdateOne({"_id": ObjectId(group_id)}, {"$max": {"lastActivity": when}})
+                for group_id, when in groups.items()
+            ]
+            if not contact_operations and not group_operations:
+                return 0
+
+            try:
+                if contact_operations:
+                    self._contacts_collection.bulk_write(contact_operations, ordered=False)
+                    contacts = {}
+                if group_operations:
+                    self._groups_collection.bulk_write(group_operations, ordered=False)
+                    groups = {}
+            except PyMongoError as e:
+                print(f"Error flushing activity updates: {e}")
+                self.errors += 1
+                self._requeue(contacts, groups)
+                return 0
+
+            self.flushes += 1
+            self.written += len(contact_operations) + len(group_operations)
+            self.last_flush_at = time.time()
+            self.last_flush_ms = (time.monotonic() - started) * 1000
+            return len(contact_operations) + len(group_operations)
+
+    def _requeue(self, contacts, groups):
+        # Keep unwritten timestamps for the next flush, without overriding newer ones
+        with self._lock:
+            for key, when in contacts.items():
+                self._contacts[key] = max(when, self._contacts.get(key, when))
+            for group_id, when in groups.items():
+                self._groups[group_id] = max(when, self._groups.get(group_id, when))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def start(self, contacts_collection, groups_collection):
+        """Start the background flusher writing to the contacts and groups collections"""
+        self._contacts_collection = contacts_collection
+        self._groups_collection = groups_collection
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="activity-flush", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the flusher and write what is still pending (shutdown)"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.interval + 1)
+            self._thread = None
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            pending_contacts = len(self._contacts)
+            pending_groups = len(self._groups)
+        return {
+            "pendingContacts": pending_contacts,
+            "pendingGroups": pending_groups,
+            "recorded": self.recorded,
+            "written": self.written,
+            "flushes": self.flushes,
+            "errors": self.errors,
+            "lastFlushAt": self.last_flush_at,
+            "lastFlushMs": round(self.last_flush_ms, 3),
+            "flushInterval": self.interval
+        }
+
+
+activity_tracker = ActivityTracker()
@@ -4,6 +4,7 @@ from flask_socketio import SocketIO, emit, join_room, leave_room
 from pymongo import MongoClient
 import os
 import json
+import atexit
 import bcrypt
 import jwt
 from datetime import datetime, timedelta, timezone
@@ -13,6 +14,39 @@ from task_routes import task_routes
 from file_upload import file_upload_bp
 from category_routes import category_routes
 from encryption import encrypt_message, decrypt_message, generate_encryption_key
+from db_indexes import bootstrap_indexes
+from daily_stats import get_daily_message_counts, DEFAULT_STATS_DAYS, MAX_STATS_DAYS
+from group_members import (is_group_member, find_member_group, member_group_ids, group_member_ids,
+                           add_group_members, remove_group_member, remove_group_members, remove_user_memberships,
+                           touch_last_read, group_rosters)
+from message_buckets import (BUCKETED_STORAGE, mark_edited, mark_deleted, drop_conversation, drop_sender_messages,
+                             fetch_bucketed_page)
+from message_audit import (parse_audit_filters, load_audit_summaries, audit_user_ids, format_audit_message,
+                           DEFAULT_AUDIT_PAGE_SIZE)
+from search_index import (tokenize, parse_search_args, search, search_conversations, highlight_offsets,
+                          decode_conversation_cursor, encode_search_cursor,
+                          DEFAULT_HITS_PER_CONVERSATION, MAX_HITS_PER_CONVERSATION)
+from user_events import record_event, sync_events, parse_sync_args, GROUP_JOINED, GROUP_LEFT, GROUP_DELETED
+from pagination import PAGINATION_HEADERS, parse_page_args, fetch_page, pagination_headers
+from socket_sessions import socket_sessions
+from presence_buffer import presence_buffer
+from activity_tracker import activity_tracker
+from presence_fanout import presence_fanout, ADMIN_ROOM
+from stage_timings import send_timings
+from message_writes import (direct_message_document, direct_message_payload, record_direct_message,
+                            group_message_document, group_message_payload, record_group_message,
+                            edit_update, delete_update, edit_payload, delete_payload, payload_rooms,
+                            record_message_edit, record_message_delete)
+from chunked_uploads import finished_upload, start_part_purger
+from user_profiles import (
+    get_user_profile, get_user_profiles, get_user_name, get_user_names, get_user_roles,
+    invalidate_user_profile, get_profile_cache_stats
+)
+from conversations import (
+    dm_conversation_id, group_conversation_id, record_edit, record_delete,
+    mark_read, mark_cleared, hide_message, get_visibility, get_visibility_filter, get_visibility_filters,
+    visible_in_conversations, unread_count, visible_last_message
+)
 
 # Note: We're avoiding monkey patching due to compatibility issues with Python 3.13
 # Instead, we'll use a simpler configuration that works with the standard library
@@ -32,7 +66,9 @@ class JSONEncoder(json.JSONEncoder):
 # Initialize Flask app
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'default_secret_key')
-CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
+# Tokens last a day; refreshing them extends a session up to this long after its login
+SESSION_MAX_AGE = timedelta(days=int(os.getenv('SESSION_MAX_AGE_DAYS', 30)))
+CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True, expose_headers=PAGINATION_HEADERS)
 socketio = SocketIO(
     app,
     cors_allowed_origins="*",
@@ -40,7 +76,10 @@ socketio = SocketIO(
     ping_timeout=120,  # Increased ping timeout to 120 seconds
     ping_interval=25,  # Keep ping interval at 25 seconds
     logger=True,  # Enable logging
-    engineio_logger=True  # Enable Engine.IO logging
+    engineio_logger=True,  # Enable Engine.IO logging
+    # Set (e.g. redis://localhost:6379/0) when several workers serve Socket.IO,
+    # so an emit reaches the room's sockets on every worker
+    message_queue=os.getenv('SOCKETIO_MESSAGE_QUEUE')
 )
 
 # MongoDB connection
@@ -52,6 +91,36 @@ contacts_collection = db.contacts
 groups_collection = db.groups
 group_messages_collection = db.group_messages
 tasks_collection = db.tasks
+conversations_collection = db.conversations
+daily_stats_collection = db.daily_stats
+group_members_collection = db.group_members
+message_buckets_collection = db.message_buckets
+uploads_collection = db.uploads
+
+def start_background_tasks():
+    """Start the periodic writers of the threading server (asgi_server.py starts its own)"""
+    # lastActive / isOnline are written behind, in batches (see presence_buffer.py)
+    presence_buffer.start(users_collection)
+    atexit.register(presence_buffer.stop)
+
+    # So is the lastActivity of contacts and groups (see activity_tracker.py)
+    activity_tracker.start(contacts_collection, groups_collection)
+    atexit.register(activity_tracker.stop)
+
+    # Part files left behind by expired or aborted chunked uploads, purged periodically
+    atexit.register(start_part_purger(uploads_collection, UPLOAD_FOLDER).set)
+
+    # Online/offline changes are sent in periodic batches to contacts and group peers only
+    presence_fanout.start(socketio, db, socket_sessions.online_among)
+
+    # Connections this worker held before a restart are gone
+    for offline_user_id in socket_sessions.presence.purge_worker():
+        presence_buffer.record(offline_user_id, get_utc_now(), is_online=False)
+        presence_fanout.publish(offline_user_id, 'offline')
+
+# Members listed per group by GET /api/groups?members=summary
+GROUP_MEMBER_SUMMARY_SIZE = 10
+MAX_GROUP_MEMBER_SUMMARY_SIZE = 100
 
 # No OpenAI integration
 
@@ -194,16 +263,21 @@ def save_file(file_data, file_type, file_name, conversation_id=None):
         traceback.print_exc()
         return None
 
-# Active users dictionary to track online status
-active_users = {}
-
 # Helper functions
-def generate_token(user_id):
-    """Generate JWT token for authenticated user"""
+def generate_token(user_id, auth_time=None):
+    """Generate JWT token for authenticated user
+
+    `auth_time` (seconds since the epoch) is the login the session started
+    with; refreshed tokens carry it forward and never outlive SESSION_MAX_AGE.
+    """
     now = get_utc_now()
+    if auth_time is None:
+        auth_time = int(now.timestamp())
+    session_end = datetime.fromtimestamp(auth_time, tz=timezone.utc) + SESSION_MAX_AGE
     payload = {
-        'exp': now + timedelta(days=1),
+        'exp': min(now + timedelta(days=1), session_end),
         'iat': now,
+        'auth_time': auth_time,
         'sub': str(user_id)
     }
     return jwt.encode(
@@ -212,33 +286,45 @@ def generate_token(user_id):
         algorithm='HS256'
     )
 
-def verify_token(token):
-    """Verify JWT token and return user_id if valid"""
+def decode_token(token):
+    """Verify JWT token and return its payload if valid"""
     try:
-        payload = jwt.decode(
+        return jwt.decode(
             token,
             app.config.get('SECRET_KEY'),
             algorithms=['HS256']
         )
-        return payload['sub']
     except jwt.ExpiredSignatureError:
         return None
     except jwt.InvalidTokenError:
         return None
 
+def verify_token(token):
+    """Verify JWT token and return user_id if valid"""
+    payload = decode_token(token)
+    return payload['sub'] if payload else None
+
+def socket_user():
+    """User id bound to the current socket at connect (None once its token expired)
+
+    Asks the client to re-authenticate when the token is about to expire.
+    """
+    user_id, reauth = socket_sessions.authenticate(request.sid)
+    if reauth:
+        emit('reauth_required', {'expired': user_id is None})
+    return user_id
+
 def delete_group_messages(group_id, user_id=None):
     """Mark all messages in a group as deleted for a specific user
 
-    If user_id is provided, only mark messages as deleted for that user.
+    If user_id is provided, only hide the current history from that user (one
+    watermark write, whatever the size of the history).
     If user_id is None, actually delete the messages (used when deleting the entire group).
     """
     try:
         if user_id:
-            # Mark messages as deleted for this user only
-            group_messages_collection.update_many(
-                {"groupId": ObjectId(group_id)},
-                {"$addToSet": {"deletedBy": ObjectId(user_id)}}
-            )
+            # Hide messages up to now for this user only
+            mark_cleared(conversations_collection, group_conversation_id(group_id), user_id, get_utc_now())
         else:
             # Actually delete messages (only used when deleting the entire group)
             group_messages_collection.delete_many({"groupId": ObjectId(group_id)})
@@ -290,6 +376,7 @@ def signup():
     # Insert user into database
     result = users_collection.insert_one(user)
     user_id = result.inserted_id
+    invalidate_user_profile(user_id)
 
     # Generate token
     token = generate_token(user_id)
@@ -348,6 +435,22 @@ def signin():
         "token": token
     }), 200
 
+@app.route('/api/auth/refresh', methods=['POST'])
+def refresh_token():
+    """Exchange a valid token for a fresh one (sockets renew theirs with `reauth`)"""
+    token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    payload = decode_token(token)
+
+    if not payload:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    # The session ends SESSION_MAX_AGE after its login, however often it was refreshed
+    auth_time = int(payload.get('auth_time', payload['iat']))
+    if get_utc_now() >= datetime.fromtimestamp(auth_time, tz=timezone.utc) + SESSION_MAX_AGE:
+        return jsonify({"error": "Session expired, please sign in again"}), 401
+
+    return jsonify({"token": generate_token(payload['sub'], auth_time)}), 200
+
 @app.route('/api/auth/change-password', methods=['POST'])
 def change_password():
     token = request.headers.get('Authorization', '').replace('Bearer ', '')
@@ -431,69 +534,83 @@ def get_contacts():
     if not user_id:
         return jsonify({"error": "Unauthorized"}), 401
 
-    # Find all contacts for the user
-    user_contacts = contacts_collection.find({"userId": ObjectId(user_id)})
+    user_oid = ObjectId(user_id)
+
+    contact_id_str = {"$toString": "$contactId"}
+
+    # Resolve every contact, its user document and its conversation summary
+    # in a single aggregation (constant round trips, indexed _id lookups)
+    user_contacts = contacts_collection.aggregate([
+        {"$match": {"userId": user_oid}},
+        {"$addFields": {"conversationId": {"$concat": [
+            "dm_", {"$min": [user_id, contact_id_str]}, "_", {"$max": [user_id, contact_id_str]}
+        ]}}},
+        {"$lookup": {
+            "from": users_collection.name,
+            "localField": "contactId",
+            "foreignField": "_id",
+            "as": "contactUser"
+        }},
+        # Contacts whose user no longer exists are dropped here
+        {"$unwind": "$contactUser"},
+        {"$lookup": {
+            "from": conversations_collection.name,
+            "localField": "conversationId",
+            "foreignField": "_id",
+            "as": "conversation"
+        }},
+        {"$project": {
+            "_id": 0,
+            "categoryId": 1,
+            "categoryIds": 1,
+            "createdAt": 1,
+            "lastActivity": 1,
+            "contactUser._id": 1,
+            "contactUser.name": 1,
+            "contactUser.email": 1,
+            "contactUser.department": 1,
+            "conversation": {"$arrayElemAt": ["$conversation", 0]}
+        }}
+    ])
 
     # Get contact details with last message timestamp
     contacts_list = []
     for contact in user_contacts:
-        contact_user = users_collection.find_one({"_id": contact["contactId"]})
-        if contact_user:
-            # Get the most recent message timestamp for this contact
-            last_message = messages_collection.find({
-                "$and": [
-                    {
-                        "$or": [
-                            {"senderId": ObjectId(user_id), "receiverId": contact["contactId"]},
-                            {"senderId": contact["contactId"], "receiverId": ObjectId(user_id)}
-                        ]
-                    },
-                    {
-                        "$or": [
-                            {"deletedBy": {"$exists": False}},
-                            {"deletedBy": {"$not": {"$elemMatch": {"$eq": ObjectId(user_id)}}}}
-                        ]
-                    }
-                ]
-            }).sort("timestamp", -1).limit(1)
-
-            last_message_time = None
-            for msg in last_message:
-                last_message_time = msg["timestamp"]
-                break
-
-            # Use last message time if available, otherwise use lastActivity
-            sort_timestamp = last_message_time if last_message_time else contact.get("lastActivity", contact.get("createdAt", get_utc_now()))
-
-            # Include categoryId if it exists
-            contact_data = {
-                "id": str(contact_user["_id"]),
-                "name": contact_user["name"],
-                "email": contact_user["email"],
-                "department": contact_user.get("department", ""),
-                "isActive": str(contact_user["_id"]) in active_users,
-                "lastActivity": contact.get("lastActivity", contact.get("createdAt", get_utc_now())).isoformat(),
-                "lastMessageTime": sort_timestamp.isoformat() if sort_timestamp else None
-            }
+        contact_user = contact["contactUser"]
+        conversation = contact.get("conversation")
+        last_activity = contact.get("lastActivity", contact.get("createdAt", get_utc_now()))
+
+        # Use last message time if available, otherwise use lastActivity
+        last_message, last_message_time = visible_last_message(conversation, user_id)
+        sort_timestamp = last_message_time or last_activity
+
+        # Include categoryId if it exists
+        contact_data = {
+            "id": str(contact_user["_id"]),
+            "name": contact_user["name"],
+            "email": contact_user["email"],
+            "department": contact_user.get("department", ""),
+            "isActive": socket_sessions.is_online(contact_user["_id"]),
+            "lastActivity": last_activity.isoformat(),
+            "lastMessageTime": sort_timestamp.isoformat() if sort_timestamp else None,
+            "lastMessage": last_message["text"] if last_message else "",
+            "unreadCount": unread_count(conversation, user_id)
+        }
 
-            # Add categoryIds array if it exists
-            if "categoryIds" in contact and contact["categoryIds"]:
-                contact_data["categoryIds"] = [str(cat_id) for cat_id in contact["categoryIds"]]
-                print(f"Contact {contact_data['name']} has categories: {contact_data['categoryIds']}")
-
-                # For backward compatibility, set the first category as the main categoryId
-                if contact["categoryIds"]:
-                    contact_data["categoryId"] = str(contact["categoryIds"][0])
-            # Fall back to single categoryId if categoryIds doesn't exist
-            elif "categoryId" in contact:
-                contact_data["categoryId"] = str(contact["categoryId"])
-                contact_data["categoryIds"] = [str(contact["categoryId"])]
-                print(f"Contact {contact_data['name']} has category: {contact_data['categoryId']}")
-            else:
-                print(f"Contact {contact_data['name']} has no category")
-                contact_data["categoryIds"] = []
+        # Add categoryIds array if it exists
+        if contact.get("categoryIds"):
+            contact_data["categoryIds"] = [str(cat_id) for cat_id in contact["categoryIds"]]
 
-            contacts_list.append(contact_data)
+            # For backward compatibility, set the first category as the main categoryId
+            contact_data["categoryId"] = str(contact["categoryIds"][0])
+        # Fall back to single categoryId if categoryIds doesn't exist
+        elif "categoryId" in contact:
+            contact_data["categoryId"] = str(contact["categoryId"])
+            contact_data["categoryIds"] = [str(contact["categoryId"])]
+        else:
+            contact_data["categoryIds"] = []
+
+        contacts_list.append(contact_data)
 
     # Sort contacts by most recent message timestamp (most recent first)
     contacts_list.sort(key=lambda x: x["lastMessageTime"] if x["lastMessageTime"] else x["lastActivity"], reverse=True)
@@ -545,6 +662,7 @@ def add_contact():
 
     # Insert the contact first
     contact_id = contacts_collection.insert_one(contact).inserted_id
+    presence_fanout.invalidate([contact_user["_id"]])
 
     # Now handle department categories
     if department:
@@ -605,7 +723,7 @@ def add_contact():
         "name": contact_user["name"],
         "email": contact_user["email"],
         "department": contact_user.get("department", ""),
-        "isActive": str(contact_user["_id"]) in active_users,
+        "isActive": socket_sessions.is_online(contact_user["_id"]),
         "categoryId": str(contact.get("categoryId")) if "categoryId" in contact else None
     }), 201
 
@@ -632,14 +750,13 @@ def delete_contact(contact_id):
             "userId": ObjectId(user_id),
             "contactId": ObjectId(contact_id)
         })
+        presence_fanout.invalidate([contact_id])
 
         # Supprimer également les messages associés
-        messages_collection.delete_many({
-            "$or": [
-                {"senderId": ObjectId(user_id), "receiverId": ObjectId(contact_id)},
-                {"senderId": ObjectId(contact_id), "receiverId": ObjectId(user_id)}
-            ]
-        })
+        conversation_id = dm_conversation_id(user_id, contact_id)
+        messages_collection.delete_many({"conversationId": conversation_id})
+        conversations_collection.delete_one({"_id": conversation_id})
+        drop_conversation(message_buckets_collection, conversation_id)
 
         return jsonify({"message": "Contact deleted successfully"}), 200
 
@@ -656,24 +773,27 @@ def messages_operations(contact_id):
     if not user_id:
         return jsonify({"error": "Unauthorized"}), 401
 
+    # Both directions of the conversation share one canonical key
+    conversation_id = dm_conversation_id(user_id, contact_id)
+
     if request.method == 'GET':
-        # Get messages between user and contact, excluding those deleted by the current user
-        messages = messages_collection.find({
-            "$and": [
-                {
-                    "$or": [
-                        {"senderId": ObjectId(user_id), "receiverId": ObjectId(contact_id)},
-                        {"senderId": ObjectId(contact_id), "receiverId": ObjectId(user_id)}
-                    ]
-                },
-                {
-                    "$or": [
-                        {"deletedBy": {"$exists": False}},
-                        {"deletedBy": {"$not": {"$elemMatch": {"$eq": ObjectId(user_id)}}}}
-                    ]
-                }
-            ]
-        }).sort("timestamp", 1)
+        # History is paginated: latest page by default, older/newer pages via cursors
+        try:
+            direction, cursor, limit = parse_page_args(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # Get messages between user and contact, excluding those cleared or hidden by the current user
+        if BUCKETED_STORAGE:
+            cleared_at, hidden = get_visibility(conversations_collection, conversation_id, user_id)
+            messages, has_more = fetch_bucketed_page(
+                message_buckets_collection, conversation_id, direction, cursor, limit, cleared_at, hidden
+            )
+        else:
+            messages, has_more = fetch_page(messages_collection, {
+                "conversationId": conversation_id,
+                **get_visibility_filter(conversations_collection, conversation_id, user_id)
+            }, direction, cursor, limit)
 
         # Format messages for the frontend
         messages_list = []
@@ -689,40 +809,20 @@ def messages_operations(contact_id):
                 "isDeleted": msg.get("isDeleted", False)
             })
 
-        # Always update lastActivity for this conversation when messages are viewed
-        # This ensures conversations move to the top when messages are received, not just when sent
-        current_time = get_utc_now()
-
-        # Update lastActivity in contacts collection for both users
-        contacts_collection.update_one(
-            {"userId": ObjectId(user_id), "contactId": ObjectId(contact_id)},
-            {"$set": {"lastActivity": current_time}}
-        )
-
-        # Also update the contact in the other user's contact list
-        contacts_collection.update_one(
-            {"userId": ObjectId(contact_id), "contactId": ObjectId(user_id)},
-            {"$set": {"lastActivity": current_time}}
-        )
+        # Viewing the conversation marks it as read (lastActivity only moves when messages are sent)
+        mark_read(conversations_collection, conversation_id, user_id)
 
-        return jsonify(messages_list), 200
+        return jsonify(messages_list), 200, pagination_headers(messages, has_more)
 
     elif request.method == 'DELETE':
         try:
-            # Mark all messages between user and contact as deleted for this user only
-            result = messages_collection.update_many(
-                {
-                    "$or": [
-                        {"senderId": ObjectId(user_id), "receiverId": ObjectId(contact_id)},
-                        {"senderId": ObjectId(contact_id), "receiverId": ObjectId(user_id)}
-                    ]
-                },
-                {"$addToSet": {"deletedBy": ObjectId(user_id)}}
-            )
+            # Hide all messages up to now for this user only: one watermark write
+            cleared_at = get_utc_now()
+            mark_cleared(conversations_collection, conversation_id, user_id, cleared_at)
 
             return jsonify({
                 "message": "Messages deleted successfully",
-                "count": result.modified_count
+                "clearedAt": cleared_at.isoformat()
             }), 200
         except Exception as e:
             print(f"Error deleting messages: {e}")
@@ -736,45 +836,153 @@ def search_messages(contact_id):
     if not user_id:
         return jsonify({"error": "Unauthorized"}), 401
 
-    query = request.args.get('query', '')
-    if not query:
-        return jsonify({"error": "Search query is required"}), 400
-
-    # Search messages between user and contact that contain the query, excluding deleted ones
-    messages = messages_collection.find({
-        "$and": [
-            {
-                "$or": [
-                    {"senderId": ObjectId(user_id), "receiverId": ObjectId(contact_id)},
-                    {"senderId": ObjectId(contact_id), "receiverId": ObjectId(user_id)}
-                ]
-            },
-            {"text": {"$regex": query, "$options": "i"}},  # Case-insensitive search
-            {
-                "$or": [
-                    {"deletedBy": {"$exists": False}},
-                    {"deletedBy": {"$not": {"$elemMatch": {"$eq": ObjectId(user_id)}}}}
-                ]
-            }
-        ]
-    }).sort("timestamp", 1)
+    try:
+        terms, cursor, limit = parse_search_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Ranked token search in the conversation, excluding messages the user cleared or hid
+    conversation_id = dm_conversation_id(user_id, contact_id)
+    messages, next_cursor = search(messages_collection, {
+        "conversationId": conversation_id,
+        **get_visibility_filter(conversations_collection, conversation_id, user_id)
+    }, terms, cursor, limit)
+
+    # Resolve every sender of the result set at once
+    sender_names = get_user_names(users_collection, [msg["senderId"] for msg in messages])
 
     # Format messages for the frontend
     results = []
     for msg in messages:
         sender_id = str(msg["senderId"])
-        sender = users_collection.find_one({"_id": msg["senderId"]})
-        sender_name = sender["name"] if sender else "Unknown"
 
         results.append({
             "id": str(msg["_id"]),
             "sender": sender_id,
-            "senderName": sender_name,
+            "senderName": sender_names[sender_id],
             "text": msg["text"],
-            "timestamp": msg["timestamp"].isoformat()
+            "timestamp": msg["timestamp"].isoformat(),
+            "score": msg["score"],
+            "highlights": highlight_offsets(msg["text"], terms)
         })
 
-    return jsonify({"results": results, "count": len(results)}), 200
+    return jsonify({"results": results, "count": len(results), "nextCursor": next_cursor}), 200
+
+@app.route('/api/messages/<contact_id>/<message_id>/hide', methods=['POST'])
+def hide_direct_message(contact_id, message_id):
+    token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    user_id = verify_token(token)
+
+    if not user_id:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    if not ObjectId.is_valid(message_id):
+        return jsonify({"error": "Invalid message id"}), 400
+
+    conversation_id = dm_conversation_id(user_id, contact_id)
+    if not messages_collection.find_one({"_id": ObjectId(message_id), "conversationId": conversation_id}, {"_id": 1}):
+        return jsonify({"error": "Message not found"}), 404
+
+    # Hide the message from this user's history only
+    hide_message(conversations_collection, conversation_id, user_id, ObjectId(message_id))
+    return jsonify({"message": "Message hidden"}), 200
+
+@app.route('/api/search', methods=['GET'])
+def search_all_messages():
+    token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    user_id = verify_token(token)
+
+    if not user_id:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    try:
+        terms, cursor, limit = parse_search_args(request.args, decode_conversation_cursor)
+        hits_per_conversation = int(request.args.get('hits', DEFAULT_HITS_PER_CONVERSATION))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    hits_per_conversation = max(1, min(hits_per_conversation, MAX_HITS_PER_CONVERSATION))
+
+    # Every conversation the user can see: their DMs and the groups they belong to
+    dm_ids = [summary["_id"] for summary in conversations_collection.find(
+        {"type": "dm", "participants": ObjectId(user_id)}, {"_id": 1}
+    )]
+    user_groups = {
+        group["_id"]: group
+        for group in groups_collection.find(
+            {"_id": {"$in": member_group_ids(group_members_collection, user_id)}}, {"name": 1}
+        )
+    }
+
+    # Messages the user cleared or hid, per conversation
+    dm_scope = {conversation_id: conversation_id for conversation_id in dm_ids}
+    group_scope = {group_conversation_id(group_id): group_id for group_id in user_groups}
+    filters = get_visibility_filters(conversations_collection, list(dm_scope) + list(group_scope), user_id)
+
+    # One aggregation per collection over the (conversation, searchTokens) indexes
+    conversations, next_cursor = search_conversations([
+        (messages_collection,
+         visible_in_conversations("conversationId", dm_scope, filters),
+         "$conversationId"),
+        (group_messages_collection,
+         visible_in_conversations("groupId", group_scope, filters),
+         {"$concat": ["group_", {"$toString": "$groupId"}]})
+    ], terms, cursor, limit, hits_per_conversation)
+
+    # Resolve contact and sender names of the whole page at once
+    user_ids = {user_id}
+    for conversation in conversations:
+        if conversation["_id"].startswith("dm_"):
+            user_ids.update(conversation["_id"][3:].split("_"))
+        user_ids.update(hit["senderId"] for hit in conversation["hits"])
+    names = get_user_names(users_collection, user_ids)
+
+    results = []
+    for conversation in conversations:
+        conversation_id = conversation["_id"]
+        if conversation_id.startswith("dm_"):
+            contact_id = next((uid for uid in conversation_id[3:].split("_") if uid != user_id), user_id)
+            result = {"type": "dm", "contactId": contact_id, "name": names[contact_id]}
+        else:
+            group_id = conversation_id[len("group_"):]
+            group = user_groups.get(ObjectId(group_id), {})
+            result = {"type": "group", "groupId": group_id, "name": group.get("name", "Unknown")}
+
+        hits = conversation["hits"]
+        result.update({
+            "conversationId": conversation_id,
+            "score": conversation["bestScore"],
+            "matchCount": conversation["matchCount"],
+            "hits": [{
+                "id": str(hit["_id"]),
+                "sender": str(hit["senderId"]),
+                "senderName": names[str(hit["senderId"])],
+                "text": hit["text"],
+                "timestamp": hit["timestamp"].isoformat(),
+                "messageType": hit.get("messageType", "text"),
+                "score": hit["score"],
+                "highlights": highlight_offsets(hit["text"], terms)
+            } for hit in hits],
+            # Continue within this conversation through its scoped search endpoint
+            "nextCursor": encode_search_cursor(hits[-1]) if conversation["matchCount"] > len(hits) else None
+        })
+        results.append(result)
+
+    return jsonify({"results": results, "count": len(results), "nextCursor": next_cursor}), 200
+
+@app.route('/api/sync', methods=['GET'])
+def sync():
+    token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    user_id = verify_token(token)
+
+    if not user_id:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    try:
+        since, limit = parse_sync_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify(sync_events(db, user_id, since, limit)), 200
 
 # Admin routes
 @app.route('/api/admin/users', methods=['GET'])
@@ -786,7 +994,7 @@ def get_all_users():
         return jsonify({"error": "Unauthorized"}), 401
 
     # Check if user is admin
-    user = users_collection.find_one({"_id": ObjectId(user_id)})
+    user = get_user_roles(users_collection, user_id)
     if not user or not user.get("isAdmin", False):
         return jsonify({"error": "Forbidden"}), 403
 
@@ -802,7 +1010,7 @@ def get_all_users():
             "isAdmin": user.get("isAdmin", False),
             "adminRole": user.get("adminRole", None),
             "department": user.get("department", ""),
-            "isActive": str(user["_id"]) in active_users,
+            "isActive": socket_sessions.is_online(user["_id"]),
             "lastActive": user.get("lastActive", user.get("createdAt")).isoformat(),
             "createdAt": user.get("createdAt").isoformat() if "createdAt" in user else None
         })
@@ -818,69 +1026,36 @@ def get_all_messages():
         return jsonify({"error": "Unauthorized"}), 401
 
     # Check if user is admin
-    user = users_collection.find_one({"_id": ObjectId(user_id)})
+    user = get_user_roles(users_collection, user_id)
     if not user or not user.get("isAdmin", False):
         return jsonify({"error": "Forbidden"}), 403
 
     # Check if user is admin master (for handling encrypted messages)
     is_admin_master = user.get("adminRole") == "admin_master"
 
-    # Get all messages
-    all_messages = messages_collection.find({}).sort("timestamp", -1).limit(100)
-    messages_list = []
+    try:
+        query = parse_audit_filters(request.args)
+        direction, cursor, limit = parse_page_args(request.args, DEFAULT_AUDIT_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    sender_cache = {}
-    receiver_cache = {}
+    messages, has_more = fetch_page(messages_collection, query, direction, cursor, limit)
+    headers = pagination_headers(messages, has_more)
 
-    for msg in all_messages:
-        sender_id = str(msg["senderId"])
-        receiver_id = str(msg["receiverId"])
-
-        if sender_id not in sender_cache:
-            sender = users_collection.find_one({"_id": ObjectId(sender_id)})
-            sender_cache[sender_id] = sender["name"] if sender else "Unknown"
-
-        if receiver_id not in receiver_cache:
-            receiver = users_collection.find_one({"_id": ObjectId(receiver_id)})
-            receiver_cache[receiver_id] = receiver["name"] if receiver else "Unknown"
-
-        # Include information about who deleted the message
-        deleted_by = []
-        if "deletedBy" in msg and msg["deletedBy"]:
-            for deleted_user_id in msg["deletedBy"]:
-                deleted_user = users_collection.find_one({"_id": deleted_user_id})
-                if deleted_user:
-                    deleted_by.append({
-                        "id": str(deleted_user_id),
-                        "name": deleted_user["name"]
-                    })
-
-        # Handle encrypted messages - only hide messages that are actually encrypted
-        message_text = msg["text"]
-        is_encrypted = msg.get("encrypted", False)
-
-        # Only hide messages that are actually encrypted (not just because user has encryption enabled)
-        if is_encrypted:
-            message_text = "End-to-End Encrypted Message"
-
-        messages_list.append({
-            "id": str(msg["_id"]),
-            "senderId": sender_id,
-            "senderName": sender_cache[sender_id],
-            "receiverId": receiver_id,
-            "receiverName": receiver_cache[receiver_id],
-            "text": message_text,
-            "timestamp": msg["timestamp"].isoformat(),
-            "isDeleted": msg.get("isDeleted", False),
-            "deletedBy": deleted_by,
-            "fileUrl": msg.get("fileUrl"),
-            "fileType": msg.get("fileType"),
-            "fileName": msg.get("fileName"),
-            "encrypted": is_encrypted,
-            "urgencyLevel": msg.get("urgencyLevel", "normal")
-        })
+    # Clear watermarks, then senders, receivers and deleters of the whole page in one batched lookup each
+    summaries = load_audit_summaries(conversations_collection, messages)
+    profiles = get_user_profiles(users_collection, audit_user_ids(messages, summaries))
 
-    return jsonify(messages_list), 200
+    # Newest first, as the admin views have always listed messages
+    messages_list = []
+    for msg in reversed(messages):
+        message_data = format_audit_message(msg, profiles, summaries)
+        receiver = profiles.get(str(msg["receiverId"]))
+        message_data["receiverId"] = str(msg["receiverId"])
+        message_data["receiverName"] = receiver["name"] if receiver else "Unknown"
+        messages_list.append(message_data)
+
+    return jsonify(messages_list), 200, headers
 
 @app.route('/api/admin/group-messages', methods=['GET'])
 def get_all_group_messages():
@@ -891,70 +1066,41 @@ def get_all_group_messages():
         return jsonify({"error": "Unauthorized"}), 401
 
     # Check if user is admin
-    user = users_collection.find_one({"_id": ObjectId(user_id)})
+    user = get_user_roles(users_collection, user_id)
     if not user or not user.get("isAdmin", False):
         return jsonify({"error": "Forbidden"}), 403
 
     # Check if user is admin master (for handling encrypted messages)
     is_admin_master = user.get("adminRole") == "admin_master"
 
-    # Get all group messages
-    all_messages = group_messages_collection.find({}).sort("timestamp", -1).limit(100)
-    messages_list = []
-
-    sender_cache = {}
-    group_cache = {}
+    try:
+        query = parse_audit_filters(request.args, group_messages=True)
+        direction, cursor, limit = parse_page_args(request.args, DEFAULT_AUDIT_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    messages, has_more = fetch_page(group_messages_collection, query, direction, cursor, limit)
+    headers = pagination_headers(messages, has_more)
+
+    # Clear watermarks, users and groups of the whole page in one batched lookup each
+    summaries = load_audit_summaries(conversations_collection, messages)
+    profiles = get_user_profiles(users_collection, audit_user_ids(messages, summaries))
+    group_names = {
+        str(group["_id"]): group["name"]
+        for group in groups_collection.find(
+            {"_id": {"$in": list({msg["groupId"] for msg in messages})}}, {"name": 1}
+        )
+    }
 
-    for msg in all_messages:
-        sender_id = str(msg["senderId"])
-        group_id = str(msg["groupId"])
-
-        if sender_id not in sender_cache:
-            sender = users_collection.find_one({"_id": ObjectId(sender_id)})
-            sender_cache[sender_id] = sender["name"] if sender else "Unknown"
-
-        if group_id not in group_cache:
-            group = groups_collection.find_one({"_id": ObjectId(group_id)})
-            group_cache[group_id] = group["name"] if group else "Unknown Group"
-
-        # Include information about who deleted the message
-        deleted_by = []
-        if "deletedBy" in msg and msg["deletedBy"]:
-            for deleted_user_id in msg["deletedBy"]:
-                deleted_user = users_collection.find_one({"_id": deleted_user_id})
-                if deleted_user:
-                    deleted_by.append({
-                        "id": str(deleted_user_id),
-                        "name": deleted_user["name"]
-                    })
-
-        # Handle encrypted messages differently for regular admins vs admin masters
-        message_text = msg["text"]
-        is_encrypted = msg.get("encrypted", False)
-
-        # If message is encrypted, always show placeholder text regardless of who sent it
-        # This ensures admin's own messages are also shown as encrypted
-        if is_encrypted:
-            message_text = "End-to-End Encrypted Message"
-
-        messages_list.append({
-            "id": str(msg["_id"]),
-            "senderId": sender_id,
-            "senderName": sender_cache[sender_id],
-            "groupId": group_id,
-            "groupName": group_cache[group_id],
-            "text": message_text,
-            "timestamp": msg["timestamp"].isoformat(),
-            "isDeleted": msg.get("isDeleted", False),
-            "deletedBy": deleted_by,
-            "fileUrl": msg.get("fileUrl"),
-            "fileType": msg.get("fileType"),
-            "fileName": msg.get("fileName"),
-            "encrypted": is_encrypted,
-            "urgencyLevel": msg.get("urgencyLevel", "normal")
-        })
+    # Newest first, as the admin views have always listed messages
+    messages_list = []
+    for msg in reversed(messages):
+        message_data = format_audit_message(msg, profiles, summaries)
+        message_data["groupId"] = str(msg["groupId"])
+        message_data["groupName"] = group_names.get(str(msg["groupId"]), "Unknown Group")
+        messages_list.append(message_data)
 
-    return jsonify(messages_list), 200
+    return jsonify(messages_list), 200, headers
 
 @app.route('/api/admin/users/<user_id>', methods=['DELETE'])
 def delete_user(user_id):
@@ -965,13 +1111,13 @@ def delete_user(user_id):
         return jsonify({"error": "Unauthorized"}), 401
 
     # Check if the requester is an admin
-    admin = users_collection.find_one({"_id": ObjectId(admin_id)})
+    admin = get_user_roles(users_collection, admin_id)
     if not admin or not admin.get("isAdmin", False):
         return jsonify({"error": "Forbidden"}), 403
 
     try:
         # Check if user exists
-        user = users_collection.find_one({"_id": ObjectId(user_id)})
+        user = get_user_roles(users_collection, user_id)
         if not user:
             return jsonify({"error": "User not found"}), 404
 
@@ -1009,14 +1155,19 @@ def delete_user(user_id):
         # Delete user's group messages
         group_messages_collection.delete_many({"senderId": ObjectId(user_id)})
 
+        # Delete the summaries (and buckets) of the user's direct conversations
+        if BUCKETED_STORAGE:
+            for summary in conversations_collection.find({"type": "dm", "participants": ObjectId(user_id)}, {"_id": 1}):
+                drop_conversation(message_buckets_collection, summary["_id"])
+            drop_sender_messages(message_buckets_collection, user_id)
+        conversations_collection.delete_many({"type": "dm", "participants": ObjectId(user_id)})
+
         # Remove user from all groups
-        groups_collection.update_many(
-            {"members.userId": ObjectId(user_id)},
-            {"$pull": {"members": {"userId": ObjectId(user_id)}}}
-        )
+        remove_user_memberships(group_members_collection, user_id)
 
         # Finally delete the user
         result = users_collection.delete_one({"_id": ObjectId(user_id)})
+        invalidate_user_profile(user_id)
 
         if result.deleted_count == 0:
             return jsonify({"error": "Failed to delete user"}), 500
@@ -1036,13 +1187,13 @@ def promote_user(user_id):
         return jsonify({"error": "Unauthorized"}), 401
 
     # Check if the requester is an admin
-    admin = users_collection.find_one({"_id": ObjectId(admin_id)})
+    admin = get_user_roles(users_collection, admin_id)
     if not admin or not admin.get("isAdmin", False):
         return jsonify({"error": "Forbidden"}), 403
 
     # Regular admins can only promote regular users to regular admin role
     # Admin masters can promote any user to any role
-    target_user = users_collection.find_one({"_id": ObjectId(user_id)})
+    target_user = get_user_roles(users_collection, user_id)
 
     # If requester is not admin_master, they can only promote non-admin users to regular admin
     if admin.get("adminRole") != "admin_master":
@@ -1051,7 +1202,7 @@ def promote_user(user_id):
 
     try:
         # Check if user exists
-        user = users_collection.find_one({"_id": ObjectId(user_id)})
+        user = get_user_profile(users_collection, user_id)
         if not user:
             return jsonify({"error": "User not found"}), 404
 
@@ -1064,6 +1215,7 @@ def promote_user(user_id):
             {"_id": ObjectId(user_id)},
             {"$set": {"isAdmin": True, "adminRole": "admin"}}
         )
+        invalidate_user_profile(user_id)
 
         if result.modified_count == 0:
             return jsonify({"error": "Failed to promote user"}), 500
@@ -1083,13 +1235,13 @@ def promote_user_to_master(user_id):
         return jsonify({"error": "Unauthorized"}), 401
 
     # Check if the requester is an admin master
-    admin = users_collection.find_one({"_id": ObjectId(admin_id)})
+    admin = get_user_roles(users_collection, admin_id)
     if not admin or not admin.get("isAdmin", False) or admin.get("adminRole") != "admin_master":
         return jsonify({"error": "Forbidden - Only admin masters can promote to admin master"}), 403
 
     try:
         # Check if user exists
-        user = users_collection.find_one({"_id": ObjectId(user_id)})
+        user = get_user_profile(users_collection, user_id)
         if not user:
             return jsonify({"error": "User not found"}), 404
 
@@ -1102,6 +1254,7 @@ def promote_user_to_master(user_id):
             {"_id": ObjectId(user_id)},
             {"$set": {"isAdmin": True, "adminRole": "admin_master"}}
         )
+        invalidate_user_profile(user_id)
 
         if result.modified_count == 0:
             return jsonify({"error": "Failed to promote user to admin master"}), 500
@@ -1121,13 +1274,13 @@ def demote_user(user_id):
         return jsonify({"error": "Unauthorized"}), 401
 
     # Check if the requester is an admin master - ONLY admin masters can demote users
-    admin = users_collection.find_one({"_id": ObjectId(admin_id)})
+    admin = get_user_roles(users_collection, admin_id)
     if not admin or not admin.get("isAdmin", False) or admin.get("adminRole") != "admin_master":
         return jsonify({"error": "Forbidden - Only admin masters can demote users"}), 403
 
     try:
         # Check if user exists
-        user = users_collection.find_one({"_id": ObjectId(user_id)})
+        user = get_user_profile(users_collection, user_id)
         if not user:
             return jsonify({"error": "User not found"}), 404
 
@@ -1140,6 +1293,7 @@ def demote_user(user_id):
             {"_id": ObjectId(user_id)},
             {"$set": {"isAdmin": False}}
         )
+        invalidate_user_profile(user_id)
 
         if result.modified_count == 0:
             return jsonify({"error": "Failed to demote user"}), 500
@@ -1242,39 +1396,49 @@ def handle_connect():
     if not token:
         return False
 
-    user_id = verify_token(token)
-    if not user_id:
+    payload = decode_token(token)
+    if not payload:
         return False
 
-    # Join user's personal room
+    # Authenticate once: later events of this socket are attributed from the session
+    user_id = payload['sub']
+    profile = get_user_profile(users_collection, user_id)
+    came_online = socket_sessions.bind(request.sid, user_id, payload['exp'], device={
+        "userAgent": request.headers.get('User-Agent'),
+        "transport": request.args.get('transport')
+    }, name=profile["name"] if profile else None)
+
+    # Join user's personal room (shared by all of the user's devices)
     join_room(user_id)
-    active_users[user_id] = request.sid
 
-    # Update user's online status in database
-    users_collection.update_one(
-        {"_id": ObjectId(user_id)},
-        {"$set": {"lastActive": get_utc_now(), "isOnline": True}}
-    )
+    # Admin screens list every user, so admins receive every status change
+    roles = get_user_roles(users_collection, user_id)
+    if roles and roles.get("isAdmin", False):
+        join_room(ADMIN_ROOM)
 
-    # Broadcast user online status to all users
-    emit('user_status', {'userId': user_id, 'status': 'online'}, broadcast=True)
+    # Update user's online status in database (written by the next presence flush)
+    presence_buffer.record(user_id, get_utc_now(), is_online=True)
+
+    # Tell the user's contacts and group peers, unless another device already did
+    if came_online:
+        presence_fanout.publish(user_id, 'online')
     return True
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    for user_id, sid in list(active_users.items()):
-        if sid == request.sid:
-            active_users.pop(user_id)
-
-            # Update user's online status in database
-            users_collection.update_one(
-                {"_id": ObjectId(user_id)},
-                {"$set": {"lastActive": get_utc_now(), "isOnline": False}}
-            )
+    session, went_offline = socket_sessions.unbind(request.sid)
+
+    # The user stays online while any of their other devices is connected
+    if not went_offline:
+        return
+
+    user_id = session["userId"]
+
+    # Update user's online status in database (written by the next presence flush)
+    presence_buffer.record(user_id, get_utc_now(), is_online=False)
 
-            # Broadcast user offline status to all users
-            emit('user_status', {'userId': user_id, 'status': 'offline'}, broadcast=True)
-            break
+    # Tell the user's contacts and group peers
+    presence_fanout.publish(user_id, 'offline')
 
 @socketio.on('heartbeat')
 def handle_heartbeat():
@@ -1284,20 +1448,34 @@ def handle_heartbeat():
     emit('heartbeat-ack', {'status': 'ok', 'timestamp': now.isoformat()})
     print(f"Heartbeat received from {request.sid}")
 
-    # Update user's last active timestamp
-    for user_id, sid in active_users.items():
-        if sid == request.sid:
-            # Update user's last active timestamp in database
-            users_collection.update_one(
-                {"_id": ObjectId(user_id)},
-                {"$set": {"lastActive": now}}
-            )
-            break
+    # Update user's last active timestamp (written by the next presence flush)
+    user_id = socket_sessions.touch(request.sid)
+    if user_id:
+        presence_buffer.record(user_id, now)
+
+@socketio.on('reauth')
+def handle_reauth(data=None):
+    """Extend the session of a connected socket with a fresh token"""
+    if not data:
+        emit('reauth_required', {'expired': True})
+        return
+
+    payload = decode_token(data.get('token'))
+    session = socket_sessions.get(request.sid)
+
+    # The socket has joined its user's rooms: a token can only renew the same user
+    if not payload or not session or payload['sub'] != session['userId']:
+        emit('reauth_required', {'expired': True})
+        return
+
+    socket_sessions.bind(request.sid, payload['sub'], payload['exp'])
+    emit('reauth_ok', {'expiresAt': payload['exp']})
 
 @socketio.on('join_personal_room')
 def handle_join_personal_room(data):
     try:
-        user_id = data.get('userId')
+        # Only the authenticated user's own room, whatever userId the client sends
+        user_id = socket_user()
         if not user_id:
             return
             
@@ -1307,11 +1485,28 @@ def handle_join_personal_room(data):
     except Exception as e:
         print(f"Error joining personal room: {e}")
 
+@socketio.on('sync')
+def handle_sync(data=None):
+    """Send the events a reconnecting client missed since its last seq"""
+    user_id = socket_user()
+
+    if not user_id:
+        return
+
+    try:
+        since, limit = parse_sync_args(data or {})
+        emit('sync_result', sync_events(db, user_id, since, limit))
+    except ValueError as e:
+        emit('error', {'message': str(e)})
+    except Exception as e:
+        print(f"Error syncing events: {e}")
+        emit('error', {'message': 'Failed to sync events'})
+
 @socketio.on('send_message')
 def handle_send_message(data):
+    timer = send_timings.start()
     try:
-        token = data.get('token')
-        user_id = verify_token(token)
+        user_id = socket_user()
 
         if not user_id:
             return
@@ -1326,7 +1521,6 @@ def handle_send_message(data):
         # Get encryption data if available
         encrypted = data.get('encrypted', False)
         encrypted_data = data.get('encryptedData')
-        iv = data.get('iv')
 
         # Get urgency level if available
         urgency_level = data.get('urgencyLevel', 'normal')  # Default to normal if not specified
@@ -1335,15 +1529,19 @@ def handle_send_message(data):
               f"fileType={file_type}, fileName={file_name}, hasFileData={bool(file_data)}, fileUrl={file_url}, "
               f"encrypted={encrypted}, urgencyLevel={urgency_level}")
 
+        # A finished chunked upload stands for the file (see chunked_uploads.py)
+        if data.get('uploadId'):
+            upload = finished_upload(uploads_collection, data['uploadId'], user_id)
+            if not upload:
+                emit('error', {'message': 'Upload not found or not finished'})
+                return
+            file_url, file_type, file_name = upload["fileUrl"], upload["fileType"], upload["fileName"]
+
         if not receiver_id or (not message_text.strip() and not file_data and not file_url and not encrypted_data):
             print("Missing required data for message")
             return
 
-        # Determine message type
-        message_type = "text"
-
-        # Handle file upload if present
-        # Case 1: We have file_data (base64) to process
+        # Handle file upload if present: base64 file_data is saved under the conversation
         if file_data and file_type and file_name:
             print(f"Processing file data for {file_name} of type {file_type}")
             # Validate file size
@@ -1352,11 +1550,8 @@ def handle_send_message(data):
                 emit('error', {'message': error_message})
                 return
 
-            # Generate conversation ID for file storage
-            conversation_id = f"dm_{min(user_id, receiver_id)}_{max(user_id, receiver_id)}"
-
             # Save file to server
-            file_url = save_file(file_data, file_type, file_name, conversation_id)
+            file_url = save_file(file_data, file_type, file_name, dm_conversation_id(user_id, receiver_id))
 
             if not file_url:
                 emit('error', {'message': 'Failed to save file'})
@@ -1364,99 +1559,28 @@ def handle_send_message(data):
 
             print(f"File saved successfully, URL: {file_url}")
 
-            # Set message type based on file type
-            if file_type.startswith('image/'):
-                message_type = "image"
-            elif file_type.startswith('video/'):
-                message_type = "video"
-            else:
-                message_type = "file"
-        # Case 2: We already have a fileUrl from a previous upload
-        elif file_url and file_type and file_name:
-            print(f"Using pre-uploaded file: {file_url}")
-            # Set message type based on file type
-            if file_type.startswith('image/'):
-                message_type = "image"
-            elif file_type.startswith('video/'):
-                message_type = "video"
-            else:
-                message_type = "file"
-
-        # Get current timestamp
-        current_time = get_utc_now()
-
-        # Create message record
-        message = {
-            "senderId": ObjectId(user_id),
-            "receiverId": ObjectId(receiver_id),
-            "text": message_text,
-            "timestamp": current_time,
-            "fileUrl": file_url,
-            "fileType": file_type,
-            "fileName": file_name,
-            "messageType": message_type,
-            "encrypted": encrypted,
-            "urgencyLevel": urgency_level
-        }
-
-        # Add encryption data if message is encrypted
-        if encrypted and encrypted_data:
-            message["encryptedData"] = encrypted_data
-            message["iv"] = iv
-            # If the message is encrypted, we still store the original text for admin viewing
-            # but mark it as encrypted so clients know to decrypt it
-
-        # Save message to database
-        result = messages_collection.insert_one(message)
-        message_id = result.inserted_id
-
-        # Get sender info
-        user = users_collection.find_one({"_id": ObjectId(user_id)})
-
-        # Format message for sending
-        message_data = {
-            "id": str(message_id),
-            "sender": user_id,
-            "receiver": receiver_id,
-            "text": message_text,
-            "timestamp": message["timestamp"].isoformat(),
-            "fileUrl": file_url,
-            "fileType": file_type,
-            "fileName": file_name,
-            "messageType": message_type,
-            "senderName": user["name"] if user else "Unknown",
-            "encrypted": encrypted,
-            "urgencyLevel": urgency_level
-        }
-
-        # Add encryption data if message is encrypted
-        if encrypted and encrypted_data:
-            message_data["encryptedData"] = encrypted_data
-            message_data["iv"] = iv
+        message = direct_message_document(user_id, receiver_id, data, file_url, file_type, file_name, get_utc_now())
+        timer.stage("prepare")
 
-        # Update lastActivity for both sender and receiver contacts
-        # For sender's contact list
-        contacts_collection.update_one(
-            {"userId": ObjectId(user_id), "contactId": ObjectId(receiver_id)},
-            {"$set": {"lastActivity": current_time}}
-        )
+        # Save message to database: the only write the recipients wait for
+        messages_collection.insert_one(message)
+        timer.stage("insert")
 
-        # For receiver's contact list
-        contacts_collection.update_one(
-            {"userId": ObjectId(receiver_id), "contactId": ObjectId(user_id)},
-            {"$set": {"lastActivity": current_time}}
-        )
+        # Format message for sending (the sender's name was bound to the socket at connect)
+        message_data = direct_message_payload(message, socket_sessions.user_name(request.sid))
 
-        print(f"Sending message to sender (room {user_id}): {message_data}")
         # Send to sender's room
         emit('receive_message', message_data, room=user_id)
 
         # Send to receiver's room if online
-        if receiver_id in active_users:
-            print(f"Sending message to receiver (room {receiver_id}): {message_data}")
+        if socket_sessions.is_online(receiver_id):
             emit('receive_message', message_data, room=receiver_id)
-        else:
-            print(f"Receiver {receiver_id} is not online, message will be delivered when they connect")
+        timer.stage("emit")
+
+        # Derived data (summary, bucket, statistics, lastActivity, sync log) is written after delivery
+        record_direct_message(db, message, message_data, timer)
+
+        send_timings.finish(timer)
     except Exception as e:
         print(f"Error sending message: {e}")
         import traceback
@@ -1466,8 +1590,7 @@ def handle_send_message(data):
 @socketio.on('group_message')
 def handle_group_message(data):
     try:
-        token = data.get('token')
-        user_id = verify_token(token)
+        user_id = socket_user()
         if not user_id:
             return
 
@@ -1481,19 +1604,11 @@ def handle_group_message(data):
             return
 
         # Check if user is member of the group
-        group = groups_collection.find_one({
-            "_id": ObjectId(group_id),
-            "members": {"$elemMatch": {"userId": ObjectId(user_id)}}
-        })
-
-        if not group:
+        if not is_group_member(group_members_collection, group_id, user_id):
             return
 
-        # Determine message type
-        message_type = "text"
-        file_url = None
-
         # Handle file upload if present
+        file_url = None
         if file_data and file_type and file_name:
             # Validate file size
             is_valid, error_message = validate_file_size(file_data, file_type)
@@ -1508,43 +1623,18 @@ def handle_group_message(data):
                 emit('error', {'message': 'Failed to save file'})
                 return
 
-            # Set message type based on file type
-            if file_type.startswith('image/'):
-                message_type = "image"
-            elif file_type.startswith('video/'):
-                message_type = "video"
-            else:
-                message_type = "file"
-
-        # Get user info
-        user = users_collection.find_one({"_id": ObjectId(user_id)})
-        if not user:
-            return
-
-        # Generate a unique message ID
-        message_id = str(ObjectId())
-        timestamp = get_utc_now().isoformat()
-
-        # Create message document
-        message = {
-            'id': message_id,
-            'sender': user_id,
-            'senderName': user['name'],
-            'groupId': group_id,
-            'text': text,
-            'timestamp': timestamp,
-            'fileUrl': file_url,
-            'fileType': file_type,
-            'fileName': file_name,
-            'messageType': message_type
-        }
-
-        # Save message to database
+        # Same document, payload and derived writes as send_group_message
+        message = group_message_document(user_id, group_id, data, file_url, file_type, file_name, get_utc_now())
         db.group_messages.insert_one(message)
 
+        message_data = group_message_payload(message, socket_sessions.user_name(request.sid))
+
         # Emit to all users in the group, including sender
         # Use room=f"group_{group_id}" to ensure all users in the group receive the message exactly once
-        emit('receive_group_message', message, room=f"group_{group_id}")
+        emit('receive_group_message', message_data, room=f"group_{group_id}")
+
+        # Summary, bucket, statistics, lastActivity and sync log, after delivery
+        record_group_message(db, message, message_data)
 
     except Exception as e:
         print(f"Error handling group message: {str(e)}")
@@ -1553,8 +1643,7 @@ def handle_group_message(data):
 @socketio.on('join_group')
 def on_join_group(data):
     try:
-        token = data.get('token')
-        user = verify_token(token)
+        user = socket_user()
         if not user:
             return
 
@@ -1573,19 +1662,8 @@ def on_join_group(data):
         if not group:
             return
 
-        # Check if user is already a member
-        is_member = any(member.get('id') == user['id'] for member in (group.get('members') or []))
-        if not is_member:
-            # Only update members if user isn't already in the group
-            db.groups.update_one(
-                {'_id': ObjectId(group_id)},
-                {'$addToSet': {'members': {
-                    'id': user['id'],
-                    'name': user['name'],
-                    'isActive': True
-                }}}
-            )
-
+        # Only add the user if they aren't already in the group
+        if add_group_members(group_members_collection, group_id, [user['id']]):
             # Notify other members only if user wasn't already in the group
             emit('group_user_joined', {
                 'groupId': group_id,
@@ -1606,8 +1684,7 @@ def on_join_group(data):
 @socketio.on('leave_group')
 def on_leave_group(data):
     try:
-        token = data.get('token')
-        user = verify_token(token)
+        user = socket_user()
         if not user:
             return
 
@@ -1625,30 +1702,20 @@ def on_leave_group(data):
         if not group:
             return
 
-        # Check if user is actually a member
-        is_member = any(member.get('id') == user['id'] for member in (group.get('members') or []))
-        if is_member:
-            # Only update members if user is actually in the group
-            result = db.groups.update_one(
-                {'_id': ObjectId(group_id)},
-                {'$pull': {'members': {'id': user['id']}}}
-            )
-
-            if result.modified_count > 0:
-                # Notify other members only if user was actually removed
-                emit('group_user_left', {
-                    'groupId': group_id,
-                    'userId': user['id'],
-                    'userName': user['name']
-                }, room=group_id)
+        # Only notify other members if the user was actually in the group
+        if remove_group_member(group_members_collection, group_id, user['id']):
+            emit('group_user_left', {
+                'groupId': group_id,
+                'userId': user['id'],
+                'userName': user['name']
+            }, room=group_id)
 
     except Exception as e:
         print(f"Error leaving group: {str(e)}")
 
 @socketio.on('join_group')
 def handle_join_group(data):
-    token = data.get('token')
-    user_id = verify_token(token)
+    user_id = socket_user()
 
     if not user_id:
         return
@@ -1658,12 +1725,7 @@ def handle_join_group(data):
         return
 
     # Check if user is member of the group
-    group = groups_collection.find_one({
-        "_id": ObjectId(group_id),
-        "members": {"$elemMatch": {"userId": ObjectId(user_id)}}
-    })
-
-    if not group:
+    if not is_group_member(group_members_collection, group_id, user_id):
         return
 
     # Join group room
@@ -1674,8 +1736,7 @@ def handle_join_group(data):
 
 @socketio.on('leave_group')
 def handle_leave_group(data):
-    token = data.get('token')
-    user_id = verify_token(token)
+    user_id = socket_user()
 
     if not user_id:
         return
@@ -1688,7 +1749,7 @@ def handle_leave_group(data):
     leave_room(f"group_{group_id}")
 
     # Notify other members
-    user = users_collection.find_one({"_id": ObjectId(user_id)})
+    user = get_user_profile(users_collection, user_id)
     if user:
         emit('group_user_left', {
             "groupId": group_id,
@@ -1698,8 +1759,7 @@ def handle_leave_group(data):
 
 @socketio.on('edit_group_message')
 def handle_edit_group_message(data):
-    token = data.get('token')
-    user_id = verify_token(token)
+    user_id = socket_user()
 
     if not user_id:
         return
@@ -1723,8 +1783,10 @@ def handle_edit_group_message(data):
     # Update the message
     db.group_messages.update_one(
         {"_id": ObjectId(message_id)},
-        {"$set": {"text": new_text, "isEdited": True}}
+        {"$set": {"text": new_text, "searchTokens": tokenize(new_text), "isEdited": True}}
     )
+    record_edit(conversations_collection, group_conversation_id(group_id), ObjectId(message_id), new_text)
+    mark_edited(message_buckets_collection, group_conversation_id(group_id), ObjectId(message_id), new_text)
 
     # Notify all users in the group
     emit('message_edited', {
@@ -1735,8 +1797,7 @@ def handle_edit_group_message(data):
 
 @socketio.on('delete_group_message')
 def handle_delete_group_message(data):
-    token = data.get('token')
-    user_id = verify_token(token)
+    user_id = socket_user()
 
     if not user_id:
         return
@@ -1762,11 +1823,14 @@ def handle_delete_group_message(data):
         {"$set": {
             "isDeleted": True,
             "text": "This message was deleted",
+            "searchTokens": [],
             "fileUrl": None,
             "fileType": None,
             "fileName": None
         }}
     )
+    record_delete(conversations_collection, group_conversation_id(group_id), ObjectId(message_id))
+    mark_deleted(message_buckets_collection, group_conversation_id(group_id), ObjectId(message_id))
 
     # Notify all users in the group
     emit('message_deleted', {
@@ -1777,8 +1841,7 @@ def handle_delete_group_message(data):
 @socketio.on('send_group_message')
 def handle_send_group_message(data):
     try:
-        token = data.get('token')
-        user_id = verify_token(token)
+        user_id = socket_user()
 
         if not user_id:
             return
@@ -1797,25 +1860,24 @@ def handle_send_group_message(data):
               f"fileType={file_type}, fileName={file_name}, hasFileData={bool(file_data)}, fileUrl={file_url}, "
               f"urgencyLevel={urgency_level}")
 
+        # A finished chunked upload stands for the file (see chunked_uploads.py)
+        if data.get('uploadId'):
+            upload = finished_upload(uploads_collection, data['uploadId'], user_id)
+            if not upload:
+                emit('error', {'message': 'Upload not found or not finished'})
+                return
+            file_url, file_type, file_name = upload["fileUrl"], upload["fileType"], upload["fileName"]
+
         if not group_id or (not message_text.strip() and not file_data and not file_url):
             print("Missing required data for group message")
             return
 
         # Check if user is member of the group
-        group = groups_collection.find_one({
-            "_id": ObjectId(group_id),
-            "members": {"$elemMatch": {"userId": ObjectId(user_id)}}
-        })
-
-        if not group:
+        if not is_group_member(group_members_collection, group_id, user_id):
             print(f"User {user_id} is not a member of group {group_id}")
             return
 
-        # Determine message type
-        message_type = "text"
-
-        # Handle file upload if present
-        # Case 1: We have file_data (base64) to process
+        # Handle file upload if present: base64 file_data is saved under the group
         if file_data and file_type and file_name:
             print(f"Processing file data for group message: {file_name} of type {file_type}")
             # Validate file size
@@ -1833,69 +1895,19 @@ def handle_send_group_message(data):
 
             print(f"Group file saved successfully, URL: {file_url}")
 
-            # Set message type based on file type
-            if file_type.startswith('image/'):
-                message_type = "image"
-            elif file_type.startswith('video/'):
-                message_type = "video"
-            else:
-                message_type = "file"
-        # Case 2: We already have a fileUrl from a previous upload
-        elif file_url and file_type and file_name:
-            print(f"Using pre-uploaded file for group message: {file_url}")
-            # Set message type based on file type
-            if file_type.startswith('image/'):
-                message_type = "image"
-            elif file_type.startswith('video/'):
-                message_type = "video"
-            else:
-                message_type = "file"
-
-        # Create message record
-        message = {
-            "groupId": ObjectId(group_id),
-            "senderId": ObjectId(user_id),
-            "text": message_text,
-            "timestamp": get_utc_now(),
-            "fileUrl": file_url,
-            "fileType": file_type,
-            "fileName": file_name,
-            "messageType": message_type,
-            "urgencyLevel": urgency_level
-        }
-
-        # Save message to database (in a group_messages collection)
-        result = db.group_messages.insert_one(message)
-        message_id = result.inserted_id
+        message = group_message_document(user_id, group_id, data, file_url, file_type, file_name, get_utc_now())
 
-        # Update group's lastActivity for proper sorting
-        current_time = get_utc_now()
-        groups_collection.update_one(
-            {"_id": ObjectId(group_id)},
-            {"$set": {"lastActivity": current_time}}
-        )
+        # Save message to database (in a group_messages collection): the only write the members wait for
+        db.group_messages.insert_one(message)
 
-        # Get sender info
-        user = users_collection.find_one({"_id": ObjectId(user_id)})
+        # Format message for sending (the sender's name was bound to the socket at connect)
+        message_data = group_message_payload(message, socket_sessions.user_name(request.sid))
 
-        # Format message for sending
-        message_data = {
-            "id": str(message_id),
-            "groupId": group_id,
-            "sender": user_id,
-            "senderName": user["name"] if user else "Unknown",
-            "text": message_text,
-            "timestamp": message["timestamp"].isoformat(),
-            "fileUrl": file_url,
-            "fileType": file_type,
-            "fileName": file_name,
-            "messageType": message_type,
-            "urgencyLevel": urgency_level
-        }
-
-        print(f"Sending group message to room group_{group_id}: {message_data}")
         # Send to the group room
         emit('receive_group_message', message_data, room=f"group_{group_id}")
+
+        # Derived data (summary, bucket, statistics, lastActivity, sync log) is written after delivery
+        record_group_message(db, message, message_data)
     except Exception as e:
         print(f"Error sending group message: {e}")
         import traceback
@@ -1911,44 +1923,26 @@ def get_stats():
         return jsonify({"error": "Unauthorized"}), 401
 
     # Check if user is admin
-    user = users_collection.find_one({"_id": ObjectId(user_id)})
+    user = get_user_roles(users_collection, user_id)
     if not user or not user.get("isAdmin", False):
         return jsonify({"error": "Forbidden"}), 403
 
-    # Get statistics
-    total_users = users_collection.count_documents({})
-    active_users_count = len(active_users)
-    total_private_messages = messages_collection.count_documents({})
-    total_group_messages = group_messages_collection.count_documents({})
+    try:
+        days = int(request.args.get('days', DEFAULT_STATS_DAYS))
+    except ValueError:
+        return jsonify({"error": "'days' must be an integer"}), 400
+    days = max(1, min(days, MAX_STATS_DAYS))
+
+    # Get statistics (collection totals come from metadata, not a scan)
+    total_users = users_collection.estimated_document_count()
+    active_users_count = socket_sessions.online_count()
+    total_private_messages = messages_collection.estimated_document_count()
+    total_group_messages = group_messages_collection.estimated_document_count()
     total_messages = total_private_messages + total_group_messages
 
-    # Get messages per day for last 7 days
-    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-    daily_messages = []
-
-    for i in range(7):
-        day = today - timedelta(days=i)
-        next_day = day + timedelta(days=1)
-
-        # Compter les messages privés
-        private_count = messages_collection.count_documents({
-            "timestamp": {"$gte": day, "$lt": next_day}
-        })
-
-        # Compter les messages de groupe
-        group_count = group_messages_collection.count_documents({
-            "timestamp": {"$gte": day, "$lt": next_day}
-        })
-
-        # Combiner les deux types de messages
-        total_count = private_count + group_count
-
-        daily_messages.append({
-            "date": day.strftime("%Y-%m-%d"),
-            "count": total_count,
-            "privateCount": private_count,
-            "groupCount": group_count
-        })
+    # Messages per day: past days from the daily_stats rollup, today counted live
+    daily_messages = get_daily_message_counts(db, days)
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
 
     # Get number of new users in last 7 days
     new_users = users_collection.count_documents({
@@ -1962,7 +1956,13 @@ def get_stats():
         "privateMessages": total_private_messages,
         "groupMessages": total_group_messages,
         "dailyMessages": daily_messages,
-        "newUsers": new_users
+        "newUsers": new_users,
+        "profileCache": get_profile_cache_stats(),
+        "socketSessions": socket_sessions.stats(),
+        "presenceBuffer": presence_buffer.stats(),
+        "presenceFanout": presence_fanout.stats(),
+        "activityTracker": activity_tracker.stats(),
+        "sendTimings": send_timings.stats()
     }
 
     return jsonify(stats), 200
@@ -1975,48 +1975,59 @@ def get_groups():
     if not user_id:
         return jsonify({"error": "Unauthorized"}), 401
 
+    # ?members=summary returns memberCount and only the first memberLimit members
+    summary_only = request.args.get('members') == 'summary'
+    try:
+        member_limit = int(request.args.get('memberLimit', GROUP_MEMBER_SUMMARY_SIZE))
+    except ValueError:
+        return jsonify({"error": "'memberLimit' must be an integer"}), 400
+    member_limit = max(0, min(member_limit, MAX_GROUP_MEMBER_SUMMARY_SIZE))
+
     # Get groups where user is a member
-    user_groups = groups_collection.find({
-        "members": {"$elemMatch": {"userId": ObjectId(user_id)}}
-    })
+    user_groups = list(groups_collection.find({
+        "_id": {"$in": member_group_ids(group_members_collection, user_id)}
+    }))
+
+    # Last message and unread counters for every group in one indexed read
+    summaries = {
+        summary["_id"]: summary
+        for summary in conversations_collection.find({
+            "_id": {"$in": [group_conversation_id(group["_id"]) for group in user_groups]}
+        })
+    }
+
+    # Hydrate the members of every group with one roster query and one batched user lookup
+    rosters = group_rosters(
+        group_members_collection,
+        [group["_id"] for group in user_groups],
+        member_limit if summary_only else None
+    )
+    profiles = get_user_profiles(
+        users_collection,
+        [member["userId"] for _, roster in rosters.values() for member in roster]
+    )
 
     groups_list = []
     for group in user_groups:
-        # Get the last message for the group
-        last_message = db.group_messages.find_one(
-            {"groupId": group["_id"]},
-            sort=[("timestamp", -1)]
-        )
+        summary = summaries.get(group_conversation_id(group["_id"]))
+        last_message, last_message_time = visible_last_message(summary, user_id)
 
-        # Get full member details
+        # Get member details
+        member_count, roster = rosters[group["_id"]]
         members = []
-        user_last_read = None
-        for member in group["members"]:
-            member_user = users_collection.find_one({"_id": member["userId"]})
+        for member in roster:
+            member_id = str(member["userId"])
+            member_user = profiles.get(member_id)
             if member_user:
                 members.append({
-                    "id": str(member_user["_id"]),
+                    "id": member_id,
                     "name": member_user["name"],
                     "role": member["role"],
-                    "isActive": str(member_user["_id"]) in active_users,
+                    "isActive": socket_sessions.is_online(member_id),
                 })
 
-                # Store the user's last read timestamp
-                if str(member["userId"]) == user_id and "lastRead" in member:
-                    user_last_read = member["lastRead"]
-
-        # Calculate unread count for this group
-        unread_count = 0
-        if user_last_read:
-            # Count messages that were sent after the user's last read timestamp
-            unread_count = db.group_messages.count_documents({
-                "groupId": group["_id"],
-                "senderId": {"$ne": ObjectId(user_id)},  # Don't count user's own messages
-                "timestamp": {"$gt": user_last_read}
-            })
-
         # Use last message time for sorting, fallback to group creation time
-        sort_timestamp = last_message["timestamp"] if last_message else group.get("createdAt", get_utc_now())
+        sort_timestamp = last_message_time or group.get("createdAt", get_utc_now())
 
         groups_list.append({
             "id": str(group["_id"]),
@@ -2026,8 +2037,8 @@ def get_groups():
             "members": members,
             "lastMessage": last_message["text"] if last_message else "",
             "lastMessageTime": sort_timestamp.isoformat(),
-            "unreadCount": unread_count,
-            "memberCount": len(members)
+            "unreadCount": unread_count(summary, user_id),
+            "memberCount": member_count if summary_only else len(members)
         })
 
     # Sort groups by most recent message timestamp (most recent first)
@@ -2050,7 +2061,7 @@ def create_group():
 
     # Check if user is admin for department group creation
     if is_department_group:
-        user = users_collection.find_one({"_id": ObjectId(user_id)})
+        user = get_user_roles(users_collection, user_id)
         if not user or not user.get("isAdmin", False):
             return jsonify({"error": "Only admins can create department groups"}), 403
 
@@ -2076,28 +2087,13 @@ def create_group():
     if not name:
         return jsonify({"error": "Group name is required"}), 400
 
-    # Create member objects
-    members = []
-    for mid in member_ids:
-        try:
-            now = get_utc_now()
-            member = {
-                "userId": ObjectId(mid),
-                "role": "admin" if mid == user_id else "member",
-                "joinedAt": now,
-                "lastRead": now
-            }
-            members.append(member)
-        except:
-            pass
-
     # Create group
+    now = get_utc_now()
     group = {
         "name": name,
         "description": description,
         "createdBy": ObjectId(user_id),
-        "createdAt": get_utc_now(),
-        "members": members,
+        "createdAt": now,
         "isDepartmentGroup": is_department_group
     }
 
@@ -2107,6 +2103,21 @@ def create_group():
 
     result = groups_collection.insert_one(group)
 
+    # Add the members, the creator being the group admin
+    members = add_group_members(
+        group_members_collection,
+        result.inserted_id,
+        member_ids,
+        roles={user_id: "admin"},
+        joined_at=now
+    )
+    presence_fanout.invalidate(members)
+    record_event(db, members, GROUP_JOINED, {
+        "groupId": str(result.inserted_id),
+        "groupName": name,
+        "invitedBy": user_id
+    })
+
     # No automatic system message for department groups
 
     return jsonify({
@@ -2127,52 +2138,47 @@ def get_group_messages(group_id):
         return jsonify({"error": "Unauthorized"}), 401
 
     # Check if user is member of the group
-    group = groups_collection.find_one({
-        "_id": ObjectId(group_id),
-        "members": {"$elemMatch": {"userId": ObjectId(user_id)}}
-    })
-
-    if not group:
+    if not is_group_member(group_members_collection, group_id, user_id):
         return jsonify({"error": "Forbidden"}), 403
 
-    # Get messages for the group, excluding those deleted by the current user
-    messages = db.group_messages.find({
-        "$and": [
-            {"groupId": ObjectId(group_id)},
-            {
-                "$or": [
-                    {"deletedBy": {"$exists": False}},
-                    {"deletedBy": {"$not": {"$elemMatch": {"$eq": ObjectId(user_id)}}}}
-                ]
-            }
-        ]
-    }).sort("timestamp", 1)
+    # History is paginated: latest page by default, older/newer pages via cursors
+    try:
+        direction, cursor, limit = parse_page_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    touch_last_read(group_members_collection, group_id, user_id)
+
+    # Get messages for the group, excluding those cleared or hidden by the current user
+    conversation_id = group_conversation_id(group_id)
+    if BUCKETED_STORAGE:
+        cleared_at, hidden = get_visibility(conversations_collection, conversation_id, user_id)
+        messages, has_more = fetch_bucketed_page(
+            message_buckets_collection, conversation_id, direction, cursor, limit, cleared_at, hidden
+        )
+    else:
+        messages, has_more = fetch_page(db.group_messages, {
+            "groupId": ObjectId(group_id),
+            **get_visibility_filter(conversations_collection, conversation_id, user_id)
+        }, direction, cursor, limit)
 
-    # Update last read timestamp
-    groups_collection.update_one(
-        {
-            "_id": ObjectId(group_id),
-            "members.userId": ObjectId(user_id)
-        },
-        {"$set": {"members.$.lastRead": get_utc_now()}}
-    )
+    # Viewing the group marks it as read
+    mark_read(conversations_collection, group_conversation_id(group_id), user_id)
+
+    # Resolve every sender of the page at once
+    sender_names = get_user_names(users_collection, [msg["senderId"] for msg in messages])
 
     # Format messages for the frontend
     messages_list = []
-    sender_cache = {}
 
     for msg in messages:
         sender_id = str(msg["senderId"])
 
-        if sender_id not in sender_cache:
-            sender = users_collection.find_one({"_id": ObjectId(sender_id)})
-            sender_cache[sender_id] = sender["name"] if sender else "Unknown"
-
         # Create message object with all fields
         message_data = {
             "id": str(msg["_id"]),
             "sender": sender_id,
-            "senderName": sender_cache[sender_id],
+            "senderName": sender_names[sender_id],
             "text": msg["text"],
             "timestamp": msg["timestamp"].isoformat(),
             "messageType": msg.get("messageType", "text"),
@@ -2189,7 +2195,7 @@ def get_group_messages(group_id):
 
         messages_list.append(message_data)
 
-    return jsonify(messages_list), 200
+    return jsonify(messages_list), 200, pagination_headers(messages, has_more)
 
 @app.route('/api/groups/<group_id>/messages/search', methods=['GET'])
 def search_group_messages(group_id):
@@ -2200,48 +2206,39 @@ def search_group_messages(group_id):
         return jsonify({"error": "Unauthorized"}), 401
 
     # Check if user is member of the group
-    group = groups_collection.find_one({
-        "_id": ObjectId(group_id),
-        "members": {"$elemMatch": {"userId": ObjectId(user_id)}}
-    })
-
-    if not group:
+    if not is_group_member(group_members_collection, group_id, user_id):
         return jsonify({"error": "Forbidden"}), 403
 
-    query = request.args.get('query', '')
-    if not query:
-        return jsonify({"error": "Search query is required"}), 400
-
-    # Search messages in the group that contain the query, excluding those deleted by the current user
-    messages = group_messages_collection.find({
-        "$and": [
-            {"groupId": ObjectId(group_id)},
-            {"text": {"$regex": query, "$options": "i"}},  # Case-insensitive search
-            {
-                "$or": [
-                    {"deletedBy": {"$exists": False}},
-                    {"deletedBy": {"$not": {"$elemMatch": {"$eq": ObjectId(user_id)}}}}
-                ]
-            }
-        ]
-    }).sort("timestamp", 1)
+    try:
+        terms, cursor, limit = parse_search_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Ranked token search in the group, excluding messages the user cleared or hid
+    messages, next_cursor = search(group_messages_collection, {
+        "groupId": ObjectId(group_id),
+        **get_visibility_filter(conversations_collection, group_conversation_id(group_id), user_id)
+    }, terms, cursor, limit)
+
+    # Resolve every sender of the result set at once
+    sender_names = get_user_names(users_collection, [msg["senderId"] for msg in messages])
 
     # Format messages for the frontend
     results = []
     for msg in messages:
         sender_id = str(msg["senderId"])
-        sender = users_collection.find_one({"_id": msg["senderId"]})
-        sender_name = sender["name"] if sender else "Unknown"
 
         # Create message object with all fields
         message_data = {
             "id": str(msg["_id"]),
             "sender": sender_id,
-            "senderName": sender_name,
+            "senderName": sender_names[sender_id],
             "text": msg["text"],
             "timestamp": msg["timestamp"].isoformat(),
             "messageType": msg.get("messageType", "text"),
-            "isDeleted": msg.get("isDeleted", False)
+            "isDeleted": msg.get("isDeleted", False),
+            "score": msg["score"],
+            "highlights": highlight_offsets(msg["text"], terms)
         }
 
         # Add file information if present
@@ -2254,7 +2251,29 @@ def search_group_messages(group_id):
 
         results.append(message_data)
 
-    return jsonify({"results": results, "count": len(results)}), 200
+    return jsonify({"results": results, "count": len(results), "nextCursor": next_cursor}), 200
+
+@app.route('/api/groups/<group_id>/messages/<message_id>/hide', methods=['POST'])
+def hide_group_message(group_id, message_id):
+    token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    user_id = verify_token(token)
+
+    if not user_id:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    # Check if user is member of the group
+    if not is_group_member(group_members_collection, group_id, user_id):
+        return jsonify({"error": "Forbidden"}), 403
+
+    if not ObjectId.is_valid(message_id):
+        return jsonify({"error": "Invalid message id"}), 400
+
+    if not group_messages_collection.find_one({"_id": ObjectId(message_id), "groupId": ObjectId(group_id)}, {"_id": 1}):
+        return jsonify({"error": "Message not found"}), 404
+
+    # Hide the message from this user's history only
+    hide_message(conversations_collection, group_conversation_id(group_id), user_id, ObjectId(message_id))
+    return jsonify({"message": "Message hidden"}), 200
 
 @app.route('/api/groups/<group_id>/messages', methods=['DELETE'])
 def delete_group_chat(group_id):
@@ -2265,12 +2284,7 @@ def delete_group_chat(group_id):
         return jsonify({"error": "Unauthorized"}), 401
 
     # Check if user is member of the group
-    group = groups_collection.find_one({
-        "_id": ObjectId(group_id),
-        "members": {"$elemMatch": {"userId": ObjectId(user_id)}}
-    })
-
-    if not group:
+    if not is_group_member(group_members_collection, group_id, user_id):
         return jsonify({"error": "Forbidden"}), 403
 
     # Mark all messages in the group as deleted for this user only
@@ -2289,23 +2303,24 @@ def leave_group(group_id):
 
     try:
         # Remove user from group members
-        result = groups_collection.update_one(
-            {"_id": ObjectId(group_id)},
-            {"$pull": {"members": {"userId": ObjectId(user_id)}}}
-        )
-
-        if result.modified_count == 0:
+        if not remove_group_member(group_members_collection, group_id, user_id):
             return jsonify({"error": "Group not found or user is not a member"}), 404
 
         # Get user info for notification
-        user = users_collection.find_one({"_id": ObjectId(user_id)})
+        user = get_user_profile(users_collection, user_id)
 
-        # Emit socket event to notify other members
-        socketio.emit('group_user_left', {
+        remaining_ids = group_member_ids(group_members_collection, group_id)
+        presence_fanout.invalidate(remaining_ids + [user_id])
+
+        left_data = {
             "groupId": group_id,
             "userId": str(user_id),
             "userName": user["name"] if user else "Unknown"
-        }, room=f"group_{group_id}")
+        }
+        record_event(db, remaining_ids + [user_id], GROUP_LEFT, left_data)
+
+        # Emit socket event to notify other members
+        socketio.emit('group_user_left', left_data, room=f"group_{group_id}")
 
         return jsonify({"message": "Successfully left the group"}), 200
 
@@ -2333,18 +2348,26 @@ def delete_group(group_id):
 
         # Delete all messages in the group (passing no user_id to actually delete them)
         delete_group_messages(group_id)
+        conversations_collection.delete_one({"_id": group_conversation_id(group_id)})
+        drop_conversation(message_buckets_collection, group_conversation_id(group_id))
 
-        # Delete the group itself
+        # Delete the group itself and its memberships
+        member_ids = group_member_ids(group_members_collection, group_id)
         result = groups_collection.delete_one({"_id": ObjectId(group_id)})
+        remove_group_members(group_members_collection, group_id)
 
         if result.deleted_count == 0:
             return jsonify({"error": "Group not found"}), 404
 
-        # Notify all members via socket
-        socketio.emit("group_deleted", {
+        deleted_data = {
             "groupId": group_id,
             "groupName": group["name"]
-        }, room=f"group_{group_id}")
+        }
+        presence_fanout.invalidate(member_ids)
+        record_event(db, member_ids, GROUP_DELETED, deleted_data)
+
+        # Notify all members via socket
+        socketio.emit("group_deleted", deleted_data, room=f"group_{group_id}")
 
         return jsonify({"message": "Group deleted successfully"}), 200
 
@@ -2361,12 +2384,7 @@ def rename_group(group_id):
         return jsonify({"error": "Unauthorized"}), 401
 
     # Check if user is member of the group
-    group = groups_collection.find_one({
-        "_id": ObjectId(group_id),
-        "members": {"$elemMatch": {"userId": ObjectId(user_id)}}
-    })
-
-    if not group:
+    if not is_group_member(group_members_collection, group_id, user_id):
         return jsonify({"error": "Forbidden"}), 403
 
     data = request.get_json()
@@ -2392,10 +2410,7 @@ def invite_to_group(group_id):
         return jsonify({"error": "Unauthorized"}), 401
 
     # Check if user is member of the group
-    group = groups_collection.find_one({
-        "_id": ObjectId(group_id),
-        "members": {"$elemMatch": {"userId": ObjectId(user_id)}}
-    })
+    group = find_member_group(groups_collection, group_members_collection, group_id, user_id)
 
     if not group:
         return jsonify({"error": "Forbidden"}), 403
@@ -2407,36 +2422,29 @@ def invite_to_group(group_id):
         return jsonify({"error": "No members specified"}), 400
 
     try:
-        # Add new members
-        new_members = []
-        for mid in member_ids:
-            now = get_utc_now()
-            member = {
-                "userId": ObjectId(mid),
-                "role": "member",
-                "joinedAt": now,
-                "lastRead": now
-            }
-            new_members.append(member)
-
-        # Update group with new members
-        result = groups_collection.update_one(
-            {"_id": ObjectId(group_id)},
-            {"$push": {"members": {"$each": new_members}}}
-        )
-
-        if result.modified_count == 0:
-            return jsonify({"error": "Failed to add members to group"}), 500
+        # Add new members (users already in the group are left as they are)
+        new_member_ids = add_group_members(group_members_collection, group_id, member_ids)
+
+        # New members start with the existing history already read
+        mark_read(conversations_collection, group_conversation_id(group_id), new_member_ids)
+        if new_member_ids:
+            presence_fanout.invalidate(group_member_ids(group_members_collection, group_id))
+        record_event(db, new_member_ids, GROUP_JOINED, {
+            "groupId": group_id,
+            "groupName": group["name"],
+            "invitedBy": user_id
+        })
 
         # Get member details for response
         added_members = []
-        for mid in member_ids:
-            member_user = users_collection.find_one({"_id": ObjectId(mid)})
+        member_profiles = get_user_profiles(users_collection, new_member_ids)
+        for mid in new_member_ids:
+            member_user = member_profiles.get(str(mid))
             if member_user:
                 added_members.append({
                     "id": str(member_user["_id"]),
                     "name": member_user["name"],
-                    "isActive": str(member_user["_id"]) in active_users
+                    "isActive": socket_sessions.is_online(member_user["_id"])
                 })
 
                 # Emit socket event to notify the new member
@@ -2477,39 +2485,26 @@ def invite_group_members(group_id):
             return jsonify({"error": "Group not found"}), 404
 
         # Check if user is in the group
-        if ObjectId(user_id) not in [member["id"] for member in group.get("members", [])]:
+        if not is_group_member(group_members_collection, group_id, user_id):
             return jsonify({"error": "You must be a member of the group to invite others"}), 403
 
-        # Convert member IDs to ObjectIds and check if they exist
-        member_ids = []
-        for member_id in members_to_invite:
-            if users_collection.find_one({"_id": ObjectId(member_id)}):
-                member_ids.append(ObjectId(member_id))
+        # Keep only users that exist
+        profiles = get_user_profiles(users_collection, members_to_invite)
+        member_ids = [member_id for member_id in members_to_invite if profiles.get(str(member_id))]
 
         if not member_ids:
             return jsonify({"error": "No valid members to invite"}), 400
 
         # Add new members to the group
-        current_members = group.get("members", [])
-        new_members = []
-        for member_id in member_ids:
-            if not any(m["id"] == member_id for m in current_members):
-                member = users_collection.find_one({"_id": member_id})
-                new_members.append({
-                    "id": member_id,
-                    "name": member["name"],
-                    "isActive": str(member_id) in active_users
-                })
+        new_members = [{
+            "id": member_id,
+            "name": profiles[member_id]["name"],
+            "isActive": socket_sessions.is_online(member_id)
+        } for member_id in add_group_members(group_members_collection, group_id, member_ids)]
 
         if not new_members:
             return jsonify({"error": "All specified users are already members"}), 400
 
-        # Update group with new members
-        groups_collection.update_one(
-            {"_id": ObjectId(group_id)},
-            {"$push": {"members": {"$each": new_members}}}
-        )
-
         # Emit socket event for each new member
         for member in new_members:
             socketio.emit("group_user_joined", {
@@ -2536,10 +2531,40 @@ def invite_group_members(group_id):
         print(f"Error inviting members to group: {e}")
         return jsonify({"error": "Failed to invite members"}), 500
 
+def edit_own_message(user_id, message, new_text):
+    """Apply an edit of the sender's message, notify its rooms, then write the derived data"""
+    collection = db.group_messages if message.get("groupId") else messages_collection
+    collection.update_one({"_id": message["_id"]}, edit_update(new_text))
+
+    # Group members see who edited the message
+    sender_name = get_user_name(users_collection, user_id) if message.get("groupId") else None
+    edited_message = edit_payload(message, new_text, sender_name)
+
+    # Notify the group, or both sender and receiver (even if not active - they'll see it when they connect)
+    for room in payload_rooms(message):
+        emit('message_edited', edited_message, room=room)
+
+    record_message_edit(db, message, new_text, edited_message)
+
+def delete_own_message(user_id, message):
+    """Delete the sender's message for everyone, notify its rooms, then write the derived data"""
+    collection = db.group_messages if message.get("groupId") else messages_collection
+
+    # Mark the message as globally deleted instead of just adding to deletedBy
+    collection.update_one({"_id": message["_id"]}, delete_update())
+
+    sender_name = get_user_name(users_collection, user_id) if message.get("groupId") else None
+    deleted_message = delete_payload(message, sender_name)
+
+    # Notify all users in the group, or both sender and receiver
+    for room in payload_rooms(message):
+        emit('message_deleted', deleted_message, room=room)
+
+    record_message_delete(db, message, deleted_message)
+
 @socketio.on('edit_message')
 def handle_edit_message(data):
-    token = data.get('token')
-    user_id = verify_token(token)
+    user_id = socket_user()
 
     if not user_id:
         return
@@ -2551,72 +2576,16 @@ def handle_edit_message(data):
         return
 
     try:
-        # Find the message to edit
+        # Find the message to edit (a direct message, or else a group message)
         message = messages_collection.find_one({"_id": ObjectId(message_id)})
-
         if not message:
-            # Check if it's a group message
             message = db.group_messages.find_one({"_id": ObjectId(message_id)})
-            if not message:
-                return
-
-            # Verify sender is the same as the editor
-            if str(message["senderId"]) != user_id:
-                return
-
-            # Update the message text
-            db.group_messages.update_one(
-                {"_id": ObjectId(message_id)},
-                {"$set": {"text": new_text, "isEdited": True}}
-            )
-
-            # Get group ID
-            group_id = str(message["groupId"])
-
-            # Get sender name for notification
-            sender = users_collection.find_one({"_id": ObjectId(user_id)})
-            sender_name = sender["name"] if sender else "Unknown"
 
-            # Notify all users in the group
-            emit('message_edited', {
-                "groupId": group_id,
-                "messageId": message_id,
-                "newText": new_text,
-                "isEdited": True,
-                "senderName": sender_name,
-                "sender": user_id
-            }, room=f"group_{group_id}")
-
-        else:
-            # Verify sender is the same as the editor
-            if str(message["senderId"]) != user_id:
-                return
-
-            # Update the message text
-            messages_collection.update_one(
-                {"_id": ObjectId(message_id)},
-                {"$set": {"text": new_text, "isEdited": True}}
-            )
-
-            # Get sender and receiver IDs
-            sender_id = str(message["senderId"])
-            receiver_id = str(message["receiverId"])
-
-            # Prepare edited message data
-            edited_message = {
-                "id": message_id,
-                "sender": sender_id,
-                "receiver": receiver_id,
-                "text": new_text,
-                "isEdited": True
-            }
-
-            # Notify sender
-            emit('message_edited', edited_message, room=sender_id)
-
-            # Notify receiver (even if not active - they'll see it when they connect)
-            emit('message_edited', edited_message, room=receiver_id)
+        # Verify sender is the same as the editor
+        if not message or str(message["senderId"]) != user_id:
+            return
 
+        edit_own_message(user_id, message, new_text)
     except Exception as e:
         print(f"Error editing message: {e}")
         emit('error', {'message': 'Failed to edit message'})
@@ -2624,8 +2593,7 @@ def handle_edit_message(data):
 @socketio.on('edit_group_message')
 def handle_edit_group_message(data):
     try:
-        token = data.get('token')
-        user_id = verify_token(token)
+        user_id = socket_user()
 
         if not user_id:
             return
@@ -2639,40 +2607,19 @@ def handle_edit_group_message(data):
 
         # Find the message to edit
         message = db.group_messages.find_one({"_id": ObjectId(message_id)})
-        if not message:
-            return
 
         # Verify sender is the same as the editor
-        if str(message["senderId"]) != user_id:
+        if not message or str(message["senderId"]) != user_id:
             return
 
-        # Update the message text
-        db.group_messages.update_one(
-            {"_id": ObjectId(message_id)},
-            {"$set": {"text": new_text, "isEdited": True}}
-        )
-
-        # Get sender name for notification
-        sender = users_collection.find_one({"_id": ObjectId(user_id)})
-        sender_name = sender["name"] if sender else "Unknown"
-
-        # Notify all users in the group
-        emit('message_edited', {
-            "groupId": group_id,
-            "messageId": message_id,
-            "newText": new_text,
-            "isEdited": True,
-            "senderName": sender_name,
-            "sender": user_id
-        }, room=f"group_{group_id}")
+        edit_own_message(user_id, message, new_text)
     except Exception as e:
         print(f"Error editing group message: {e}")
         emit('error', {'message': 'Failed to edit message'})
 
 @socketio.on('delete_message')
 def handle_delete_message(data):
-    token = data.get('token')
-    user_id = verify_token(token)
+    user_id = socket_user()
 
     if not user_id:
         return
@@ -2683,78 +2630,16 @@ def handle_delete_message(data):
         return
 
     try:
-        # Find the message to delete
+        # Find the message to delete (a direct message, or else a group message)
         message = messages_collection.find_one({"_id": ObjectId(message_id)})
-
         if not message:
-            # Check if it's a group message
             message = db.group_messages.find_one({"_id": ObjectId(message_id)})
-            if not message:
-                return
-
-            # Verify sender is the same as the deleter
-            if str(message["senderId"]) != user_id:
-                return
-
-            # Mark the message as globally deleted instead of just adding to deletedBy
-            db.group_messages.update_one(
-                {"_id": ObjectId(message_id)},
-                {"$set": {
-                    "isDeleted": True,
-                    "text": "This message was deleted",
-                    "fileUrl": None,
-                    "fileType": None,
-                    "fileName": None
-                }}
-            )
-
-            # Get group ID
-            group_id = str(message["groupId"])
-
-            # Get sender name for notification
-            sender = users_collection.find_one({"_id": ObjectId(user_id)})
-            sender_name = sender["name"] if sender else "Unknown"
-
-            # Notify all users in the group
-            emit('message_deleted', {
-                "groupId": group_id,
-                "messageId": message_id,
-                "senderName": sender_name,
-                "sender": user_id
-            }, room=f"group_{group_id}")  # Send to all users in the group
-
-        else:
-            # Verify sender is the same as the deleter
-            if str(message["senderId"]) != user_id:
-                return
-
-            # Mark the message as globally deleted instead of just adding to deletedBy
-            messages_collection.update_one(
-                {"_id": ObjectId(message_id)},
-                {"$set": {
-                    "isDeleted": True,
-                    "text": "This message was deleted",
-                    "fileUrl": None,
-                    "fileType": None,
-                    "fileName": None
-                }}
-            )
 
-            # Get sender and receiver IDs
-            sender_id = str(message["senderId"])
-            receiver_id = str(message["receiverId"])
-
-            # Prepare deleted message data
-            deleted_message = {
-                "id": message_id,
-                "sender": sender_id,
-                "receiver": receiver_id,
-                "isDeleted": True
-            }
+        # Verify sender is the same as the deleter
+        if not message or str(message["senderId"]) != user_id:
+            return
 
-            # Notify both sender and receiver
-            emit('message_deleted', deleted_message, room=sender_id)
-            emit('message_deleted', deleted_message, room=receiver_id)
+        delete_own_message(user_id, message)
     except Exception as e:
         print(f"Error deleting message: {e}")
         emit('error', {'message': 'Failed to delete message'})
@@ -2762,8 +2647,7 @@ def handle_delete_message(data):
 @socketio.on('delete_group_message')
 def handle_delete_group_message(data):
     try:
-        token = data.get('token')
-        user_id = verify_token(token)
+        user_id = socket_user()
 
         if not user_id:
             return
@@ -2776,42 +2660,22 @@ def handle_delete_group_message(data):
 
         # Find the message to delete
         message = db.group_messages.find_one({"_id": ObjectId(message_id)})
-        if not message:
-            return
 
         # Verify sender is the same as the deleter
-        if str(message["senderId"]) != user_id:
+        if not message or str(message["senderId"]) != user_id:
             return
 
-        # Mark the message as globally deleted instead of just adding to deletedBy
-        db.group_messages.update_one(
-            {"_id": ObjectId(message_id)},
-            {"$set": {
-                "isDeleted": True,
-                "text": "This message was deleted",
-                "fileUrl": None,
-                "fileType": None,
-                "fileName": None
-            }}
-        )
-
-        # Get sender name for notification
-        sender = users_collection.find_one({"_id": ObjectId(user_id)})
-        sender_name = sender["name"] if sender else "Unknown"
-
-        # Notify all users in the group
-        emit('message_deleted', {
-            "groupId": group_id,
-            "messageId": message_id,
-            "senderName": sender_name,
-            "sender": user_id,
-            "isDeleted": True
-        }, room=f"group_{group_id}")  # Send to all users in the group
+        delete_own_message(user_id, message)
     except Exception as e:
         print(f"Error deleting group message: {e}")
         emit('error', {'message': 'Failed to delete message'})
 
 if __name__ == '__main__':
+    # Make sure every collection has the indexes its queries rely on
+    bootstrap_indexes(db)
+
+    start_background_tasks()
+
     # Use threading mode for Python 3.13 compatibility
-    socketio.run(app, debug=True, host='0.0.0.0', port=5000,
+    socketio.run(app, debug=True, host='0.0.0.0', port=int(os.getenv('PORT', 5000)),
                  log_output=True, use_reloader=False, allow_unsafe_werkzeug=True)
\ No newline at end of file
@@ -0,0 +1,455 @@
+"""Asyncio server mode: ASGI Socket.IO server with an async MongoDB client
+
+Run with:
+    uvicorn asgi_server:asgi_app --host 0.0.0.0 --port 5000
+
+(requires `pip install -r requirements-asyncio.txt`). The socket events used by
+the web client are served by the coroutines below on one event loop instead of
+one thread per connection; their queries go through motor, and helpers shared
+with the threading server (app.py) run in the default executor. Messages are
+built and their derived data written by message_writes.py, as in app.py. REST routes are the
+Flask app itself, mounted through a2wsgi (which runs it on a thread pool), so
+both modes expose the same API. SOCKETIO_MESSAGE_QUEUE and PRESENCE_BACKEND
+work as in app.py.
+"""
+import asyncio
+import os
+from urllib.parse import parse_qs
+import socketio
+from a2wsgi import WSGIMiddleware
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import app as flask_server
+from app import (app as flask_app, db, decode_token, get_utc_now, validate_file_size, save_file,
+                 users_collection, contacts_collection, groups_collection, uploads_collection, UPLOAD_FOLDER)
+from activity_tracker import activity_tracker
+from chunked_uploads import finished_upload, start_part_purger
+from conversations import dm_conversation_id
+from db_indexes import bootstrap_indexes
+from message_writes import (direct_message_document, direct_message_payload, record_direct_message,
+                            group_message_document, group_message_payload, record_group_message,
+                            edit_update, delete_update, edit_payload, delete_payload, payload_rooms,
+                            record_message_edit, record_message_delete)
+from presence_buffer import presence_buffer
+from presence_fanout import presence_fanout, ADMIN_ROOM
+from stage_timings import send_timings
+from socket_sessions import socket_sessions
+from user_events import sync_events, parse_sync_args
+from user_profiles import get_cached_user_profile, cache_user_profile, PROFILE_FIELDS, ROLE_FIELDS
+
+message_queue = os.getenv('SOCKETIO_MESSAGE_QUEUE')
+sio = socketio.AsyncServer(
+    async_mode='asgi',
+    cors_allowed_origins="*",
+    ping_timeout=120,
+    ping_interval=25,
+    client_manager=socketio.AsyncRedisManager(message_queue) if message_queue else None
+)
+
+mongo = AsyncIOMotorClient(os.getenv('MONGO_URI', 'mongodb://localhost:27017/'))
+adb = mongo.elite_messaging
+
+_loop = None
+_stop_part_purger = None
+
+
+def _emit_from_flask(event, data=None, room=None, to=None, namespace=None, **kwargs):
+    # REST routes emit through Flask-SocketIO, whose server has no clients in
+    # this mode: hand their events to the async server instead
+    asyncio.run_coroutine_threadsafe(sio.emit(event, data, to=to or room, namespace=namespace), _loop)
+
+
+flask_server.socketio.emit = _emit_from_flask
+
+
+async def user_profile(user_id):
+    """Profile through the shared profile cache, loading misses with motor"""
+    found, profile = get_cached_user_profile(user_id)
+    if not found:
+        profile = await adb.users.find_one({"_id": ObjectId(user_id)}, PROFILE_FIELDS)
+        cache_user_profile(user_id, profile)
+    return profile
+
+
+async def user_name(user_id, default="Unknown"):
+    profile = await user_profile(user_id)
+    return profile["name"] if profile else default
+
+
+async def is_group_member(group_id, user_id):
+    return await adb.group_members.count_documents(
+        {"groupId": ObjectId(group_id), "userId": ObjectId(user_id)}, limit=1
+    ) > 0
+
+
+async def socket_user(sid):
+    """User id bound to the socket at connect (None once its token expired)"""
+    user_id, reauth = socket_sessions.authenticate(sid)
+    if reauth:
+        await sio.emit('reauth_required', {'expired': user_id is None}, to=sid)
+    return user_id
+
+
+def in_background(function, *args):
+    """Run a blocking helper shared with the threading server in the default executor"""
+    return asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+
+@sio.event
+async def connect(sid, environ, auth=None):
+    token = parse_qs(environ.get('QUERY_STRING', '')).get('token', [None])[0]
+    if not token and isinstance(auth, dict):
+        token = auth.get('token')
+
+    payload = decode_token(token) if token else None
+    if not payload:
+        return False
+
+    user_id = payload['sub']
+    profile = await user_profile(user_id)
+    came_online = await in_background(socket_sessions.bind, sid, user_id, payload['exp'], {
+        "userAgent": environ.get('HTTP_USER_AGENT'),
+        "transport": parse_qs(environ.get('QUERY_STRING', '')).get('transport', [None])[0]
+    }, profile["name"] if profile else None)
+
+    await sio.enter_room(sid, user_id)
+
+    roles = await adb.users.find_one({"_id": ObjectId(user_id)}, ROLE_FIELDS)
+    if roles and roles.get("isAdmin", False):
+        await sio.enter_room(sid, ADMIN_ROOM)
+
+    presence_buffer.record(user_id, get_utc_now(), is_online=True)
+    if came_online:
+        presence_fanout.publish(user_id, 'online')
+    return True
+
+
+@sio.event
+async def disconnect(sid):
+    session, went_offline = await in_background(socket_sessions.unbind, sid)
+    if not went_offline:
+        return
+
+    presence_buffer.record(session["userId"], get_utc_now(), is_online=False)
+    presence_fanout.publish(session["userId"], 'offline')
+
+
+@sio.event
+async def heartbeat(sid, data=None):
+    now = get_utc_now()
+    await sio.emit('heartbeat-ack', {'status': 'ok', 'timestamp': now.isoformat()}, to=sid)
+
+    user_id = socket_sessions.touch(sid)
+    if user_id:
+        presence_buffer.record(user_id, now)
+
+
+@sio.event
+async def reauth(sid, data=None):
+    if not data:
+        await sio.emit('reauth_required', {'expired': True}, to=sid)
+        return
+
+    payload = decode_token(data.get('token'))
+    session = socket_sessions.get(sid)
+
+    if not payload or not session or payload['sub'] != session['userId']:
+        await sio.emit('reauth_required', {'expired': True}, to=sid)
+        return
+
+    await in_background(socket_sessions.bind, sid, payload['sub'], payload['exp'])
+    await sio.emit('reauth_ok', {'expiresAt': payload['exp']}, to=sid)
+
+
+@sio.event
+async def join_personal_room(sid, data=None):
+    user_id = await socket_user(sid)
+    if user_id:
+        await sio.enter_room(sid, user_id)
+
+
+@sio.event
+async def sync(sid, data=None):
+    user_id = await socket_user(sid)
+    if not user_id:
+        return
+
+    try:
+        since, limit = parse_sync_args(data or {})
+        result = await in_background(sync_events, db, user_id, since, limit)
+        await sio.emit('sync_result', result, to=sid)
+    except ValueError as e:
+        await sio.emit('error', {'message': str(e)}, to=sid)
+
+
+@sio.event
+async def send_message(sid, data):
+    timer = send_timings.start()
+    try:
+        user_id = await socket_user(sid)
+        if not user_id:
+            return
+
+        receiver_id = data.get('receiverId')
+        message_text = data.get('text', '')
+        file_type = data.get('fileType')
+        file_name = data.get('fileName')
+        file_data = data.get('fileData')
+        file_url = data.get('fileUrl')
+
+        if data.get('uploadId'):
+            upload = await in_background(finished_upload, uploads_collection, data['uploadId'], user_id)
+            if not upload:
+                await sio.emit('error', {'message': 'Upload not found or not finished'}, to=sid)
+                return
+            file_url, file_type, file_name = upload["fileUrl"], upload["fileType"], upload["fileName"]
+
+        if not receiver_id or (not message_text.strip() and not file_data and not file_url
+                               and not data.get('encryptedData')):
+            return
+
+        if file_data and file_type and file_name:
+            file_url = await save_attachment(sid, file_data, file_type, file_name, dm_conversation_id(user_id, receiver_id))
+            if not file_url:
+                return
+
+        message = direct_message_document(user_id, receiver_id, data, file_url, file_type, file_name, get_utc_now())
+        timer.stage("prepare")
+
+        await adb.messages.insert_one(message)
+        timer.stage("insert")
+
+        message_data = direct_message_payload(message, socket_sessions.user_name(sid))
+        await sio.emit('receive_message', message_data, room=user_id)
+        if receiver_id != user_id:
+            await sio.emit('receive_message', message_data, room=receiver_id)
+        timer.stage("emit")
+
+        # Derived data (summary, bucket, statistics, lastActivity, sync log) after delivery
+        await in_background(record_direct_message, db, message, message_data, timer)
+
+        send_timings.finish(timer)
+    except Exception as e:
+        print(f"Error sending message: {e}")
+        await sio.emit('error', {'message': f'Failed to send message: {str(e)}'}, to=sid)
+
+
+@sio.event
+async def send_group_message(sid, data):
+    try:
+        user_id = await socket_user(sid)
+        if not user_id:
+            return
+
+        group_id = data.get('groupId')
+        message_text = data.get('text', '')
+        file_type = data.get('fileType')
+        file_name = data.get('fileName')
+        file_data = data.get('fileData')
+        file_url = data.get('fileUrl')
+
+        if data.get('uploadId'):
+            upload = await in_background(finished_upload, uploads_collection, data['uploadId'], user_id)
+            if not upload:
+                await sio.emit('error', {'message': 'Upload not found or not finished'}, to=sid)
+                return
+            file_url, file_type, file_name = upload["fileUrl"], upload["fileType"], upload["fileName"]
+
+        if not group_id or (not message_text.strip() and not file_data and not file_url):
+            return
+
+        if not await is_group_member(group_id, user_id):
+            return
+
+        if file_data and file_type and file_name:
+            file_url = await save_attachment(sid, file_data, file_type, file_name, f"group_{group_id}")
+            if not file_url:
+                return
+
+        message = group_message_document(user_id, group_id, data, file_url, file_type, file_name, get_utc_now())
+        await adb.group_messages.insert_one(message)
+
+        message_data = group_message_payload(message, socket_sessions.user_name(sid))
+        await sio.emit('receive_group_message', message_data, room=f"group_{group_id}")
+
+        # Derived data (summary, bucket, statistics, lastActivity, sync log) after delivery
+        await in_background(record_group_message, db, message, message_data)
+    except Exception as e:
+        print(f"Error sending group message: {e}")
+        await sio.emit('error', {'message': f'Failed to send group message: {str(e)}'}, to=sid)
+
+
+async def save_attachment(sid, file_data, file_type, file_name, conversation_id):
+    """Store a base64 attachment, telling the sender why it was refused (None then)"""
+    is_valid, error_message = validate_file_size(file_data, file_type)
+    if not is_valid:
+        await sio.emit('error', {'message': error_message}, to=sid)
+        return None
+
+    file_url = await in_background(save_file, file_data, file_type, file_name, conversation_id)
+    if not file_url:
+        await sio.emit('error', {'message': 'Failed to save file'}, to=sid)
+    return file_url
+
+
+@sio.event
+async def join_group(sid, data):
+    user_id = await socket_user(sid)
+    group_id = data.get('groupId')
+    if not user_id or not group_id:
+        return
+
+    if await is_group_member(group_id, user_id):
+        await sio.enter_room(sid, f"group_{group_id}")
+
+
+@sio.event
+async def leave_group(sid, data):
+    user_id = await socket_user(sid)
+    group_id = data.get('groupId')
+    if not user_id or not group_id:
+        return
+
+    await sio.leave_room(sid, f"group_{group_id}")
+    await sio.emit('group_user_left', {
+        "groupId": group_id,
+        "userId": user_id,
+        "userName": await user_name(user_id)
+    }, room=f"group_{group_id}")
+
+
+async def _own_message(user_id, message_id, group_only=False):
+    """The direct (unless group_only) or group message with this id, if the user sent it"""
+    message = None if group_only else await adb.messages.find_one({"_id": ObjectId(message_id)})
+    if not message:
+        message = await adb.group_messages.find_one({"_id": ObjectId(message_id)})
+    return message if message and str(message["senderId"]) == user_id else None
+
+
+async def _edit_message(user_id, message, new_text):
+    collection = adb.group_messages if message.get("groupId") else adb.messages
+    await collection.update_one({"_id": message["_id"]}, edit_update(new_text))
+
+    sender_name = await user_name(user_id) if message.get("groupId") else None
+    edited_message = edit_payload(message, new_text, sender_name)
+    for room in payload_rooms(message):
+        await sio.emit('message_edited', edited_message, room=room)
+
+    await in_background(record_message_edit, db, message, new_text, edited_message)
+
+
+async def _delete_message(user_id, message):
+    collection = adb.group_messages if message.get("groupId") else adb.messages
+    await collection.update_one({"_id": message["_id"]}, delete_update())
+
+    sender_name = await user_name(user_id) if message.get("groupId") else None
+    deleted_message = delete_payload(message, sender_name)
+    for room in payload_rooms(message):
+        await sio.emit('message_deleted', deleted_message, room=room)
+
+    await in_background(record_message_delete, db, message, deleted_message)
+
+
+@sio.event
+async def edit_message(sid, data):
+    try:
+        user_id = await socket_user(sid)
+        message_id = data.get('messageId')
+        new_text = data.get('text')
+        if not user_id or not message_id or not new_text:
+            return
+
+        message = await _own_message(user_id, message_id)
+        if message:
+            await _edit_message(user_id, message, new_text)
+    except Exception as e:
+        print(f"Error editing message: {e}")
+        await sio.emit('error', {'message': 'Failed to edit message'}, to=sid)
+
+
+@sio.event
+async def edit_group_message(sid, data):
+    try:
+        user_id = await socket_user(sid)
+        message_id = data.get('messageId')
+        new_text = data.get('text')
+        if not user_id or not message_id or not new_text or not data.get('groupId'):
+            return
+
+        message = await _own_message(user_id, message_id, group_only=True)
+        if message:
+            await _edit_message(user_id, message, new_text)
+    except Exception as e:
+        print(f"Error editing group message: {e}")
+        await sio.emit('error', {'message': 'Failed to edit message'}, to=sid)
+
+
+@sio.event
+async def delete_message(sid, data):
+    try:
+        user_id = await socket_user(sid)
+        message_id = data.get('messageId')
+        if not user_id or not message_id:
+            return
+
+        message = await _own_message(user_id, message_id)
+        if message:
+            await _delete_message(user_id, message)
+    except Exception as e:
+        print(f"Error deleting message: {e}")
+        await sio.emit('error', {'message': 'Failed to delete message'}, to=sid)
+
+
+@sio.event
+async def delete_group_message(sid, data):
+    try:
+        user_id = await socket_user(sid)
+        message_id = data.get('messageId')
+        if not user_id or not message_id or not data.get('groupId'):
+            return
+
+        message = await _own_message(user_id, message_id, group_only=True)
+        if message:
+            await _delete_message(user_id, message)
+    except Exception as e:
+        print(f"Error deleting group message: {e}")
+        await sio.emit('error', {'message': 'Failed to delete message'}, to=sid)
+
+
+async def _send_presence_changes():
+    while True:
+        await sio.sleep(presence_fanout.interval)
+        try:
+            for room, payload in await in_background(presence_fanout.collect):
+                await sio.emit('presence_diff', payload, room=room)
+        except Exception as e:
+            print(f"Error sending presence changes: {e}")
+
+
+async def startup():
+    global _loop, _stop_part_purger
+    _loop = asyncio.get_running_loop()
+
+    # Make sure every collection has the indexes its queries rely on
+    await in_background(bootstrap_indexes, db)
+
+    presence_buffer.start(users_collection)
+    activity_tracker.start(contacts_collection, groups_collection)
+    _stop_part_purger = start_part_purger(uploads_collection, UPLOAD_FOLDER)
+    presence_fanout.configure(db, socket_sessions.online_among)
+
+    # Connections this worker held before a restart are gone
+    for offline_user_id in await in_background(socket_sessions.presence.purge_worker):
+        presence_buffer.record(offline_user_id, get_utc_now(), is_online=False)
+        presence_fanout.publish(offline_user_id, 'offline')
+
+    sio.start_background_task(_send_presence_changes)
+
+
+async def shutdown():
+    _stop_part_purger.set()
+    await asyncio.gather(in_background(presence_buffer.stop), in_background(activity_tracker.stop))
+
+
+asgi_app = socketio.ASGIApp(sio, other_asgi_app=WSGIMiddleware(flask_app), on_startup=startup, on_shutdown=shutdown)
@@ -0,0 +1,96 @@
+"""Compare history reads on the flat and bucketed message layouts
+
+Usage:
+    python benchmark_buckets.py [messages] [page_size]
+
+Fills one conversation of a scratch database (BENCHMARK_DB, default
+elite_messaging_benchmark, on MONGO_URI) with `messages` messages, then pages
+through the whole history with `before` cursors on both layouts. The scratch
+database is dropped afterwards.
+"""
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from pymongo import MongoClient
+
+from db_indexes import INDEXES, BUCKET_INDEXES, ensure_indexes
+from message_buckets import fetch_bucketed_page, rebuild_buckets
+from pagination import fetch_page
+
+CONVERSATION_ID = "dm_benchmark_a_benchmark_b"
+INSERT_BATCH_SIZE = 5000
+
+
+def fill(db, count):
+    sender, receiver = ObjectId(), ObjectId()
+    start = datetime.now(timezone.utc) - timedelta(seconds=count)
+
+    batch = []
+    for i in range(count):
+        batch.append({
+            "conversationId": CONVERSATION_ID,
+            "senderId": sender if i % 2 else receiver,
+            "receiverId": receiver if i % 2 else sender,
+            "text": f"Benchmark message {i}",
+            "timestamp": start + timedelta(seconds=i),
+            "messageType": "text",
+            "urgencyLevel": "normal"
+        })
+        if len(batch) >= INSERT_BATCH_SIZE:
+            db.messages.insert_many(batch)
+            batch = []
+    if batch:
+        db.messages.insert_many(batch)
+
+
+def walk(fetch, limit):
+    """Read the whole history page by page; returns per-page timings in ms"""
+    timings = []
+    cursor = None
+    while True:
+        started = time.perf_counter()
+        messages, has_more = fetch(cursor, limit)
+        timings.append((time.perf_counter() - started) * 1000)
+        if not has_more:
+            return timings
+        cursor = (messages[0]["timestamp"], messages[0]["_id"])
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    median = timings[len(timings) // 2]
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f"{name:<10} pages={len(timings):<6} first={timings[0]:.2f}ms median={median:.2f}ms "
+          f"p95={p95:.2f}ms total={sum(timings):.0f}ms")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    client = MongoClient(os.getenv('MONGO_URI', 'mongodb://localhost:27017/'))
+    db = client[os.getenv('BENCHMARK_DB', 'elite_messaging_benchmark')]
+    client.drop_database(db.name)
+
+    try:
+        print(f"Inserting {count} messages...")
+        ensure_indexes(db, {"messages": INDEXES["messages"], "message_buckets": BUCKET_INDEXES})
+        fill(db, count)
+        print(f"Building buckets: {rebuild_buckets(db)}")
+
+        flat = walk(lambda cursor, size: fetch_page(
+            db.messages, {"conversationId": CONVERSATION_ID}, "before", cursor, size), limit)
+        bucketed = walk(lambda cursor, size: fetch_bucketed_page(
+            db.message_buckets, CONVERSATION_ID, "before", cursor, size), limit)
+
+        print(f"Paging {count} messages, {limit} per page:")
+        report("flat", flat)
+        report("bucketed", bucketed)
+    finally:
+        client.drop_database(db.name)
+
+
+if __name__ == '__main__':
+    main()
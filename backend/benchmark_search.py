@@ -0,0 +1,116 @@
+"""Check message search latency on a large conversation
+
+Usage:
+    python benchmark_search.py [messages] [runs]
+
+Fills one conversation of a scratch database (BENCHMARK_DB, default
+elite_messaging_benchmark, on MONGO_URI) with `messages` messages, then runs
+a set of queries `runs` times each through search(). Exits with status 1 when
+the p95 latency of a query exceeds the target (SEARCH_LATENCY_TARGET_MS,
+default 50). The scratch database is dropped afterwards.
+"""
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from pymongo import MongoClient
+
+from db_indexes import INDEXES, ensure_indexes
+from search_index import search, query_terms, tokenize
+
+CONVERSATION_ID = "dm_benchmark_a_benchmark_b"
+INSERT_BATCH_SIZE = 5000
+
+SEARCH_LATENCY_TARGET_MS = float(os.getenv('SEARCH_LATENCY_TARGET_MS', 50))
+
+# Common words appear in most messages, rare ones in a few
+COMMON_WORDS = ["the", "meeting", "project", "report", "team", "today", "update", "review", "call", "deadline"]
+RARE_WORDS = ["budget", "quarterly", "onboarding", "incident", "migration"]
+
+QUERIES = [
+    "meeting",
+    "meet",
+    "budget",
+    "quarterly budget",
+    "project deadline review",
+    "zzzz",
+]
+
+
+def fill(db, count):
+    rng = random.Random(42)
+    sender, receiver = ObjectId(), ObjectId()
+    start = datetime.now(timezone.utc) - timedelta(seconds=count)
+
+    batch = []
+    for i in range(count):
+        words = rng.sample(COMMON_WORDS, 5)
+        if rng.random() < 0.01:
+            words.append(rng.choice(RARE_WORDS))
+        text = " ".join(words) + f" {i}"
+        batch.append({
+            "conversationId": CONVERSATION_ID,
+            "senderId": sender if i % 2 else receiver,
+            "receiverId": receiver if i % 2 else sender,
+            "text": text,
+            "searchTokens": tokenize(text),
+            "timestamp": start + timedelta(seconds=i),
+            "messageType": "text",
+            "urgencyLevel": "normal"
+        })
+        if len(batch) >= INSERT_BATCH_SIZE:
+            db.messages.insert_many(batch)
+            batch = []
+    if batch:
+        db.messages.insert_many(batch)
+
+
+def measure(db, query, runs):
+    """Timings in ms of the first page of a query"""
+    terms = query_terms(query)
+    scope = {"conversationId": CONVERSATION_ID}
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        search(db.messages, scope, terms)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def report(name, timings):
+    """Print median / p95 and return the p95"""
+    timings = sorted(timings)
+    median = timings[len(timings) // 2]
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    status = "ok" if p95 <= SEARCH_LATENCY_TARGET_MS else "SLOW"
+    print(f"{name!r:<28} median={median:.2f}ms p95={p95:.2f}ms {status}")
+    return p95
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    client = MongoClient(os.getenv('MONGO_URI', 'mongodb://localhost:27017/'))
+    db = client[os.getenv('BENCHMARK_DB', 'elite_messaging_benchmark')]
+    client.drop_database(db.name)
+
+    try:
+        print(f"Inserting {count} messages...")
+        ensure_indexes(db, {"messages": INDEXES["messages"]})
+        fill(db, count)
+
+        print(f"Searching {count} messages, {runs} runs per query (target p95 <= {SEARCH_LATENCY_TARGET_MS:.0f}ms):")
+        slow = [query for query in QUERIES if report(query, measure(db, query, runs)) > SEARCH_LATENCY_TARGET_MS]
+    finally:
+        client.drop_database(db.name)
+
+    if slow:
+        print(f"Over the latency target: {', '.join(slow)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
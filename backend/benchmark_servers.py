@@ -0,0 +1,145 @@
+"""Compare the threading and asyncio server modes under many socket connections
+
+Usage:
+    python benchmark_servers.py [connections] [messages]
+
+Starts each server in turn on BENCHMARK_PORT (default 5099): the threading
+server (`python app.py`), then the asyncio one (`uvicorn asgi_server:asgi_app`).
+Both use MONGO_URI, so point it at a scratch MongoDB: the benchmark users and
+their messages are left behind. For each mode, `connections` users sign up and
+open one websocket each, then every user sends `messages` direct messages to
+the next one; a send is timed until its receive_message echo reaches the
+sender. Server CPU is read from /proc, so this runs on Linux only.
+
+Requires `pip install -r requirements-asyncio.txt`.
+"""
+import asyncio
+import os
+import subprocess
+import sys
+import time
+import uuid
+import aiohttp
+import socketio
+
+PORT = int(os.getenv('BENCHMARK_PORT', 5099))
+BASE_URL = f"http://127.0.0.1:{PORT}"
+
+MODES = {
+    "threading": [sys.executable, "app.py"],
+    "asyncio": [sys.executable, "-m", "uvicorn", "asgi_server:asgi_app", "--port", str(PORT),
+                "--log-level", "warning"]
+}
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+STARTUP_TIMEOUT = 30
+
+
+def cpu_seconds(pid):
+    """User + system CPU time used so far by a process"""
+    with open(f"/proc/{pid}/stat") as stat:
+        # Fields after the parenthesised command name; utime and stime are 14th and 15th
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+async def wait_until_up(http):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            async with http.get(f"{BASE_URL}/api/auth/verify"):
+                return
+        except aiohttp.ClientError:
+            await asyncio.sleep(0.5)
+    raise RuntimeError(f"Server did not start on port {PORT}")
+
+
+async def signup(http, run_id, i):
+    async with http.post(f"{BASE_URL}/api/auth/signup", json={
+        "username": f"benchmark {i}",
+        "email": f"benchmark-{run_id}-{i}@example.com",
+        "password": "benchmark",
+        "department": "Benchmark"
+    }) as response:
+        data = await response.json()
+    return data["user"]["id"], data["token"]
+
+
+async def connect(token, echoes):
+    client = socketio.AsyncClient(reconnection=False)
+
+    @client.on('receive_message')
+    async def on_message(message):
+        future = echoes.pop(message.get("text"), None)
+        if future is not None and not future.done():
+            future.set_result(time.perf_counter())
+
+    await client.connect(f"{BASE_URL}?token={token}", transports=["websocket"])
+    return client
+
+
+async def send(client, receiver_id, text, echoes):
+    """Send a direct message; returns the time until the sender got it back, in ms"""
+    future = echoes[text] = asyncio.get_running_loop().create_future()
+    started = time.perf_counter()
+    await client.emit('send_message', {"receiverId": receiver_id, "text": text})
+    return (await asyncio.wait_for(future, 30) - started) * 1000
+
+
+async def run_mode(pid, connections, messages):
+    run_id = uuid.uuid4().hex[:8]
+    echoes = {}
+    async with aiohttp.ClientSession() as http:
+        await wait_until_up(http)
+        users = [await signup(http, run_id, i) for i in range(connections)]
+
+    cpu_before, started = cpu_seconds(pid), time.perf_counter()
+    clients = await asyncio.gather(*(connect(token, echoes) for _, token in users))
+    connect_cpu, connect_time = cpu_seconds(pid) - cpu_before, time.perf_counter() - started
+
+    try:
+        latencies = []
+        cpu_before = cpu_seconds(pid)
+        for round_number in range(messages):
+            latencies += await asyncio.gather(*(
+                send(client, users[(i + 1) % connections][0], f"{run_id} {round_number} {i}", echoes)
+                for i, client in enumerate(clients)
+            ))
+        send_cpu = cpu_seconds(pid) - cpu_before
+    finally:
+        await asyncio.gather(*(client.disconnect() for client in clients))
+
+    return connect_cpu, connect_time, send_cpu, sorted(latencies)
+
+
+def report(name, connections, connect_cpu, connect_time, send_cpu, latencies):
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{name:<10} connections={connections:<6} connect={connect_time:.2f}s "
+          f"connections/cpu-s={connections / max(connect_cpu, 0.01):.0f} "
+          f"cpu/message={send_cpu / len(latencies) * 1000:.2f}ms "
+          f"p50={p50:.2f}ms p99={p99:.2f}ms")
+
+
+def main():
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    results = {}
+    for name, command in MODES.items():
+        print(f"Starting the {name} server...")
+        server = subprocess.Popen(command, env=dict(os.environ, PORT=str(PORT)),
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            results[name] = asyncio.run(run_mode(server.pid, connections, messages))
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f"{connections} connections, {messages} messages each:")
+    for name, result in results.items():
+        report(name, connections, *result)
+
+
+if __name__ == '__main__':
+    main()
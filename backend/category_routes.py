@@ -73,6 +73,7 @@ def clean_orphaned_department_categories(user_id):
 def ensure_department_categories(user_id):
     """Create department categories for a user if they don't exist"""
     from app import db, users_collection, contacts_collection
+    from user_profiles import get_user_profile
 
     print(f"Ensuring department categories for user {user_id}")
 
@@ -80,7 +81,7 @@ def ensure_department_categories(user_id):
     clean_orphaned_department_categories(user_id)
 
     # Get user's department
-    user = users_collection.find_one({"_id": ObjectId(user_id)})
+    user = get_user_profile(users_collection, user_id)
     if user and user.get("department"):
         user_department = user.get("department")
 
@@ -584,12 +585,10 @@ def set_group_category(group_id):
 
     # Get database reference
     from app import db
+    from group_members import find_member_group
 
     # Check if group exists and user is a member
-    group = db.groups.find_one({
-        "_id": ObjectId(group_id),
-        "members": {"$elemMatch": {"userId": ObjectId(user_id)}}
-    })
+    group = find_member_group(db.groups, db.group_members, group_id, user_id)
 
     if not group:
         return jsonify({"error": "Group not found"}), 404
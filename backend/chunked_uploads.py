@@ -0,0 +1,251 @@
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReturnDocument
+from werkzeug.utils import secure_filename
+from file_upload import allowed_file, FILE_SIZE_LIMITS
+
+# Resumable attachment uploads, in fixed-size chunks.
+#
+# A client creates an upload (file name, MIME type, size) and gets an upload
+# id and the chunk size back, then PUTs the file chunk by chunk, each at the
+# offset the server last acknowledged. Chunks are copied from the request
+# stream straight into uploads/incoming/<upload id>.part at their offset, so
+# the server never holds more than a small copy buffer of a file; after a
+# dropped connection the client asks for the upload's offset and resumes from
+# there. When the last chunk arrives the part file is moved to where
+# /api/upload would have stored the file, and sends reference it by uploadId.
+# If that fails after the last chunk was acknowledged, the upload stays
+# pending with offset == fileSize: any later PUT (an empty one at that
+# offset will do) finishes it.
+#
+# An upload document (`uploads` collection):
+#   {"userId", "fileName", "fileType", "category", "fileSize", "conversationId",
+#    "chunkSize", "offset", "status": "pending" | "complete", "fileUrl",
+#    "createdAt", "expiresAt"}
+# Pending uploads expire (TTL index on expiresAt) UPLOAD_EXPIRY_HOURS after
+# their last chunk; finished ones are kept, messages link to their file. The
+# part files of expired and aborted uploads are purged every
+# UPLOAD_PURGE_INTERVAL seconds.
+
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', 1024 * 1024))
+UPLOAD_EXPIRY_HOURS = int(os.getenv('UPLOAD_EXPIRY_HOURS', 24))
+UPLOAD_PURGE_INTERVAL = float(os.getenv('UPLOAD_PURGE_INTERVAL', 3600))
+
+PENDING = "pending"
+COMPLETE = "complete"
+
+# Bytes copied from the request stream to disk at a time
+COPY_BUFFER_SIZE = 64 * 1024
+
+
+def file_category(file_type):
+    """image / video / file, from a MIME type"""
+    return 'image' if file_type.startswith('image/') else 'video' if file_type.startswith('video/') else 'file'
+
+
+def part_path(upload_folder, upload_id):
+    return os.path.join(upload_folder, 'incoming', f"{upload_id}.part")
+
+
+def _expiry():
+    return datetime.now(timezone.utc) + timedelta(hours=UPLOAD_EXPIRY_HOURS)
+
+
+def create_upload(collection, upload_folder, user_id, file_name, file_type, file_size, conversation_id=None):
+    """Start an upload; raises ValueError if the file is not accepted"""
+    if not file_name or not file_type or not isinstance(file_size, int) or isinstance(file_size, bool):
+        raise ValueError("fileName, fileType and an integer fileSize are required")
+    if not allowed_file(file_name):
+        raise ValueError("File type not allowed")
+
+    category = file_category(file_type)
+    limit = FILE_SIZE_LIMITS.get(category, FILE_SIZE_LIMITS['file'])
+    if file_size <= 0 or file_size > limit:
+        raise ValueError(f"File exceeds maximum size of {limit / (1024 * 1024)}MB for {category} files")
+
+    upload = {
+        "_id": ObjectId(),
+        "userId": ObjectId(user_id),
+        "fileName": secure_filename(file_name),
+        "fileType": file_type,
+        "category": category,
+        "fileSize": file_size,
+        "conversationId": conversation_id,
+        "chunkSize": UPLOAD_CHUNK_SIZE,
+        "offset": 0,
+        "status": PENDING,
+        "createdAt": datetime.now(timezone.utc),
+        "expiresAt": _expiry()
+    }
+
+    # Stored before its part file exists, so a concurrent purge never takes the file for abandoned
+    collection.insert_one(upload)
+
+    path = part_path(upload_folder, upload["_id"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+    return upload
+
+
+def get_upload(collection, upload_id, user_id):
+    """An upload of the user, or None"""
+    try:
+        return collection.find_one({"_id": ObjectId(upload_id), "userId": ObjectId(user_id)})
+    except InvalidId:
+        return None
+
+
+def finished_upload(collection, upload_id, user_id):
+    """A complete upload of the user (what a message can reference), or None"""
+    upload = get_upload(collection, upload_id, user_id)
+    return upload if upload and upload["status"] == COMPLETE else None
+
+
+def write_chunk(collection, upload_folder, upload, offset, stream, length):
+    """Append a chunk read from `stream` at `offset`
+
+    Raises ValueError for a chunk of the wrong size, and FileNotFoundError
+    if the upload was aborted or purged meanwhile. Returns the updated
+    upload, or None if `offset` is not the acknowledged offset (another
+    request wrote it first, or the client is out of step and should resume
+    from the upload's offset). An empty chunk at the end of an upload that
+    has every byte but is still pending returns it as is, to be completed.
+    """
+    if upload["status"] != PENDING or offset != upload["offset"]:
+        return None
+
+    if length == 0 and offset == upload["fileSize"]:
+        return upload
+
+    remaining = upload["fileSize"] - offset
+    if length <= 0 or length != min(upload["chunkSize"], remaining):
+        raise ValueError(f"Chunk at offset {offset} must be {min(upload['chunkSize'], remaining)} bytes")
+
+    received = 0
+    with open(part_path(upload_folder, upload["_id"]), 'r+b') as part:
+        part.seek(offset)
+        while received < length:
+            data = stream.read(min(COPY_BUFFER_SIZE, length - received))
+            if not data:
+                break
+            part.write(data)
+            received += len(data)
+    if received != length:
+        raise ValueError(f"Chunk ended after {received} of {length} bytes")
+
+    # Only acknowledge the chunk if nobody moved the offset meanwhile
+    return collection.find_one_and_update(
+        {"_id": upload["_id"], "offset": offset, "status": PENDING},
+        {"$set": {"offset": offset + length, "expiresAt": _expiry()}},
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def complete_upload(collection, upload_folder, upload):
+    """Move the reassembled file to its final place; returns the finished upload
+
+    The file URL is recorded before the move, so a completion that failed
+    halfway can be retried. Raises FileNotFoundError if the part file was
+    aborted or purged meanwhile.
+    """
+    file_url = upload.get("fileUrl")
+    if not file_url:
+        target_dir = os.path.join(upload_folder, upload["category"] + 's')
+        if upload.get("conversationId"):
+            target_dir = os.path.join(target_dir, secure_filename(str(upload["conversationId"])))
+        os.makedirs(target_dir, exist_ok=True)
+
+        # Same URL shape as /api/upload and save_file
+        file_path = os.path.join(target_dir, f"{uuid.uuid4()}_{upload['fileName']}")
+        rel_path = os.path.relpath(file_path, upload_folder)
+        file_url = f"/api/files/{rel_path.replace(os.sep, '/')}"
+        # A concurrent completion may have recorded its URL first: use that one
+        upload_id = upload["_id"]
+        upload = collection.find_one_and_update(
+            {"_id": upload_id, "fileUrl": None},
+            {"$set": {"fileUrl": file_url}},
+            return_document=ReturnDocument.AFTER
+        ) or collection.find_one({"_id": upload_id})
+        if upload is None:
+            raise FileNotFoundError(part_path(upload_folder, upload_id))
+        file_url = upload["fileUrl"]
+
+    file_path = os.path.join(upload_folder, *file_url[len("/api/files/"):].split('/'))
+    if not os.path.exists(file_path):
+        os.replace(part_path(upload_folder, upload["_id"]), file_path)
+
+    return collection.find_one_and_update(
+        {"_id": upload["_id"]},
+        {"$set": {"status": COMPLETE, "completedAt": datetime.now(timezone.utc)},
+         "$unset": {"expiresAt": ""}},
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def abort_upload(collection, upload_folder, upload):
+    """Drop a pending upload and its part file"""
+    collection.delete_one({"_id": upload["_id"], "status": PENDING})
+    try:
+        os.remove(part_path(upload_folder, upload["_id"]))
+    except FileNotFoundError:
+        pass
+
+
+def purge_abandoned_parts(collection, upload_folder):
+    """Delete part files whose upload expired or was aborted; returns how many"""
+    incoming = os.path.join(upload_folder, 'incoming')
+    if not os.path.isdir(incoming):
+        return 0
+
+    purged = 0
+    for name in os.listdir(incoming):
+        upload_id = name[:-len(".part")]
+        if not name.endswith(".part") or not ObjectId.is_valid(upload_id):
+            continue
+        if collection.count_documents({"_id": ObjectId(upload_id), "status": PENDING}, limit=1) == 0:
+            try:
+                os.remove(os.path.join(incoming, name))
+            except FileNotFoundError:
+                # Aborted or completed meanwhile
+                continue
+            purged += 1
+    return purged
+
+
+def start_part_purger(collection, upload_folder, interval=UPLOAD_PURGE_INTERVAL):
+    """Purge abandoned part files now and then every `interval` seconds
+
+    Runs in a daemon thread; returns the event that stops it.
+    """
+    stop = threading.Event()
+
+    def run():
+        while True:
+            try:
+                purge_abandoned_parts(collection, upload_folder)
+            except Exception as e:
+                print(f"Error purging abandoned uploads: {e}")
+            if stop.wait(interval):
+                return
+
+    threading.Thread(target=run, name="upload-purge", daemon=True).start()
+    return stop
+
+
+def upload_to_json(upload):
+    data = {
+        "uploadId": str(upload["_id"]),
+        "fileName": upload["fileName"],
+        "fileType": upload["fileType"],
+        "fileSize": upload["fileSize"],
+        "chunkSize": upload["chunkSize"],
+        "offset": upload["offset"],
+        "status": upload["status"]
+    }
+    if upload["status"] == COMPLETE:
+        data["fileUrl"] = upload["fileUrl"]
+    return data
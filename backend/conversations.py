@@ -0,0 +1,376 @@
+from datetime import datetime, timezone
+from bson import ObjectId
+
+# Denormalized per-conversation summaries kept in the `conversations` collection.
+#
+# One document per DM (`dm_<minUserId>_<maxUserId>`) or group (`group_<groupId>`):
+#   {
+#       "_id": "dm_..." | "group_...",
+#       "type": "dm" | "group",
+#       "participants": [ObjectId, ObjectId],        # DMs only
+#       "lastMessage": {"id", "text", "senderId", "messageType", "urgencyLevel",
+#                       "isEdited", "isDeleted"},
+#       "lastMessageTime": datetime,
+#       "lastSenderId": ObjectId,
+#       "messageCount": int,                          # messages ever sent
+#       "baseSeq": int,                               # messageCount at backfill time
+#       "readSeq": {userId: int},                     # messageCount at the user's last read
+#       "sentSinceRead": {userId: int},               # user's own messages since that read
+#       "clearedAt": {userId: datetime},              # user's last "clear chat"
+#       "hiddenMessages": {userId: [ObjectId]}        # messages the user hid since then
+#   }
+#
+# Clearing a chat is a single write of the user's clearedAt watermark: history
+# and search only read messages newer than it (a range on the same index as
+# the conversation). Single hidden messages are a small per-user exception set,
+# emptied again by the next clear.
+#
+# Unread counters are kept per member without touching every member on each send:
+# unread = messageCount - readSeq[user] - sentSinceRead[user]. A send is a single
+# $inc on the sender's counter, however large the group is.
+
+# Number of characters of the last message stored in the summary
+PREVIEW_LENGTH = 200
+
+DELETED_MESSAGE_TEXT = "This message was deleted"
+
+
+def dm_conversation_id(user_a, user_b):
+    """Canonical conversation id for a direct message thread"""
+    user_a, user_b = str(user_a), str(user_b)
+    return f"dm_{min(user_a, user_b)}_{max(user_a, user_b)}"
+
+
+def group_conversation_id(group_id):
+    """Conversation id for a group chat"""
+    return f"group_{group_id}"
+
+
+def summary_identity(conversation_id):
+    """`type` and, for DMs, `participants` of a summary, derived from its id"""
+    if conversation_id.startswith("dm_"):
+        return {"type": "dm", "participants": [ObjectId(user_id) for user_id in conversation_id[3:].split("_")]}
+    return {"type": "group"}
+
+
+def message_preview(text):
+    """Truncate message text for storage in a conversation summary"""
+    return (text or "")[:PREVIEW_LENGTH]
+
+
+def record_message(conversations_collection, conversation_id, message_id, message, participants=None):
+    """Update the conversation summary after a message has been stored
+
+    `message` is the stored message document. Creates the summary on first use.
+    """
+    sender_id = message["senderId"]
+    update = {
+        "$set": {
+            "type": "dm" if participants else "group",
+            "lastMessage": {
+                "id": message_id,
+                "text": message_preview(message.get("text")),
+                "senderId": sender_id,
+                "messageType": message.get("messageType", "text"),
+                "urgencyLevel": message.get("urgencyLevel", "normal"),
+                "isEdited": False,
+                "isDeleted": False
+            },
+            "lastMessageTime": message["timestamp"],
+            "lastSenderId": sender_id
+        },
+        "$inc": {
+            "messageCount": 1,
+            f"sentSinceRead.{sender_id}": 1
+        }
+    }
+
+    # Set on every send: the summary may have been created by a clear or hide first
+    if participants:
+        update["$set"]["participants"] = list(participants)
+
+    conversations_collection.update_one({"_id": conversation_id}, update, upsert=True)
+
+
+def record_edit(conversations_collection, conversation_id, message_id, new_text):
+    """Refresh the preview if the edited message is the latest one"""
+    conversations_collection.update_one(
+        {"_id": conversation_id, "lastMessage.id": message_id},
+        {"$set": {"lastMessage.text": message_preview(new_text), "lastMessage.isEdited": True}}
+    )
+
+
+def record_delete(conversations_collection, conversation_id, message_id):
+    """Replace the preview if the deleted message is the latest one"""
+    conversations_collection.update_one(
+        {"_id": conversation_id, "lastMessage.id": message_id},
+        {"$set": {
+            "lastMessage.text": DELETED_MESSAGE_TEXT,
+            "lastMessage.messageType": "text",
+            "lastMessage.isDeleted": True
+        }}
+    )
+
+
+def mark_read(conversations_collection, conversation_id, user_ids):
+    """Reset the unread counter of one or more users
+
+    Uses an update pipeline so the read position is taken from the current
+    messageCount atomically, without reading the document first.
+    """
+    if not isinstance(user_ids, (list, tuple, set)):
+        user_ids = [user_ids]
+
+    fields = {}
+    for user_id in user_ids:
+        fields[f"readSeq.{user_id}"] = {"$ifNull": ["$messageCount", 0]}
+        fields[f"sentSinceRead.{user_id}"] = 0
+
+    if fields:
+        conversations_collection.update_one({"_id": conversation_id}, [{"$set": fields}])
+
+
+def mark_cleared(conversations_collection, conversation_id, user_id, cleared_at):
+    """Remember that a user cleared the conversation history
+
+    Messages hidden one by one are older than the new watermark, so the
+    user's exception set is dropped at the same time.
+    """
+    conversations_collection.update_one(
+        {"_id": conversation_id},
+        {
+            "$set": {f"clearedAt.{user_id}": cleared_at},
+            "$unset": {f"hiddenMessages.{user_id}": ""},
+            "$setOnInsert": summary_identity(conversation_id)
+        },
+        upsert=True
+    )
+    mark_read(conversations_collection, conversation_id, user_id)
+
+
+def hide_message(conversations_collection, conversation_id, user_id, message_id):
+    """Hide a single message from one user's history"""
+    conversations_collection.update_one(
+        {"_id": conversation_id},
+        {
+            "$addToSet": {f"hiddenMessages.{user_id}": message_id},
+            "$setOnInsert": summary_identity(conversation_id)
+        },
+        upsert=True
+    )
+
+
+def visibility_filter(summary, user_id):
+    """Query clauses selecting the messages the user has neither cleared nor hidden"""
+    user_id = str(user_id)
+    clauses = {}
+    if not summary:
+        return clauses
+
+    cleared_at = summary.get("clearedAt", {}).get(user_id)
+    if cleared_at:
+        clauses["timestamp"] = {"$gt": cleared_at}
+
+    hidden = summary.get("hiddenMessages", {}).get(user_id)
+    if hidden:
+        clauses["_id"] = {"$nin": hidden}
+
+    return clauses
+
+
+def get_visibility(conversations_collection, conversation_id, user_id):
+    """(clearedAt or None, hidden message ids) of one user in a conversation"""
+    user_id = str(user_id)
+    summary = conversations_collection.find_one(
+        {"_id": conversation_id},
+        {f"clearedAt.{user_id}": 1, f"hiddenMessages.{user_id}": 1}
+    ) or {}
+    return summary.get("clearedAt", {}).get(user_id), summary.get("hiddenMessages", {}).get(user_id, [])
+
+
+def get_visibility_filter(conversations_collection, conversation_id, user_id):
+    """visibility_filter for one conversation, reading only the user's own fields"""
+    summary = conversations_collection.find_one(
+        {"_id": conversation_id},
+        {f"clearedAt.{user_id}": 1, f"hiddenMessages.{user_id}": 1}
+    )
+    return visibility_filter(summary, user_id)
+
+
+def get_visibility_filters(conversations_collection, conversation_ids, user_id):
+    """visibility_filter of many conversations in one query: {conversation_id: clauses}"""
+    return {
+        summary["_id"]: visibility_filter(summary, user_id)
+        for summary in conversations_collection.find(
+            {"_id": {"$in": list(conversation_ids)}},
+            {f"clearedAt.{user_id}": 1, f"hiddenMessages.{user_id}": 1}
+        )
+    }
+
+
+def unread_count(summary, user_id):
+    """Number of messages the user has not read yet"""
+    if not summary:
+        return 0
+
+    user_id = str(user_id)
+    read_seq = summary.get("readSeq", {}).get(user_id, summary.get("baseSeq", 0))
+    sent_since_read = summary.get("sentSinceRead", {}).get(user_id, 0)
+    return max(summary.get("messageCount", 0) - read_seq - sent_since_read, 0)
+
+
+def visible_last_message(summary, user_id):
+    """Return (lastMessage, lastMessageTime) as seen by the user
+
+    Messages older than the user's last "clear chat" are not visible.
+    """
+    if not summary or not summary.get("lastMessageTime"):
+        return None, None
+
+    cleared_at = summary.get("clearedAt", {}).get(str(user_id))
+    last_message_time = summary["lastMessageTime"]
+    if cleared_at and _as_utc(last_message_time) <= _as_utc(cleared_at):
+        return None, None
+
+    return summary.get("lastMessage"), last_message_time
+
+
+def _as_utc(value):
+    """Compare naive (as returned by pymongo) and aware datetimes safely"""
+    if isinstance(value, datetime) and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def backfill_dm_conversation_ids(db):
+    """Store the canonical conversationId on direct messages that predate it
+
+    Runs as a single server-side update, so no message is loaded into the app.
+    """
+    sender = {"$toString": "$senderId"}
+    receiver = {"$toString": "$receiverId"}
+
+    result = db.messages.update_many(
+        {
+            "conversationId": {"$exists": False},
+            "senderId": {"$type": "objectId"},
+            "receiverId": {"$type": "objectId"}
+        },
+        [{"$set": {"conversationId": {
+            "$concat": ["dm_", {"$min": [sender, receiver]}, "_", {"$max": [sender, receiver]}]
+        }}}]
+    )
+    return {"updated": result.modified_count}
+
+
+def backfill_conversation_summaries(db):
+    """Build summaries for conversations that existed before the collection
+
+    Existing history is treated as read by every member (baseSeq).
+    Conversations that already have a summary are left untouched.
+    """
+    sender = {"$toString": "$senderId"}
+    receiver = {"$toString": "$receiverId"}
+
+    db.messages.aggregate([
+        {"$match": {"senderId": {"$type": "objectId"}, "receiverId": {"$type": "objectId"}}},
+        {"$sort": {"timestamp": 1}},
+        {"$group": {
+            "_id": {"$concat": ["dm_", {"$min": [sender, receiver]}, "_", {"$max": [sender, receiver]}]},
+            "last": {"$last": "$$ROOT"},
+            "messageCount": {"$sum": 1}
+        }},
+        {"$project": _summary_projection("dm")},
+        {"$merge": {"into": "conversations", "whenMatched": "keepExisting", "whenNotMatched": "insert"}}
+    ])
+
+    db.group_messages.aggregate([
+        {"$match": {"groupId": {"$type": "objectId"}, "senderId": {"$type": "objectId"}}},
+        {"$sort": {"timestamp": 1}},
+        {"$group": {
+            "_id": {"$concat": ["group_", {"$toString": "$groupId"}]},
+            "last": {"$last": "$$ROOT"},
+            "messageCount": {"$sum": 1}
+        }},
+        {"$project": _summary_projection("group")},
+        {"$merge": {"into": "conversations", "whenMatched": "keepExisting", "whenNotMatched": "insert"}}
+    ])
+
+
+def _summary_projection(conversation_type):
+    projection = {
+        "type": {"$literal": conversation_type},
+        "lastMessage": {
+            "id": "$last._id",
+            "text": {"$substrCP": [{"$ifNull": ["$last.text", ""]}, 0, PREVIEW_LENGTH]},
+            "senderId": "$last.senderId",
+            "messageType": {"$ifNull": ["$last.messageType", "text"]},
+            "urgencyLevel": {"$ifNull": ["$last.urgencyLevel", "normal"]},
+            "isEdited": {"$ifNull": ["$last.isEdited", False]},
+            "isDeleted": {"$ifNull": ["$last.isDeleted", False]}
+        },
+        "lastMessageTime": "$last.timestamp",
+        "lastSenderId": "$last.senderId",
+        "messageCount": 1,
+        "baseSeq": "$messageCount"
+    }
+
+    if conversation_type == "dm":
+        projection["participants"] = ["$last.senderId", "$last.receiverId"]
+
+    return projection
+
+
+def visible_in_conversations(field, conversation_values, filters):
+    """Query matching the visible messages of several conversations at once
+
+    `conversation_values` maps a conversation id to the value of `field` on its
+    messages (the conversationId itself, or a groupId); `filters` comes from
+    get_visibility_filters. Conversations without a watermark share one $in.
+    """
+    plain = [value for conversation_id, value in conversation_values.items() if not filters.get(conversation_id)]
+    clauses = [{field: {"$in": plain}}] if plain else []
+    clauses += [
+        {field: value, **filters[conversation_id]}
+        for conversation_id, value in conversation_values.items()
+        if filters.get(conversation_id)
+    ]
+    if not clauses:
+        return {field: {"$in": []}}
+    return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+
+def backfill_clear_watermarks(db):
+    """Turn the deletedBy entries written by "clear chat" into clearedAt watermarks
+
+    Each user's watermark becomes the newest message they had cleared, unless
+    a later one is already recorded. deletedBy itself is left in place for the
+    admin audit views.
+    """
+    sources = (
+        (db.messages, "$conversationId"),
+        (db.group_messages, {"$concat": ["group_", {"$toString": "$groupId"}]})
+    )
+
+    updated = 0
+    for collection, conversation_key in sources:
+        for row in collection.aggregate([
+            {"$match": {"deletedBy.0": {"$exists": True}}},
+            {"$unwind": "$deletedBy"},
+            {"$group": {
+                "_id": {"conversationId": conversation_key, "userId": "$deletedBy"},
+                "clearedAt": {"$max": "$timestamp"}
+            }}
+        ]):
+            conversation_id = row["_id"]["conversationId"]
+            if not conversation_id:
+                continue
+
+            result = db.conversations.update_one(
+                {"_id": conversation_id},
+                {"$max": {f"clearedAt.{row['_id']['userId']}": row["clearedAt"]}},
+                upsert=True
+            )
+            updated += result.modified_count + (1 if result.upserted_id else 0)
+
+    return {"updated": updated}
@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta, timezone
+
+# Per-day message counts kept in the `daily_stats` collection, so the admin
+# dashboard never counts the message collections day by day.
+#
+# One document per UTC day:
+#   {"_id": "YYYY-MM-DD", "privateCount": int, "groupCount": int}
+#
+# Counters are incremented on every send. Past days are read from the rollup;
+# the current day is counted directly so it is exact even while sends are in flight.
+
+DATE_FORMAT = "%Y-%m-%d"
+
+DEFAULT_STATS_DAYS = 7
+MAX_STATS_DAYS = 365
+
+PRIVATE = "privateCount"
+GROUP = "groupCount"
+
+
+def day_key(timestamp):
+    """Rollup key of the UTC day a timestamp falls in"""
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc)
+    return timestamp.strftime(DATE_FORMAT)
+
+
+def record_daily_message(daily_stats_collection, timestamp, counter):
+    """Count one sent message (counter is PRIVATE or GROUP)"""
+    daily_stats_collection.update_one(
+        {"_id": day_key(timestamp)},
+        {"$inc": {counter: 1}},
+        upsert=True
+    )
+
+
+def count_today(db, today):
+    """Private and group messages sent since `today` (00:00 UTC), in one aggregation"""
+    since = {"$match": {"timestamp": {"$gte": today}}}
+    counts = {PRIVATE: 0, GROUP: 0}
+
+    for row in db.messages.aggregate([
+        since,
+        {"$project": {"_id": 0, "counter": {"$literal": PRIVATE}}},
+        {"$unionWith": {"coll": "group_messages", "pipeline": [
+            since,
+            {"$project": {"_id": 0, "counter": {"$literal": GROUP}}}
+        ]}},
+        {"$group": {"_id": "$counter", "count": {"$sum": 1}}}
+    ]):
+        counts[row["_id"]] = row["count"]
+
+    return counts
+
+
+def get_daily_message_counts(db, days=DEFAULT_STATS_DAYS, now=None):
+    """Message counts of the last `days` UTC days, newest first
+
+    Reads at most `days` rollup documents plus today's index range, whatever
+    the size of the message collections.
+    """
+    now = now or datetime.now(timezone.utc)
+    today = now.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    first_day = today - timedelta(days=days - 1)
+
+    rollup = {
+        doc["_id"]: doc
+        for doc in db.daily_stats.find({"_id": {"$gte": day_key(first_day), "$lt": day_key(today)}})
+    }
+    rollup[day_key(today)] = count_today(db, today)
+
+    daily_messages = []
+    for i in range(days):
+        key = day_key(today - timedelta(days=i))
+        doc = rollup.get(key, {})
+        private_count = doc.get(PRIVATE, 0)
+        group_count = doc.get(GROUP, 0)
+
+        daily_messages.append({
+            "date": key,
+            "count": private_count + group_count,
+            "privateCount": private_count,
+            "groupCount": group_count
+        })
+
+    return daily_messages
+
+
+def backfill_daily_stats(db):
+    """Rebuild the rollup from the stored messages
+
+    Overwrites the counters of every day that has messages, so it can be
+    re-run to repair drift.
+    """
+    for collection, counter in ((db.messages, PRIVATE), (db.group_messages, GROUP)):
+        collection.aggregate([
+            {"$match": {"timestamp": {"$type": "date"}}},
+            {"$group": {
+                "_id": {"$dateToString": {"format": DATE_FORMAT, "date": "$timestamp"}},
+                counter: {"$sum": 1}
+            }},
+            {"$merge": {"into": "daily_stats", "whenMatched": "merge", "whenNotMatched": "insert"}}
+        ])
+
+    return {"days": db.daily_stats.count_documents({})}
@@ -0,0 +1,245 @@
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import OperationFailure, PyMongoError
+from message_buckets import BUCKETED_STORAGE
+from user_events import EVENT_RETENTION_DAYS
+
+# Indexes declared per collection, matched to the query shapes used by
+# app.py, category_routes.py and task_routes.py. Names are explicit so the
+# startup check can compare them with what already exists on the server.
+INDEXES = {
+    "users": [
+        # signin / signup / add_contact look users up by email
+        IndexModel([("email", ASCENDING)], name="email"),
+        # create_group collects every user of a department
+        IndexModel([("department", ASCENDING)], name="department"),
+    ],
+    "messages": [
+        # DM history and clear: a single (conversationId, timestamp) range,
+        # with _id as the keyset pagination tie-breaker
+        IndexModel([("conversationId", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)],
+                   name="conversation_timestamp_id"),
+        # Message search: query terms are prefix ranges on searchTokens within a conversation
+        IndexModel([("conversationId", ASCENDING), ("searchTokens", ASCENDING)], name="conversation_search_tokens"),
+        # Admin audit filtered by sender / receiver, paged on (timestamp, _id);
+        # delete_user removes every message sent or received by a user
+        IndexModel([("senderId", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)],
+                   name="sender_timestamp_id"),
+        IndexModel([("receiverId", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)],
+                   name="receiver_timestamp_id"),
+        # Admin audit without a user filter, and today's daily statistics
+        IndexModel([("timestamp", ASCENDING), ("_id", ASCENDING)], name="timestamp_id"),
+    ],
+    "group_messages": [
+        # Group history and clear: {groupId} sorted by (timestamp, _id)
+        IndexModel([("groupId", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)],
+                   name="group_timestamp_id"),
+        # Group message search, same shape as conversation_search_tokens
+        IndexModel([("groupId", ASCENDING), ("searchTokens", ASCENDING)], name="group_search_tokens"),
+        # Admin audit filtered by sender; delete_user removes every group message sent by a user
+        IndexModel([("senderId", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)],
+                   name="sender_timestamp_id"),
+        # Admin audit without a user filter, and today's daily statistics
+        IndexModel([("timestamp", ASCENDING), ("_id", ASCENDING)], name="timestamp_id"),
+    ],
+    "groups": [
+        # delete_group / category cleanup look groups up by creator
+        IndexModel([("createdBy", ASCENDING), ("categoryId", ASCENDING)], name="creator_category"),
+    ],
+    "group_members": [
+        # Membership checks and rosters: {groupId, userId}, one membership per pair
+        IndexModel([("groupId", ASCENDING), ("userId", ASCENDING)], name="group_user", unique=True),
+        # Groups of a user (sidebar, global search, delete_user)
+        IndexModel([("userId", ASCENDING), ("groupId", ASCENDING)], name="user_group"),
+    ],
+    "contacts": [
+        # Contact list and single-contact lookups: {userId, contactId}
+        IndexModel([("userId", ASCENDING), ("contactId", ASCENDING)], name="user_contact"),
+        # delete_user removes the user from other people's contact lists
+        IndexModel([("contactId", ASCENDING)], name="contact"),
+        # Department categories: {userId, department}
+        IndexModel([("userId", ASCENDING), ("department", ASCENDING)], name="user_department"),
+    ],
+    "categories": [
+        # Category lookups: {userId, name, isDepartmentCategory}
+        IndexModel([("userId", ASCENDING), ("name", ASCENDING), ("isDepartmentCategory", ASCENDING)],
+                   name="user_name_department"),
+    ],
+    "tasks": [
+        IndexModel([("groupId", ASCENDING)], name="group"),
+        IndexModel([("assignedTo", ASCENDING)], name="assigned_to"),
+    ],
+    "key_exchanges": [
+        IndexModel([("senderId", ASCENDING), ("recipientId", ASCENDING)], name="sender_recipient"),
+    ],
+    "conversations": [
+        # delete_user removes the summaries of a user's direct conversations
+        IndexModel([("participants", ASCENDING)], name="participants"),
+    ],
+    "user_events": [
+        # Sync reads a user's log in seq order; the unique key guards against a reused seq
+        IndexModel([("userId", ASCENDING), ("seq", ASCENDING)], name="user_seq", unique=True),
+        # Events expire after the retention period
+        IndexModel([("timestamp", ASCENDING)], name="timestamp_ttl",
+                   expireAfterSeconds=EVENT_RETENTION_DAYS * 24 * 3600),
+    ],
+    "uploads": [
+        # Pending chunked uploads expire at expiresAt; finished ones have no expiresAt
+        IndexModel([("expiresAt", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+}
+
+# Indexes of the optional bucketed history layout (see message_buckets.py)
+BUCKET_INDEXES = [
+    # Bucketed history pages: buckets of a conversation by time range
+    IndexModel([("conversationId", ASCENDING), ("maxTs", ASCENDING)], name="conversation_max_ts"),
+    IndexModel([("conversationId", ASCENDING), ("minTs", ASCENDING)], name="conversation_min_ts"),
+    # Appends go to the newest bucket; unique so concurrent writers open a single next bucket
+    IndexModel([("conversationId", ASCENDING), ("bucket", ASCENDING)], name="conversation_bucket",
+               unique=True, partialFilterExpression={"bucket": {"$exists": True}}),
+]
+
+# Only deployments running it (MESSAGE_STORAGE=bucketed) need them
+if BUCKETED_STORAGE:
+    INDEXES["message_buckets"] = BUCKET_INDEXES
+
+
+def ensure_indexes(db, indexes=None):
+    """Create any declared index that is missing
+
+    Safe to run on every startup: existing indexes are left untouched and an
+    index whose name exists with a different key or options (unique, sparse,
+    TTL, partial filter) is reported instead of being rebuilt.
+
+    Returns a report: {"created": [...], "conflicts": [...], "errors": [...]}
+    """
+    indexes = INDEXES if indexes is None else indexes
+    report = {"created": [], "conflicts": [], "errors": []}
+
+    for collection_name, models in indexes.items():
+        collection = db[collection_name]
+
+        try:
+            existing = collection.index_information()
+        except PyMongoError as e:
+            report["errors"].append(f"{collection_name}: {e}")
+            continue
+
+        missing = []
+        for model in models:
+            name = model.document["name"]
+            key = list(model.document["key"].items())
+
+            if name not in existing:
+                missing.append(model)
+                continue
+
+            differences = _differences(existing[name], model.document)
+            if _normalize_key(existing[name]["key"]) != _normalize_key(key):
+                differences.insert(0, "key")
+            if differences:
+                report["conflicts"].append(f"{collection_name}.{name} ({', '.join(differences)})")
+
+        if not missing:
+            continue
+
+        try:
+            created = collection.create_indexes(missing)
+            report["created"].extend(f"{collection_name}.{name}" for name in created)
+        except OperationFailure as e:
+            report["errors"].append(f"{collection_name}: {e}")
+
+    return report
+
+
+# Index options that change what an index enforces or holds
+_COMPARED_OPTIONS = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression")
+
+
+def _normalize_option(option, value):
+    # Missing and false mean the same for flags; TTLs may come back as floats
+    if option in ("unique", "sparse"):
+        return bool(value)
+    if option == "expireAfterSeconds" and value is not None:
+        return int(value)
+    return dict(value) if value is not None else None
+
+
+def _differences(existing, declared):
+    """Options whose existing value differs from the declared one"""
+    return [
+        option for option in _COMPARED_OPTIONS
+        if _normalize_option(option, existing.get(option)) != _normalize_option(option, declared.get(option))
+    ]
+
+
+def _normalize_key(key):
+    # The server may report directions as floats (1.0) for older indexes
+    return [(field, int(direction) if isinstance(direction, float) else direction)
+            for field, direction in key]
+
+
+def find_unused_indexes(db, indexes=None):
+    """Report indexes that exist but are not declared or have never been used
+
+    Usage counters come from $indexStats and reset when mongod restarts, so
+    an index reported as unused shortly after a restart is not necessarily dead.
+
+    Returns {"undeclared": [...], "unused": [...]}
+    """
+    indexes = INDEXES if indexes is None else indexes
+    report = {"undeclared": [], "unused": []}
+
+    for collection_name, models in indexes.items():
+        declared = {model.document["name"] for model in models}
+
+        try:
+            stats = list(db[collection_name].aggregate([{"$indexStats": {}}]))
+        except PyMongoError:
+            continue
+
+        for stat in stats:
+            name = stat["name"]
+            if name == "_id_":
+                continue
+
+            if name not in declared:
+                report["undeclared"].append(f"{collection_name}.{name}")
+            # TTL indexes are used by the expiry monitor, which is not counted
+            if "expireAfterSeconds" in stat.get("spec", {}):
+                continue
+            if stat.get("accesses", {}).get("ops", 0) == 0:
+                report["unused"].append(f"{collection_name}.{name}")
+
+    return report
+
+
+def bootstrap_indexes(db):
+    """Ensure indexes exist and print a short report (called on startup)"""
+    try:
+        report = ensure_indexes(db)
+        usage = find_unused_indexes(db)
+    except PyMongoError as e:
+        print(f"Index bootstrap skipped: {e}")
+        return None
+
+    report.update(usage)
+    # Indexes created just now have not had a chance to be used yet
+    report["unused"] = [name for name in report["unused"] if name not in report["created"]]
+
+    if report["created"]:
+        print(f"Created indexes: {', '.join(report['created'])}")
+    if report["conflicts"]:
+        print(f"Index definitions differ from the declared ones: {', '.join(report['conflicts'])}")
+    if report["errors"]:
+        print(f"Index creation errors: {'; '.join(report['errors'])}")
+    if report["undeclared"]:
+        print(f"Indexes not declared in db_indexes.py: {', '.join(report['undeclared'])}")
+    if report["unused"]:
+        print(f"Indexes with no recorded use since the last mongod restart: {', '.join(report['unused'])}")
+
+    return report
+
+
+if __name__ == '__main__':
+    from app import db
+    bootstrap_indexes(db)
@@ -113,6 +113,121 @@ def upload_file():
     except Exception as e:
         return jsonify({"error": f"Error uploading file: {str(e)}"}), 500
 
+def upload_user():
+    """User id from the Authorization header, or None"""
+    from app import verify_token
+    return verify_token(request.headers.get('Authorization', '').replace('Bearer ', ''))
+
+@file_upload_bp.route('/api/uploads', methods=['POST'])
+def create_chunked_upload():
+    """Start a resumable upload (see chunked_uploads.py)"""
+    from app import uploads_collection
+    from chunked_uploads import create_upload, upload_to_json
+
+    user_id = upload_user()
+    if not user_id:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    data = request.get_json() or {}
+    try:
+        upload = create_upload(
+            uploads_collection,
+            current_app.config['UPLOAD_FOLDER'],
+            user_id,
+            data.get('fileName'),
+            data.get('fileType'),
+            data.get('fileSize'),
+            data.get('conversationId')
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify(upload_to_json(upload)), 201
+
+@file_upload_bp.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_chunked_upload(upload_id):
+    """Progress of an upload: a client resumes from its offset"""
+    from app import uploads_collection
+    from chunked_uploads import get_upload, upload_to_json
+
+    user_id = upload_user()
+    if not user_id:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    upload = get_upload(uploads_collection, upload_id, user_id)
+    if not upload:
+        return jsonify({"error": "Upload not found"}), 404
+
+    return jsonify(upload_to_json(upload)), 200
+
+@file_upload_bp.route('/api/uploads/<upload_id>', methods=['PUT'])
+def put_upload_chunk(upload_id):
+    """Write one chunk (raw request body) at ?offset=, finishing the upload with its last chunk"""
+    from app import uploads_collection
+    from chunked_uploads import get_upload, write_chunk, complete_upload, upload_to_json
+
+    user_id = upload_user()
+    if not user_id:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    upload = get_upload(uploads_collection, upload_id, user_id)
+    if not upload:
+        return jsonify({"error": "Upload not found"}), 404
+
+    try:
+        offset = int(request.args.get('offset', ''))
+    except ValueError:
+        return jsonify({"error": "'offset' must be an integer"}), 400
+
+    if request.content_length is None:
+        return jsonify({"error": "Content-Length is required"}), 411
+
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    try:
+        updated = write_chunk(uploads_collection, upload_folder, upload, offset, request.stream, request.content_length)
+        if updated is None:
+            updated = get_upload(uploads_collection, upload_id, user_id)
+            if not updated:
+                return jsonify({"error": "Upload not found"}), 404
+            if not _fully_received(updated):
+                # Out of step: tell the client where to resume from
+                return jsonify({"error": "Offset does not match the upload", **upload_to_json(updated)}), 409
+
+        # Every byte is there but a previous completion may have failed: complete it now
+        if _fully_received(updated):
+            updated = complete_upload(uploads_collection, upload_folder, updated)
+            if updated is None:
+                return jsonify({"error": "Upload not found"}), 404
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except FileNotFoundError:
+        # Aborted or expired while the chunk was being written
+        return jsonify({"error": "Upload not found"}), 404
+
+    return jsonify(upload_to_json(updated)), 200
+
+def _fully_received(upload):
+    """Pending upload whose every byte has been acknowledged"""
+    from chunked_uploads import PENDING
+    return upload["status"] == PENDING and upload["offset"] == upload["fileSize"]
+
+@file_upload_bp.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def abort_chunked_upload(upload_id):
+    """Cancel a pending upload"""
+    from app import uploads_collection
+    from chunked_uploads import get_upload, abort_upload, PENDING
+
+    user_id = upload_user()
+    if not user_id:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    upload = get_upload(uploads_collection, upload_id, user_id)
+    if not upload or upload["status"] != PENDING:
+        return jsonify({"error": "Upload not found"}), 404
+
+    abort_upload(uploads_collection, current_app.config['UPLOAD_FOLDER'], upload)
+    return jsonify({"success": True}), 200
+
 @file_upload_bp.route('/api/files/<path:filename>', methods=['GET'])
 def serve_file(filename):
     """Serve uploaded files"""
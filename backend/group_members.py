@@ -0,0 +1,178 @@
+from datetime import datetime, timezone
+from bson import ObjectId
+from pymongo import UpdateOne
+
+# Group membership, one document per (group, member) in the `group_members` collection:
+#   {"groupId": ObjectId, "userId": ObjectId, "role": "admin" | "member",
+#    "joinedAt": datetime, "lastRead": datetime}
+#
+# Replaces the embedded `groups.members` array, so membership checks are a
+# single indexed lookup and joining, leaving or reading a large group never
+# rewrites the group document.
+
+MIGRATION_BATCH_SIZE = 1000
+
+
+def _utc_now():
+    return datetime.now(timezone.utc)
+
+
+def is_group_member(group_members_collection, group_id, user_id):
+    """Whether the user belongs to the group"""
+    return group_members_collection.count_documents(
+        {"groupId": ObjectId(group_id), "userId": ObjectId(user_id)}, limit=1
+    ) > 0
+
+
+def find_member_group(groups_collection, group_members_collection, group_id, user_id):
+    """The group document if the user is a member of it, otherwise None"""
+    if not is_group_member(group_members_collection, group_id, user_id):
+        return None
+    return groups_collection.find_one({"_id": ObjectId(group_id)})
+
+
+def member_group_ids(group_members_collection, user_id):
+    """Ids of every group the user belongs to"""
+    return [
+        membership["groupId"]
+        for membership in group_members_collection.find({"userId": ObjectId(user_id)}, {"groupId": 1})
+    ]
+
+
+def group_member_ids(group_members_collection, group_id):
+    """Ids of every member of a group"""
+    return [
+        membership["userId"]
+        for membership in group_members_collection.find({"groupId": ObjectId(group_id)}, {"userId": 1})
+    ]
+
+
+def add_group_members(group_members_collection, group_id, user_ids, roles=None, joined_at=None):
+    """Add users to a group, ignoring those who already belong to it
+
+    `roles` maps a user id string to its role (default "member").
+    Returns the ids (strings) of the users actually added.
+    """
+    roles = roles or {}
+    joined_at = joined_at or _utc_now()
+    user_ids = list(dict.fromkeys(str(user_id) for user_id in user_ids if ObjectId.is_valid(str(user_id))))
+    if not user_ids:
+        return []
+
+    result = group_members_collection.bulk_write([
+        UpdateOne(
+            {"groupId": ObjectId(group_id), "userId": ObjectId(user_id)},
+            {"$setOnInsert": {
+                "role": roles.get(user_id, "member"),
+                "joinedAt": joined_at,
+                "lastRead": joined_at
+            }},
+            upsert=True
+        )
+        for user_id in user_ids
+    ], ordered=False)
+
+    return [user_ids[index] for index in result.upserted_ids]
+
+
+def remove_group_member(group_members_collection, group_id, user_id):
+    """Remove a user from a group; returns whether they were a member"""
+    result = group_members_collection.delete_one({"groupId": ObjectId(group_id), "userId": ObjectId(user_id)})
+    return result.deleted_count > 0
+
+
+def remove_group_members(group_members_collection, group_id):
+    """Remove every member of a deleted group"""
+    group_members_collection.delete_many({"groupId": ObjectId(group_id)})
+
+
+def remove_user_memberships(group_members_collection, user_id):
+    """Remove a deleted user from every group"""
+    group_members_collection.delete_many({"userId": ObjectId(user_id)})
+
+
+def touch_last_read(group_members_collection, group_id, user_id, when=None):
+    """Record when the member last read the group history"""
+    group_members_collection.update_one(
+        {"groupId": ObjectId(group_id), "userId": ObjectId(user_id)},
+        {"$set": {"lastRead": when or _utc_now()}}
+    )
+
+
+def group_rosters(group_members_collection, group_ids, limit=None):
+    """Members of many groups in one query: {group_id: (member_count, [memberships])}
+
+    With `limit`, only the first `limit` members (by join date) are returned per group.
+    Memberships only carry `userId` and `role`.
+    """
+    group_ids = list(group_ids)
+    if not group_ids:
+        return {}
+
+    rosters = {group_id: (0, []) for group_id in group_ids}
+
+    if limit is None:
+        for membership in group_members_collection.find(
+                {"groupId": {"$in": group_ids}}, {"groupId": 1, "userId": 1, "role": 1}).sort(
+                [("groupId", 1), ("joinedAt", 1), ("_id", 1)]):
+            count, members = rosters[membership["groupId"]]
+            members.append(membership)
+            rosters[membership["groupId"]] = (count + 1, members)
+        return rosters
+
+    # $topN keeps `limit` members per group while grouping, instead of pushing whole rosters
+    group = {"_id": "$groupId", "count": {"$sum": 1}}
+    if limit > 0:
+        group["members"] = {"$topN": {
+            "n": limit,
+            "sortBy": {"joinedAt": 1, "_id": 1},
+            "output": {"userId": "$userId", "role": "$role"}
+        }}
+
+    for row in group_members_collection.aggregate([
+        {"$match": {"groupId": {"$in": group_ids}}},
+        {"$group": group}
+    ]):
+        rosters[row["_id"]] = (row["count"], row.get("members", []))
+    return rosters
+
+
+def migrate_embedded_members(db):
+    """Move the embedded groups.members arrays into group_members
+
+    Existing memberships are kept as they are; the array is removed from
+    each group once its members have been copied.
+    """
+    moved = 0
+    migrated_groups = 0
+
+    for group in db.groups.find({"members": {"$exists": True}}, {"members": 1, "createdAt": 1}):
+        batch = []
+        for member in group.get("members") or []:
+            # Very old socket handlers stored {"id": ...} instead of {"userId": ...}
+            user_id = member.get("userId") or member.get("id")
+            if not user_id or not ObjectId.is_valid(str(user_id)):
+                continue
+
+            joined_at = member.get("joinedAt") or group.get("createdAt") or _utc_now()
+            batch.append(UpdateOne(
+                {"groupId": group["_id"], "userId": ObjectId(str(user_id))},
+                {"$setOnInsert": {
+                    "role": member.get("role", "member"),
+                    "joinedAt": joined_at,
+                    "lastRead": member.get("lastRead") or joined_at
+                }},
+                upsert=True
+            ))
+
+            if len(batch) >= MIGRATION_BATCH_SIZE:
+                moved += db.group_members.bulk_write(batch, ordered=False).upserted_count
+                batch = []
+
+        if batch:
+            moved += db.group_members.bulk_write(batch, ordered=False).upserted_count
+
+        db.groups.update_one({"_id": group["_id"]}, {"$unset": {"members": ""}})
+        migrated_groups += 1
+
+    return {"groups": migrated_groups, "memberships": moved}
@@ -0,0 +1,170 @@
+import re
+from datetime import datetime, timezone
+from bson import ObjectId
+from conversations import dm_conversation_id, group_conversation_id
+
+# Filters of the admin message views (/api/admin/messages and
+# /api/admin/group-messages). Pages themselves come from pagination.fetch_page.
+#
+# Who deleted a message for themselves is read from the conversation summaries:
+# a user's clearedAt watermark covers every message up to it, and hiddenMessages
+# lists single hidden ones. Messages cleared before the watermarks existed still
+# carry a deletedBy array.
+
+# Admins browse larger pages than chat clients
+DEFAULT_AUDIT_PAGE_SIZE = 100
+
+URGENCY_LEVELS = {"low", "normal", "high", "urgent"}
+
+ENCRYPTED_PLACEHOLDER = "End-to-End Encrypted Message"
+
+
+def _object_id(args, name):
+    value = args.get(name)
+    if not ObjectId.is_valid(value):
+        raise ValueError(f"'{name}' must be a valid id")
+    return ObjectId(value)
+
+
+def _date(args, name):
+    value = args.get(name)
+    try:
+        date = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError(f"'{name}' must be an ISO 8601 date")
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+
+def parse_audit_filters(args, group_messages=False):
+    """Build the message query from request args, raising ValueError on bad input
+
+    Supported args: senderId, receiverId (direct messages) or groupId (group
+    messages), from / to (ISO dates, `to` exclusive), urgencyLevel,
+    encrypted (true / false) and fileType (a MIME type such as image/png, or
+    just its top-level type such as image).
+    """
+    query = {}
+
+    if args.get('senderId'):
+        query["senderId"] = _object_id(args, 'senderId')
+
+    target = 'groupId' if group_messages else 'receiverId'
+    if args.get(target):
+        query[target] = _object_id(args, target)
+
+    timestamp = {}
+    if args.get('from'):
+        timestamp["$gte"] = _date(args, 'from')
+    if args.get('to'):
+        timestamp["$lt"] = _date(args, 'to')
+    if timestamp:
+        query["timestamp"] = timestamp
+
+    urgency_level = args.get('urgencyLevel')
+    if urgency_level:
+        if urgency_level not in URGENCY_LEVELS:
+            raise ValueError(f"'urgencyLevel' must be one of {', '.join(sorted(URGENCY_LEVELS))}")
+        # Messages predating urgency levels are normal
+        query["urgencyLevel"] = {"$in": ["normal", None]} if urgency_level == "normal" else urgency_level
+
+    encrypted = args.get('encrypted')
+    if encrypted:
+        if encrypted not in ('true', 'false'):
+            raise ValueError("'encrypted' must be true or false")
+        query["encrypted"] = True if encrypted == 'true' else {"$ne": True}
+
+    file_type = args.get('fileType')
+    if file_type:
+        if '/' in file_type:
+            query["fileType"] = file_type
+        else:
+            query["fileType"] = re.compile("^" + re.escape(file_type) + "/")
+
+    return query
+
+
+def audit_conversation_id(msg):
+    """Conversation summary id of a direct or group message"""
+    if msg.get("groupId"):
+        return group_conversation_id(msg["groupId"])
+    return msg.get("conversationId") or dm_conversation_id(msg["senderId"], msg["receiverId"])
+
+
+def load_audit_summaries(conversations_collection, messages):
+    """Clear watermarks and hidden messages of the conversations of a page, in one query"""
+    return {
+        summary["_id"]: summary
+        for summary in conversations_collection.find(
+            {"_id": {"$in": list({audit_conversation_id(msg) for msg in messages})}},
+            {"clearedAt": 1, "hiddenMessages": 1}
+        )
+    }
+
+
+def _as_utc(value):
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def deleted_by_ids(msg, summaries):
+    """Ids of the users who deleted a message for themselves, in a stable order"""
+    user_ids = [str(user_id) for user_id in msg.get("deletedBy") or []]
+
+    summary = summaries.get(audit_conversation_id(msg)) or {}
+    timestamp = _as_utc(msg["timestamp"])
+    for user_id, cleared_at in (summary.get("clearedAt") or {}).items():
+        if cleared_at and timestamp <= _as_utc(cleared_at):
+            user_ids.append(user_id)
+    for user_id, hidden in (summary.get("hiddenMessages") or {}).items():
+        if msg["_id"] in (hidden or []):
+            user_ids.append(user_id)
+
+    return list(dict.fromkeys(user_ids))
+
+
+def audit_user_ids(messages, summaries):
+    """Every user id a page of messages refers to (senders, receivers, deleters)"""
+    user_ids = set()
+    for msg in messages:
+        user_ids.add(msg.get("senderId"))
+        user_ids.add(msg.get("receiverId"))
+        user_ids.update(deleted_by_ids(msg, summaries))
+    user_ids.discard(None)
+    return user_ids
+
+
+def format_audit_message(msg, profiles, summaries):
+    """Fields shared by both admin message views
+
+    profiles comes from get_user_profiles and summaries from load_audit_summaries.
+    """
+    sender_id = str(msg["senderId"])
+    sender = profiles.get(sender_id)
+
+    # Include information about who deleted the message
+    deleted_by = []
+    for deleted_user_id in deleted_by_ids(msg, summaries):
+        deleted_user = profiles.get(deleted_user_id)
+        if deleted_user:
+            deleted_by.append({"id": deleted_user_id, "name": deleted_user["name"]})
+
+    # Only hide messages that are actually encrypted (not just because user has encryption enabled)
+    is_encrypted = msg.get("encrypted", False)
+
+    return {
+        "id": str(msg["_id"]),
+        "senderId": sender_id,
+        "senderName": sender["name"] if sender else "Unknown",
+        "text": ENCRYPTED_PLACEHOLDER if is_encrypted else msg["text"],
+        "timestamp": msg["timestamp"].isoformat(),
+        "isDeleted": msg.get("isDeleted", False),
+        "deletedBy": deleted_by,
+        "fileUrl": msg.get("fileUrl"),
+        "fileType": msg.get("fileType"),
+        "fileName": msg.get("fileName"),
+        "encrypted": is_encrypted,
+        "urgencyLevel": msg.get("urgencyLevel", "normal")
+    }
@@ -0,0 +1,274 @@
+import os
+from datetime import timedelta, timezone
+from bson import ObjectId
+from pymongo import DESCENDING, ASCENDING
+from pymongo.errors import DuplicateKeyError
+from conversations import DELETED_MESSAGE_TEXT
+
+# Optional bucketed layout for message history.
+#
+# With MESSAGE_STORAGE=bucketed, every stored message is also appended to a
+# bucket document of its conversation in `message_buckets`:
+#   {
+#       "_id": ObjectId,
+#       "conversationId": "dm_..." | "group_...",
+#       "bucket": int,                 # 0, 1, 2... in order of creation, unique per conversation
+#       "count": int,                  # messages in the bucket, at most BUCKET_SIZE
+#       "minTs": datetime, "maxTs": datetime,
+#       "messages": [message, ...]     # stored message documents, oldest first
+#   }
+#
+# Messages are always appended to the highest numbered bucket; once it is full
+# the next number is upserted. The unique (conversationId, bucket) index makes
+# concurrent writers agree on a single new bucket.
+#
+# History pages are then read from a couple of bucket documents instead of one
+# document (and index entry) per message. The flat `messages` and
+# `group_messages` collections stay the source of truth for search, admin
+# views and statistics; edits and deletes patch the message in place inside
+# its bucket. The default "flat" mode does not touch buckets at all.
+
+MESSAGE_STORAGE = os.getenv('MESSAGE_STORAGE', 'flat')
+BUCKETED_STORAGE = MESSAGE_STORAGE == 'bucketed'
+
+# Messages per bucket
+BUCKET_SIZE = int(os.getenv('MESSAGE_BUCKET_SIZE', 200))
+
+# Slack between a message id's generation time and the message timestamp
+PATCH_WINDOW = timedelta(minutes=5)
+
+# Fields that are not needed to render history
+_UNBUCKETED_FIELDS = ("searchTokens", "conversationId")
+
+
+def _bucketed(message):
+    return {key: value for key, value in message.items() if key not in _UNBUCKETED_FIELDS}
+
+
+def _as_utc(value):
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def append_message(buckets_collection, conversation_id, message):
+    """Add a stored message (with its _id) to the newest bucket of its conversation"""
+    if not BUCKETED_STORAGE:
+        return
+
+    timestamp = message["timestamp"]
+    update = {
+        "$push": {"messages": _bucketed(message)},
+        "$inc": {"count": 1},
+        "$min": {"minTs": timestamp},
+        "$max": {"maxTs": timestamp}
+    }
+
+    latest = buckets_collection.find_one(
+        {"conversationId": conversation_id}, {"bucket": 1}, sort=[("bucket", DESCENDING)]
+    )
+    number = (latest.get("bucket") or 0) if latest else 0
+    while True:
+        try:
+            buckets_collection.update_one(
+                {"conversationId": conversation_id, "bucket": number, "count": {"$lt": BUCKET_SIZE}},
+                update,
+                upsert=True
+            )
+            return
+        except DuplicateKeyError:
+            # The bucket exists: either it is full, or another writer has just created it
+            if buckets_collection.count_documents(
+                    {"conversationId": conversation_id, "bucket": number, "count": {"$gte": BUCKET_SIZE}}):
+                number += 1
+
+
+def patch_message(buckets_collection, conversation_id, message_id, fields):
+    """Apply a $set of message fields to a bucketed message (edit / delete)"""
+    if not BUCKETED_STORAGE:
+        return
+
+    # The id is generated right after the message timestamp, which narrows the
+    # lookup to the bucket(s) covering that moment instead of every bucket of
+    # the conversation
+    message_id = ObjectId(message_id)
+    created_at = message_id.generation_time
+
+    fields = {key: value for key, value in fields.items() if key not in _UNBUCKETED_FIELDS}
+    buckets_collection.update_one(
+        {
+            "conversationId": conversation_id,
+            "maxTs": {"$gte": created_at - PATCH_WINDOW},
+            "minTs": {"$lte": created_at + PATCH_WINDOW},
+            "messages._id": message_id
+        },
+        {"$set": {f"messages.$.{key}": value for key, value in fields.items()}}
+    )
+
+
+def mark_edited(buckets_collection, conversation_id, message_id, new_text):
+    """Mirror a message edit into its bucket"""
+    patch_message(buckets_collection, conversation_id, message_id, {"text": new_text, "isEdited": True})
+
+
+def mark_deleted(buckets_collection, conversation_id, message_id):
+    """Mirror a message deletion into its bucket"""
+    patch_message(buckets_collection, conversation_id, message_id, {
+        "isDeleted": True,
+        "text": DELETED_MESSAGE_TEXT,
+        "fileUrl": None,
+        "fileType": None,
+        "fileName": None
+    })
+
+
+def drop_conversation(buckets_collection, conversation_id):
+    """Remove the buckets of a deleted conversation"""
+    if not BUCKETED_STORAGE:
+        return
+
+    buckets_collection.delete_many({"conversationId": conversation_id})
+
+
+def drop_sender_messages(buckets_collection, sender_id):
+    """Remove every bucketed message sent by a deleted user"""
+    if not BUCKETED_STORAGE:
+        return
+
+    sender_id = ObjectId(sender_id)
+    bucket_ids = buckets_collection.distinct("_id", {"messages.senderId": sender_id})
+    if not bucket_ids:
+        return
+
+    # count / minTs / maxTs are recomputed from what is left
+    buckets_collection.update_many({"_id": {"$in": bucket_ids}}, [
+        {"$set": {"messages": {"$filter": {
+            "input": "$messages",
+            "cond": {"$ne": ["$$this.senderId", sender_id]}
+        }}}},
+        {"$set": {
+            "count": {"$size": "$messages"},
+            "minTs": {"$min": "$messages.timestamp"},
+            "maxTs": {"$max": "$messages.timestamp"}
+        }}
+    ])
+    buckets_collection.delete_many({"_id": {"$in": bucket_ids}, "count": 0})
+
+
+def _visible(message, cleared_at, hidden):
+    if cleared_at is not None and _as_utc(message["timestamp"]) <= cleared_at:
+        return False
+    return message["_id"] not in hidden
+
+
+def _in_page(message, direction, cursor):
+    if cursor is None:
+        return True
+    key = (_as_utc(message["timestamp"]), message["_id"])
+    return key < cursor if direction == "before" else key > cursor
+
+
+def fetch_bucketed_page(buckets_collection, conversation_id, direction, cursor, limit,
+                        cleared_at=None, hidden=()):
+    """Bucketed equivalent of pagination.fetch_page for one conversation
+
+    Buckets are read newest first ("before") or oldest first ("after") and
+    only as far as needed: reading stops once the page is full and the next
+    bucket cannot contain a message that belongs to it.
+
+    Returns (messages, has_more) with messages in chronological order.
+    """
+    cleared_at = _as_utc(cleared_at) if cleared_at else None
+    hidden = set(hidden or ())
+    cursor = (_as_utc(cursor[0]), cursor[1]) if cursor else None
+    newest_first = direction == "before"
+
+    bucket_filter = {"conversationId": conversation_id}
+    if cursor is not None:
+        bucket_filter["minTs" if newest_first else "maxTs"] = {"$lte" if newest_first else "$gte": cursor[0]}
+    if cleared_at is not None:
+        bucket_filter.setdefault("maxTs", {})["$gt"] = cleared_at
+
+    order = DESCENDING if newest_first else ASCENDING
+    buckets = buckets_collection.find(bucket_filter).sort("maxTs" if newest_first else "minTs", order)
+
+    def sort_key(message):
+        return _as_utc(message["timestamp"]), message["_id"]
+
+    candidates = []
+    for bucket in buckets:
+        if len(candidates) > limit:
+            boundary = sort_key(candidates[limit])[0]
+            if newest_first and _as_utc(bucket["maxTs"]) < boundary:
+                break
+            if not newest_first and _as_utc(bucket["minTs"]) > boundary:
+                break
+
+        candidates.extend(
+            message for message in bucket.get("messages", [])
+            if _in_page(message, direction, cursor) and _visible(message, cleared_at, hidden)
+        )
+        candidates.sort(key=sort_key, reverse=newest_first)
+        del candidates[limit + 1:]
+
+    has_more = len(candidates) > limit
+    messages = candidates[:limit]
+    if newest_first:
+        messages.reverse()
+
+    return messages, has_more
+
+
+def rebuild_buckets(db):
+    """(Re)build message_buckets from the flat collections
+
+    Reads each collection once in (conversation, timestamp, _id) order, so it
+    follows the existing history indexes.
+    """
+    db.message_buckets.delete_many({})
+    created = 0
+
+    sources = (
+        (db.messages, "conversationId", lambda message: message.get("conversationId")),
+        (db.group_messages, "groupId", lambda message: f"group_{message['groupId']}")
+    )
+
+    for collection, field, conversation_of in sources:
+        batch = []
+        bucket = None
+        number = 0
+
+        for message in collection.find({field: {"$exists": True}}).sort(
+                [(field, ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)]):
+            conversation_id = conversation_of(message)
+            if not conversation_id or not message.get("timestamp"):
+                continue
+
+            if bucket is None or bucket["conversationId"] != conversation_id or bucket["count"] >= BUCKET_SIZE:
+                number = number + 1 if bucket is not None and bucket["conversationId"] == conversation_id else 0
+                bucket = {
+                    "_id": ObjectId(),
+                    "conversationId": conversation_id,
+                    "bucket": number,
+                    "count": 0,
+                    "minTs": message["timestamp"],
+                    "maxTs": message["timestamp"],
+                    "messages": []
+                }
+                batch.append(bucket)
+
+            bucket["messages"].append(_bucketed(message))
+            bucket["count"] += 1
+            bucket["maxTs"] = message["timestamp"]
+
+            # Flush completed buckets, keeping the one still being filled
+            if len(batch) > 100:
+                db.message_buckets.insert_many(batch[:-1])
+                created += len(batch) - 1
+                batch = batch[-1:]
+
+        if batch:
+            db.message_buckets.insert_many(batch)
+            created += len(batch)
+
+    return {"buckets": created}
@@ -0,0 +1,242 @@
+from bson import ObjectId
+from activity_tracker import activity_tracker
+from conversations import (dm_conversation_id, group_conversation_id, record_message, record_edit, record_delete,
+                           DELETED_MESSAGE_TEXT)
+from daily_stats import record_daily_message, PRIVATE, GROUP
+from group_members import group_member_ids
+from message_buckets import append_message, mark_edited, mark_deleted
+from search_index import tokenize
+from user_events import record_event, MESSAGE, MESSAGE_EDITED, MESSAGE_DELETED, GROUP_MESSAGE
+
+# Message documents, socket payloads and derived writes shared by both server
+# modes (app.py and asgi_server.py).
+#
+# A send, edit or delete is: build the document or update (below), write it
+# to the message collection, emit the payload, then run the derived writes
+# (conversation summary, history bucket, daily stats, lastActivity and the
+# sync log). Each mode only does the I/O around these steps its own way.
+
+
+def message_type_of(file_type):
+    """image / video / file, from a MIME type"""
+    if file_type.startswith('image/'):
+        return "image"
+    if file_type.startswith('video/'):
+        return "video"
+    return "file"
+
+
+def _attachment_type(file_url, file_type, file_name):
+    return message_type_of(file_type) if file_url and file_type and file_name else "text"
+
+
+def direct_message_document(user_id, receiver_id, data, file_url, file_type, file_name, timestamp):
+    """Direct message to store, from a send_message payload and its resolved attachment"""
+    text = data.get('text', '')
+    encrypted = data.get('encrypted', False)
+    message = {
+        # The id is known up front so the payload does not wait for the insert
+        "_id": ObjectId(),
+        "conversationId": dm_conversation_id(user_id, receiver_id),
+        "senderId": ObjectId(user_id),
+        "receiverId": ObjectId(receiver_id),
+        "text": text,
+        "searchTokens": tokenize(text),
+        "timestamp": timestamp,
+        "fileUrl": file_url,
+        "fileType": file_type,
+        "fileName": file_name,
+        "messageType": _attachment_type(file_url, file_type, file_name),
+        "encrypted": encrypted,
+        "urgencyLevel": data.get('urgencyLevel', 'normal')
+    }
+
+    # The original text is kept for admin viewing; clients decrypt encryptedData
+    if encrypted and data.get('encryptedData'):
+        message["encryptedData"] = data['encryptedData']
+        message["iv"] = data.get('iv')
+    return message
+
+
+def direct_message_payload(message, sender_name):
+    """receive_message payload of a stored direct message"""
+    payload = {
+        "id": str(message["_id"]),
+        "sender": str(message["senderId"]),
+        "receiver": str(message["receiverId"]),
+        "text": message["text"],
+        "timestamp": message["timestamp"].isoformat(),
+        "fileUrl": message["fileUrl"],
+        "fileType": message["fileType"],
+        "fileName": message["fileName"],
+        "messageType": message["messageType"],
+        "senderName": sender_name,
+        "encrypted": message["encrypted"],
+        "urgencyLevel": message["urgencyLevel"]
+    }
+    if "encryptedData" in message:
+        payload["encryptedData"] = message["encryptedData"]
+        payload["iv"] = message["iv"]
+    return payload
+
+
+def record_direct_message(db, message, payload, timer=None):
+    """Derived writes of a direct message, once it has been emitted"""
+    sender_id, receiver_id = message["senderId"], message["receiverId"]
+    conversation_id = message["conversationId"]
+
+    # Keep the conversation summary (last message, unread counters) current
+    record_message(db.conversations, conversation_id, message["_id"], message,
+                   participants=[sender_id, receiver_id])
+    append_message(db.message_buckets, conversation_id, message)
+    record_daily_message(db.daily_stats, message["timestamp"], PRIVATE)
+
+    # Move the conversation up both contact lists (written by the next activity flush)
+    activity_tracker.record_contacts(str(sender_id), str(receiver_id), message["timestamp"])
+    if timer:
+        timer.stage("history")
+
+    # Log it for both users so reconnecting clients can catch up through sync
+    record_event(db, [sender_id, receiver_id], MESSAGE, payload)
+    if timer:
+        timer.stage("events")
+
+
+def group_message_document(user_id, group_id, data, file_url, file_type, file_name, timestamp):
+    """Group message to store, from a send_group_message payload and its resolved attachment"""
+    text = data.get('text', '')
+    return {
+        "_id": ObjectId(),
+        "groupId": ObjectId(group_id),
+        "senderId": ObjectId(user_id),
+        "text": text,
+        "searchTokens": tokenize(text),
+        "timestamp": timestamp,
+        "fileUrl": file_url,
+        "fileType": file_type,
+        "fileName": file_name,
+        "messageType": _attachment_type(file_url, file_type, file_name),
+        "urgencyLevel": data.get('urgencyLevel', 'normal')
+    }
+
+
+def group_message_payload(message, sender_name):
+    """receive_group_message payload of a stored group message"""
+    return {
+        "id": str(message["_id"]),
+        "groupId": str(message["groupId"]),
+        "sender": str(message["senderId"]),
+        "senderName": sender_name,
+        "text": message["text"],
+        "timestamp": message["timestamp"].isoformat(),
+        "fileUrl": message["fileUrl"],
+        "fileType": message["fileType"],
+        "fileName": message["fileName"],
+        "messageType": message["messageType"],
+        "urgencyLevel": message["urgencyLevel"]
+    }
+
+
+def record_group_message(db, message, payload, timer=None):
+    """Derived writes of a group message, once it has been emitted"""
+    group_id = str(message["groupId"])
+    conversation_id = group_conversation_id(group_id)
+
+    record_message(db.conversations, conversation_id, message["_id"], message)
+    append_message(db.message_buckets, conversation_id, message)
+    record_daily_message(db.daily_stats, message["timestamp"], GROUP)
+
+    # Update group's lastActivity for proper sorting (written by the next activity flush)
+    activity_tracker.record_group(group_id, message["timestamp"])
+    if timer:
+        timer.stage("history")
+
+    record_event(db, group_member_ids(db.group_members, group_id), GROUP_MESSAGE, payload)
+    if timer:
+        timer.stage("events")
+
+
+def edit_update(new_text):
+    """Update applied to an edited message"""
+    return {"$set": {"text": new_text, "searchTokens": tokenize(new_text), "isEdited": True}}
+
+
+def delete_update():
+    """Update applied to a message deleted for everyone"""
+    return {"$set": {
+        "isDeleted": True,
+        "text": DELETED_MESSAGE_TEXT,
+        "searchTokens": [],
+        "fileUrl": None,
+        "fileType": None,
+        "fileName": None
+    }}
+
+
+def edit_payload(message, new_text, sender_name=None):
+    """message_edited payload; sender_name is only sent to groups"""
+    if message.get("groupId"):
+        return {
+            "groupId": str(message["groupId"]),
+            "messageId": str(message["_id"]),
+            "newText": new_text,
+            "isEdited": True,
+            "senderName": sender_name,
+            "sender": str(message["senderId"])
+        }
+    return {
+        "id": str(message["_id"]),
+        "sender": str(message["senderId"]),
+        "receiver": str(message["receiverId"]),
+        "text": new_text,
+        "isEdited": True
+    }
+
+
+def delete_payload(message, sender_name=None):
+    """message_deleted payload; sender_name is only sent to groups"""
+    if message.get("groupId"):
+        return {
+            "groupId": str(message["groupId"]),
+            "messageId": str(message["_id"]),
+            "senderName": sender_name,
+            "sender": str(message["senderId"]),
+            "isDeleted": True
+        }
+    return {
+        "id": str(message["_id"]),
+        "sender": str(message["senderId"]),
+        "receiver": str(message["receiverId"]),
+        "isDeleted": True
+    }
+
+
+def payload_rooms(message):
+    """Rooms an edit or delete of the message is emitted to"""
+    if message.get("groupId"):
+        return [f"group_{message['groupId']}"]
+    return [str(message["senderId"]), str(message["receiverId"])]
+
+
+def _conversation_and_audience(db, message):
+    if message.get("groupId"):
+        group_id = str(message["groupId"])
+        return group_conversation_id(group_id), group_member_ids(db.group_members, group_id)
+    sender_id, receiver_id = message["senderId"], message["receiverId"]
+    return dm_conversation_id(sender_id, receiver_id), [sender_id, receiver_id]
+
+
+def record_message_edit(db, message, new_text, payload):
+    """Derived writes of an edit, once it has been emitted"""
+    conversation_id, audience = _conversation_and_audience(db, message)
+    record_edit(db.conversations, conversation_id, message["_id"], new_text)
+    mark_edited(db.message_buckets, conversation_id, message["_id"], new_text)
+    record_event(db, audience, MESSAGE_EDITED, payload)
+
+
+def record_message_delete(db, message, payload):
+    """Derived writes of a delete, once it has been emitted"""
+    conversation_id, audience = _conversation_and_audience(db, message)
+    record_delete(db.conversations, conversation_id, message["_id"])
+    mark_deleted(db.message_buckets, conversation_id, message["_id"])
+    record_event(db, audience, MESSAGE_DELETED, payload)
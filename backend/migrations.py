@@ -0,0 +1,43 @@
+"""One-off data migrations
+
+Usage:
+    python migrations.py                  # list available migrations
+    python migrations.py <name> [<name>]  # run the given migrations in order
+"""
+import sys
+from conversations import backfill_dm_conversation_ids, backfill_conversation_summaries, backfill_clear_watermarks
+from search_index import backfill_search_tokens
+from daily_stats import backfill_daily_stats
+from group_members import migrate_embedded_members
+from message_buckets import rebuild_buckets
+
+# Migration name -> function taking the database handle
+MIGRATIONS = {
+    "dm_conversation_ids": backfill_dm_conversation_ids,
+    "conversation_summaries": backfill_conversation_summaries,
+    "clear_watermarks": backfill_clear_watermarks,
+    "search_tokens": backfill_search_tokens,
+    "daily_stats": backfill_daily_stats,
+    "group_members": migrate_embedded_members,
+    "message_buckets": rebuild_buckets,
+}
+
+def run_migrations(db, names):
+    """Run the named migrations against the given database"""
+    for name in names:
+        if name not in MIGRATIONS:
+            raise ValueError(f"Unknown migration: {name}")
+
+        print(f"Running migration: {name}")
+        result = MIGRATIONS[name](db)
+        print(f"Migration {name} finished: {result}")
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Available migrations:")
+        for migration_name in MIGRATIONS:
+            print(f"  {migration_name}")
+        sys.exit(0)
+
+    from app import db
+    run_migrations(db, sys.argv[1:])
@@ -0,0 +1,101 @@
+import os
+from datetime import datetime, timezone
+from bson import ObjectId
+from bson.errors import InvalidId
+
+# Keyset pagination over (timestamp, _id) for message history.
+#
+# A cursor is "<milliseconds since epoch>_<message id>", which is exact since
+# MongoDB stores datetimes with millisecond precision.
+
+DEFAULT_PAGE_SIZE = int(os.getenv('MESSAGE_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.getenv('MESSAGE_MAX_PAGE_SIZE', 200))
+
+# Response headers carrying the cursors (the body stays a plain message array)
+PAGINATION_HEADERS = ['X-Before-Cursor', 'X-After-Cursor', 'X-Has-More']
+
+
+def encode_cursor(message):
+    """Build a cursor pointing at a message document"""
+    timestamp = message["timestamp"]
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return f"{int(timestamp.timestamp() * 1000)}_{message['_id']}"
+
+
+def decode_cursor(cursor):
+    """Parse a cursor into (timestamp, ObjectId), raising ValueError if malformed"""
+    try:
+        millis, message_id = cursor.split('_', 1)
+        timestamp = datetime.fromtimestamp(int(millis) / 1000, tz=timezone.utc)
+        return timestamp, ObjectId(message_id)
+    except (AttributeError, ValueError, InvalidId, OverflowError, OSError):
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+def parse_page_args(args, default_limit=DEFAULT_PAGE_SIZE):
+    """Read `before`, `after` and `limit` from request args
+
+    Returns (direction, cursor, limit) where direction is "before" or "after"
+    and cursor is None for the latest page. Raises ValueError on bad input.
+    """
+    before = args.get('before')
+    after = args.get('after')
+
+    if before and after:
+        raise ValueError("Use either 'before' or 'after', not both")
+
+    try:
+        limit = int(args.get('limit', default_limit))
+    except (TypeError, ValueError):
+        raise ValueError("'limit' must be an integer")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    if after:
+        return "after", decode_cursor(after), limit
+    return "before", decode_cursor(before) if before else None, limit
+
+
+def keyset_filter(direction, cursor):
+    """Query filter selecting messages strictly before/after the cursor"""
+    if cursor is None:
+        return {}
+
+    timestamp, message_id = cursor
+    op = "$lt" if direction == "before" else "$gt"
+    return {"$or": [
+        {"timestamp": {op: timestamp}},
+        {"timestamp": timestamp, "_id": {op: message_id}}
+    ]}
+
+
+def fetch_page(collection, query, direction, cursor, limit):
+    """Fetch one page of messages in chronological order
+
+    Only limit + 1 documents are read; the extra one tells whether more
+    messages exist in the requested direction.
+
+    Returns (messages, has_more)
+    """
+    page_filter = keyset_filter(direction, cursor)
+    if page_filter:
+        query = {"$and": [query, page_filter]}
+
+    order = -1 if direction == "before" else 1
+    messages = list(collection.find(query).sort([("timestamp", order), ("_id", order)]).limit(limit + 1))
+
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if direction == "before":
+        messages.reverse()
+
+    return messages, has_more
+
+
+def pagination_headers(messages, has_more):
+    """Cursor headers for a page returned by fetch_page"""
+    headers = {'X-Has-More': 'true' if has_more else 'false'}
+    if messages:
+        headers['X-Before-Cursor'] = encode_cursor(messages[0])
+        headers['X-After-Cursor'] = encode_cursor(messages[-1])
+    return headers
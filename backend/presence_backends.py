@@ -0,0 +1,152 @@
+import os
+import threading
+
+# Where the set of connected users lives.
+#
+# A single server process keeps it in memory (LocalPresenceBackend). When
+# several workers serve Socket.IO behind a load balancer, a user's devices may
+# be connected to different workers, so "is this user online" and "was this
+# their first / last connection" must be answered from shared state: set
+# PRESENCE_BACKEND=redis://host:6379/0 to use RedisPresenceBackend (requires
+# the `redis` package).
+#
+# Connections are tracked as (user id, sid) pairs; both backends report when a
+# user's first connection opens and when their last one closes, so online and
+# offline changes are published exactly once whichever worker sees them.
+
+PRESENCE_BACKEND = os.getenv('PRESENCE_BACKEND', 'local')
+
+# Identifies this worker in the shared state. Required with the Redis backend,
+# and must be stable across restarts (e.g. the port): a restarted worker drops
+# the connections recorded under its id, which a fresh pid would never find
+WORKER_ID = os.getenv('WORKER_ID')
+
+
+class LocalPresenceBackend:
+    """In-process presence, for a single worker (and tests)"""
+
+    def __init__(self):
+        self._user_sids = {}
+        self._lock = threading.Lock()
+
+    def add_connection(self, user_id, sid):
+        """Register a connection; returns True if it is the user's first one"""
+        with self._lock:
+            sids = self._user_sids.setdefault(user_id, set())
+            came_online = not sids
+            sids.add(sid)
+            return came_online
+
+    def remove_connection(self, user_id, sid):
+        """Forget a connection; returns True if it was the user's last one"""
+        with self._lock:
+            sids = self._user_sids.get(user_id)
+            if not sids or sid not in sids:
+                return False
+            sids.discard(sid)
+            if sids:
+                return False
+            del self._user_sids[user_id]
+            return True
+
+    def is_online(self, user_id):
+        return str(user_id) in self._user_sids
+
+    def online_among(self, user_ids):
+        """The subset of user_ids that is online"""
+        return {user_id for user_id in user_ids if user_id in self._user_sids}
+
+    def online_count(self):
+        return len(self._user_sids)
+
+    def purge_worker(self):
+        """Nothing survives a restart of an in-process backend"""
+        return []
+
+
+# Both scripts run atomically in Redis, so two workers adding or removing the
+# connections of one user at the same time still agree on first / last
+_ADD_CONNECTION = """
+local added = redis.call('SADD', KEYS[1], ARGV[1])
+redis.call('SADD', KEYS[3], ARGV[2] .. ' ' .. ARGV[1])
+if added == 1 and redis.call('SCARD', KEYS[1]) == 1 then
+    redis.call('SADD', KEYS[2], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+_REMOVE_CONNECTION = """
+local removed = redis.call('SREM', KEYS[1], ARGV[1])
+redis.call('SREM', KEYS[3], ARGV[2] .. ' ' .. ARGV[1])
+if removed == 1 and redis.call('SCARD', KEYS[1]) == 0 then
+    redis.call('SREM', KEYS[2], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+
+class RedisPresenceBackend:
+    """Presence shared by every worker through Redis
+
+    Keys: presence:online (set of user ids), presence:sids:<user> (their
+    connection sids) and presence:worker:<worker> ("<user> <sid>" entries of
+    the connections held by a worker).
+    """
+
+    def __init__(self, url, worker_id=WORKER_ID, prefix="presence"):
+        import redis
+
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._worker_key = f"{prefix}:worker:{worker_id}"
+        self._online_key = f"{prefix}:online"
+        self._prefix = prefix
+        self._add = self._redis.register_script(_ADD_CONNECTION)
+        self._remove = self._redis.register_script(_REMOVE_CONNECTION)
+
+    def _sids_key(self, user_id):
+        return f"{self._prefix}:sids:{user_id}"
+
+    def add_connection(self, user_id, sid):
+        keys = [self._sids_key(user_id), self._online_key, self._worker_key]
+        return self._add(keys=keys, args=[sid, user_id]) == 1
+
+    def remove_connection(self, user_id, sid):
+        keys = [self._sids_key(user_id), self._online_key, self._worker_key]
+        return self._remove(keys=keys, args=[sid, user_id]) == 1
+
+    def is_online(self, user_id):
+        return bool(self._redis.sismember(self._online_key, str(user_id)))
+
+    def online_among(self, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        flags = self._redis.smismember(self._online_key, user_ids)
+        return {user_id for user_id, online in zip(user_ids, flags) if online}
+
+    def online_count(self):
+        return self._redis.scard(self._online_key)
+
+    def purge_worker(self):
+        """Drop the connections this worker held before a restart
+
+        Returns the ids of the users who went offline as a result.
+        """
+        offline = []
+        for entry in self._redis.smembers(self._worker_key):
+            user_id, sid = entry.split(" ", 1)
+            if self.remove_connection(user_id, sid):
+                offline.append(user_id)
+        self._redis.delete(self._worker_key)
+        return offline
+
+
+def create_presence_backend(url=PRESENCE_BACKEND):
+    """Backend configured by PRESENCE_BACKEND ("local" or a redis:// URL)"""
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        if not WORKER_ID:
+            raise RuntimeError("WORKER_ID must be set when PRESENCE_BACKEND is a Redis URL")
+        return RedisPresenceBackend(url)
+    return LocalPresenceBackend()
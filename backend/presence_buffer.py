@@ -0,0 +1,152 @@
+import os
+import threading
+import time
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+# Write-behind buffer for users.lastActive / users.isOnline.
+#
+# Heartbeats, connects and disconnects only record the latest presence of a
+# user in memory; a background thread writes everything that changed with a
+# single bulk_write every PRESENCE_FLUSH_INTERVAL seconds (and once more on
+# shutdown). A user heard from many times between two flushes costs one write.
+#
+# Workers flush independently, so a stale status can reach the database after
+# a newer one. Every status is written with the time it was observed
+# (users.presenceAt) and only applied if it is not older than the stored one.
+
+PRESENCE_FLUSH_INTERVAL = float(os.getenv('PRESENCE_FLUSH_INTERVAL', 5))
+
+
+def _status_update(entry):
+    """$set stage applying a status only if it was observed after the stored one"""
+    # A missing presenceAt compares lower than any date
+    is_newer = {"$lte": ["$presenceAt", entry["presenceAt"]]}
+    return {
+        "lastActive": {"$max": ["$lastActive", entry["lastActive"]]},
+        "isOnline": {"$cond": [is_newer, entry["isOnline"], "$isOnline"]},
+        "presenceAt": {"$max": ["$presenceAt", entry["presenceAt"]]}
+    }
+
+
+class PresenceBuffer:
+    """Thread-safe map of user id -> pending presence fields, flushed periodically"""
+
+    def __init__(self, interval=PRESENCE_FLUSH_INTERVAL):
+        self.interval = interval
+        self._collection = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.recorded = 0
+        self.written = 0
+        self.flushes = 0
+        self.errors = 0
+        self.last_flush_at = None
+        self.last_flush_ms = 0.0
+        self.last_flush_lag = 0.0
+
+    def record(self, user_id, last_active, is_online=None):
+        """Remember the latest presence of a user; is_online None leaves the flag as it is"""
+        with self._lock:
+            entry = self._pending.get(user_id)
+            if entry is None:
+                entry = self._pending[user_id] = {"since": time.monotonic()}
+            entry["lastActive"] = max(last_active, entry.get("lastActive", last_active))
+            if is_online is not None and last_active >= entry.get("presenceAt", last_active):
+                entry["isOnline"] = is_online
+                entry["presenceAt"] = last_active
+            self.recorded += 1
+
+    def flush(self):
+        """Write every pending update with one bulk_write; returns the number of users written"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending or self._collection is None:
+                return 0
+
+            started = time.monotonic()
+            operations = []
+            for user_id, entry in pending.items():
+                if "isOnline" in entry:
+                    update = [{"$set": _status_update(entry)}]
+                else:
+                    update = {"$max": {"lastActive": entry["lastActive"]}}
+                operations.append(UpdateOne({"_id": ObjectId(user_id)}, update))
+
+            try:
+                self._collection.bulk_write(operations, ordered=False)
+            except PyMongoError as e:
+                print(f"Error flushing presence updates: {e}")
+                self.errors += 1
+                self._requeue(pending)
+                return 0
+
+            finished = time.monotonic()
+            self.flushes += 1
+            self.written += len(operations)
+            self.last_flush_at = time.time()
+            self.last_flush_ms = (finished - started) * 1000
+            # How long the oldest of these updates waited to reach the database
+            self.last_flush_lag = finished - min(entry["since"] for entry in pending.values())
+            return len(operations)
+
+    def _requeue(self, pending):
+        # Keep failed updates for the next flush, without overriding newer ones
+        with self._lock:
+            for user_id, entry in pending.items():
+                newer = self._pending.get(user_id)
+                if newer is None:
+                    self._pending[user_id] = entry
+                    continue
+                newer["since"] = min(newer["since"], entry["since"])
+                newer["lastActive"] = max(newer["lastActive"], entry["lastActive"])
+                if "isOnline" in entry and ("isOnline" not in newer or entry["presenceAt"] > newer["presenceAt"]):
+                    newer["isOnline"] = entry["isOnline"]
+                    newer["presenceAt"] = entry["presenceAt"]
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def start(self, collection):
+        """Start the background flusher writing to `collection` (users)"""
+        self._collection = collection
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="presence-flush", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the flusher and write what is still pending (shutdown)"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.interval + 1)
+            self._thread = None
+        self.flush()
+
+    def stats(self):
+        """Flush counters and lag for monitoring"""
+        now = time.monotonic()
+        with self._lock:
+            pending = len(self._pending)
+            oldest = min((entry["since"] for entry in self._pending.values()), default=None)
+        return {
+            "pending": pending,
+            "oldestPendingSeconds": round(now - oldest, 3) if oldest is not None else 0.0,
+            "recorded": self.recorded,
+            "written": self.written,
+            "flushes": self.flushes,
+            "errors": self.errors,
+            "lastFlushAt": self.last_flush_at,
+            "lastFlushMs": round(self.last_flush_ms, 3),
+            "lastFlushLagSeconds": round(self.last_flush_lag, 3),
+            "flushInterval": self.interval
+        }
+
+
+presence_buffer = PresenceBuffer()
@@ -0,0 +1,169 @@
+import os
+import threading
+import time
+from collections import defaultdict
+from bson import ObjectId
+from group_members import member_group_ids
+
+# Delivery of online/offline changes to the users who can see them.
+#
+# Instead of broadcasting every connect and disconnect to every socket, a
+# status change is queued and, every PRESENCE_FANOUT_INTERVAL seconds, sent
+# as one `presence_diff` event per interested user:
+#   {"changes": [{"userId": "...", "status": "online" | "offline"}, ...]}
+# Interested users are those who have the user as a contact or share a group
+# with them (plus admins, who watch everyone through ADMIN_ROOM). A user
+# flapping between two ticks only produces their final status, and none at
+# all if it ends where it started.
+
+PRESENCE_FANOUT_INTERVAL = float(os.getenv('PRESENCE_FANOUT_INTERVAL', 2))
+
+# Seconds a computed audience stays cached (contact and group changes also invalidate it)
+AUDIENCE_TTL = int(os.getenv('PRESENCE_AUDIENCE_TTL', 300))
+
+# Room joined by admin sockets, which show the status of every user
+ADMIN_ROOM = "admins"
+
+
+class PresenceFanout:
+    """Queue of status changes, fanned out periodically to each user's audience"""
+
+    def __init__(self, interval=PRESENCE_FANOUT_INTERVAL, audience_ttl=AUDIENCE_TTL):
+        self.interval = interval
+        self.audience_ttl = audience_ttl
+        self._socketio = None
+        self._db = None
+        self._online_among = None
+        self._pending = {}
+        self._audiences = {}
+        self._lock = threading.Lock()
+        self._running = False
+        self.queued = 0
+        self.sent_changes = 0
+        self.sent_events = 0
+        self.suppressed = 0
+
+    def publish(self, user_id, status):
+        """Queue a status change; only the latest status per tick is delivered"""
+        with self._lock:
+            user_id = str(user_id)
+            # Remember the status the user had before their first change of this tick
+            previous = self._pending[user_id][0] if user_id in self._pending else _opposite(status)
+            self._pending[user_id] = (previous, status)
+            self.queued += 1
+
+    def invalidate(self, user_ids):
+        """Forget the cached audience of users whose contacts or groups changed"""
+        with self._lock:
+            for user_id in user_ids:
+                self._audiences.pop(str(user_id), None)
+
+    def audience(self, user_id):
+        """Ids of the users who have user_id as a contact or share a group with them"""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._audiences.get(user_id)
+        if cached and cached[0] > now:
+            return cached[1]
+
+        # Reverse contact lookup, served by the contacts {contactId} index
+        watchers = {
+            str(contact["userId"])
+            for contact in self._db.contacts.find({"contactId": ObjectId(user_id)}, {"userId": 1})
+        }
+        group_ids = member_group_ids(self._db.group_members, user_id)
+        if group_ids:
+            watchers.update(
+                str(membership["userId"])
+                for membership in self._db.group_members.find({"groupId": {"$in": group_ids}}, {"userId": 1})
+            )
+        watchers.discard(user_id)
+        watchers = frozenset(watchers)
+
+        with self._lock:
+            self._audiences[user_id] = (now + self.audience_ttl, watchers)
+        return watchers
+
+    def collect(self):
+        """Take the changes queued since the last tick
+
+        Returns the events to send as [(room, payload), ...]: one per online
+        recipient, plus one for ADMIN_ROOM.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            changes = []
+            for user_id, (previous, status) in pending.items():
+                # Back where it started: nothing to tell
+                if previous == status:
+                    self.suppressed += 1
+                    continue
+                changes.append({"userId": user_id, "status": status})
+
+        if not changes:
+            return []
+
+        audiences = {change["userId"]: self.audience(change["userId"]) for change in changes}
+        online = self._online_among(frozenset().union(*audiences.values()))
+
+        diffs = defaultdict(list)
+        for change in changes:
+            for watcher in audiences[change["userId"]] & online:
+                diffs[watcher].append(change)
+
+        events = [(watcher, {"changes": watcher_changes}) for watcher, watcher_changes in diffs.items()]
+        events.append((ADMIN_ROOM, {"changes": changes}))
+
+        self.sent_changes += len(changes)
+        self.sent_events += len(events)
+        return events
+
+    def flush(self):
+        """Send the changes queued since the last tick; returns the number of events emitted"""
+        events = self.collect()
+        for room, payload in events:
+            self._socketio.emit('presence_diff', payload, room=room)
+        return len(events)
+
+    def _run(self):
+        while self._running:
+            self._socketio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error sending presence changes: {e}")
+
+    def configure(self, db, online_among):
+        """online_among(user_ids) tells which recipients are connected"""
+        self._db = db
+        self._online_among = online_among
+
+    def start(self, socketio, db, online_among):
+        """Start the periodic fan-out on a Flask-SocketIO server"""
+        self.configure(db, online_among)
+        self._socketio = socketio
+        if not self._running:
+            self._running = True
+            socketio.start_background_task(self._run)
+
+    def stop(self):
+        self._running = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "cachedAudiences": len(self._audiences),
+                "queued": self.queued,
+                "suppressed": self.suppressed,
+                "sentChanges": self.sent_changes,
+                "sentEvents": self.sent_events,
+                "interval": self.interval
+            }
+
+
+def _opposite(status):
+    return "offline" if status == "online" else "online"
+
+
+presence_fanout = PresenceFanout()
@@ -0,0 +1,286 @@
+import os
+import re
+import unicodedata
+from datetime import datetime, timezone
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne
+
+# Token-based message search.
+#
+# Every message stores the normalized words of its text in `searchTokens`
+# (lowercased, accents stripped, deduplicated). Together with the
+# (conversationId | groupId, searchTokens) indexes this is an inverted index
+# scoped to one conversation: a query term becomes an index range on
+# `searchTokens` instead of a regex scan over every message's text.
+#
+# Each query term matches as a prefix ("meet" finds "meeting"). Results are
+# ranked by the number of query terms matched, exact word matches first,
+# then newest first, and paginated with a "<score>_<ms>_<id>" cursor.
+
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+# Global search: conversations per page and snippets returned per conversation
+DEFAULT_HITS_PER_CONVERSATION = 3
+MAX_HITS_PER_CONVERSATION = 10
+
+# Query terms beyond this are ignored
+MAX_QUERY_TERMS = 8
+
+# Shorter query terms are ignored: as a prefix they would match most of the index
+MIN_TERM_LENGTH = int(os.getenv('SEARCH_MIN_TERM_LENGTH', 2))
+
+# Longer words are truncated before indexing; messages keep at most this many tokens
+MAX_TOKEN_LENGTH = 40
+MAX_TOKENS_PER_MESSAGE = 500
+
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+def normalize_word(word):
+    """Lowercase a word and strip its accents"""
+    decomposed = unicodedata.normalize("NFKD", word.casefold())
+    return "".join(char for char in decomposed if not unicodedata.combining(char))[:MAX_TOKEN_LENGTH]
+
+
+def tokenize(text):
+    """Distinct normalized words of a text, in order of appearance"""
+    tokens = []
+    seen = set()
+    for match in WORD_PATTERN.finditer(text or ""):
+        token = normalize_word(match.group())
+        if token and token not in seen:
+            seen.add(token)
+            tokens.append(token)
+            if len(tokens) >= MAX_TOKENS_PER_MESSAGE:
+                break
+    return tokens
+
+
+def query_terms(query):
+    """Search terms of a user query, without the ones shorter than MIN_TERM_LENGTH"""
+    return [term for term in tokenize(query) if len(term) >= MIN_TERM_LENGTH][:MAX_QUERY_TERMS]
+
+
+def parse_search_args(args, decode_cursor=None):
+    """Read `query`, `cursor` and `limit` from request args
+
+    Returns (terms, cursor, limit). Raises ValueError on bad input.
+    """
+    decode_cursor = decode_cursor or decode_search_cursor
+    query = args.get('query', '')
+    if not query.strip():
+        raise ValueError("Search query is required")
+
+    try:
+        limit = int(args.get('limit', DEFAULT_SEARCH_LIMIT))
+    except (TypeError, ValueError):
+        raise ValueError("'limit' must be an integer")
+    limit = max(1, min(limit, MAX_SEARCH_LIMIT))
+
+    terms = query_terms(query)
+    if not terms:
+        raise ValueError(f"Search words must be at least {MIN_TERM_LENGTH} characters long")
+
+    cursor = args.get('cursor')
+    return terms, decode_cursor(cursor) if cursor else None, limit
+
+
+def encode_search_cursor(message):
+    """Cursor pointing after a ranked search result"""
+    timestamp = message["timestamp"]
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return f"{message['score']}_{int(timestamp.timestamp() * 1000)}_{message['_id']}"
+
+
+def decode_search_cursor(cursor):
+    """Parse a search cursor into (score, timestamp, ObjectId), raising ValueError if malformed"""
+    try:
+        score, millis, message_id = cursor.split('_', 2)
+        timestamp = datetime.fromtimestamp(int(millis) / 1000, tz=timezone.utc)
+        return int(score), timestamp, ObjectId(message_id)
+    except (AttributeError, ValueError, InvalidId, OverflowError, OSError):
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+def _prefix_pattern(term):
+    # Anchored, escaped prefix: an index range scan, no user-controlled regex syntax
+    return re.compile("^" + re.escape(term))
+
+
+def _score_expression(terms):
+    """Aggregation expression ranking a message against the query terms
+
+    Each term found as a word prefix is worth 2, an exact word match 1 more.
+    """
+    parts = []
+    for term in terms:
+        prefix_matches = {"$filter": {
+            "input": "$searchTokens",
+            "as": "token",
+            "cond": {"$regexMatch": {"input": "$$token", "regex": "^" + re.escape(term)}}
+        }}
+        parts.append({"$cond": [{"$gt": [{"$size": prefix_matches}, 0]}, 2, 0]})
+        parts.append({"$cond": [{"$in": [term, "$searchTokens"]}, 1, 0]})
+    return {"$add": parts}
+
+
+def _after_cursor(cursor):
+    score, timestamp, message_id = cursor
+    return {"$or": [
+        {"score": {"$lt": score}},
+        {"score": score, "timestamp": {"$lt": timestamp}},
+        {"score": score, "timestamp": timestamp, "_id": {"$lt": message_id}}
+    ]}
+
+
+def search(collection, scope, terms, cursor=None, limit=DEFAULT_SEARCH_LIMIT):
+    """Ranked search of the messages matching `scope` (e.g. {"conversationId": ...})
+
+    Only messages containing at least one query term are read, through the
+    scope + searchTokens index. Returns (messages, next_cursor); each message
+    carries its `score`, next_cursor is None on the last page.
+    """
+    if not terms:
+        return [], None
+
+    pipeline = [
+        {"$match": {"$and": [scope, {"searchTokens": {"$in": [_prefix_pattern(term) for term in terms]}}]}},
+        {"$addFields": {"score": _score_expression(terms)}},
+    ]
+    if cursor is not None:
+        pipeline.append({"$match": _after_cursor(cursor)})
+    pipeline += [
+        {"$sort": {"score": -1, "timestamp": -1, "_id": -1}},
+        {"$limit": limit + 1},
+        {"$project": {"searchTokens": 0}}
+    ]
+
+    messages = list(collection.aggregate(pipeline))
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    next_cursor = encode_search_cursor(messages[-1]) if has_more else None
+    return messages, next_cursor
+
+
+def encode_conversation_cursor(conversation):
+    """Cursor pointing after a conversation in global search results"""
+    timestamp = conversation["bestTime"]
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return f"{conversation['bestScore']}_{int(timestamp.timestamp() * 1000)}_{conversation['_id']}"
+
+
+def decode_conversation_cursor(cursor):
+    """Parse a global search cursor into (score, timestamp, conversation id), raising ValueError if malformed"""
+    try:
+        score, millis, conversation_id = cursor.split('_', 2)
+        timestamp = datetime.fromtimestamp(int(millis) / 1000, tz=timezone.utc)
+        if not conversation_id:
+            raise ValueError(cursor)
+        return int(score), timestamp, conversation_id
+    except (AttributeError, ValueError, OverflowError, OSError):
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+def _conversation_order_key(conversation):
+    best_time = conversation["bestTime"]
+    if best_time.tzinfo is None:
+        best_time = best_time.replace(tzinfo=timezone.utc)
+    return conversation["bestScore"], best_time, conversation["_id"]
+
+
+def search_conversations(sources, terms, cursor=None, limit=DEFAULT_SEARCH_LIMIT,
+                         hits_per_conversation=DEFAULT_HITS_PER_CONVERSATION):
+    """Ranked search across several conversations, grouped by conversation
+
+    `sources` is a list of (collection, scope, conversation_key) where
+    conversation_key is an aggregation expression naming the conversation of
+    a message. Each source is one aggregation over its scope + searchTokens
+    index. Conversations are ranked by their best hit (score, then recency).
+
+    Returns (conversations, next_cursor); each conversation is
+    {"_id", "bestScore", "bestTime", "matchCount", "hits": [...]} with at most
+    hits_per_conversation hits, best first.
+    """
+    if not terms:
+        return [], None
+
+    conversations = []
+    for collection, scope, conversation_key in sources:
+        pipeline = [
+            {"$match": {"$and": [scope, {"searchTokens": {"$in": [_prefix_pattern(term) for term in terms]}}]}},
+            {"$addFields": {"score": _score_expression(terms)}},
+            # $topN keeps only the best hits of each conversation in memory (MongoDB 5.2+)
+            {"$group": {
+                "_id": conversation_key,
+                "matchCount": {"$sum": 1},
+                "hits": {"$topN": {
+                    "n": hits_per_conversation,
+                    "sortBy": {"score": -1, "timestamp": -1, "_id": -1},
+                    "output": {
+                        "_id": "$_id",
+                        "senderId": "$senderId",
+                        "text": "$text",
+                        "timestamp": "$timestamp",
+                        "messageType": "$messageType",
+                        "score": "$score"
+                    }
+                }}
+            }},
+            {"$addFields": {
+                "bestScore": {"$first": "$hits.score"},
+                "bestTime": {"$first": "$hits.timestamp"}
+            }},
+        ]
+        if cursor is not None:
+            score, timestamp, conversation_id = cursor
+            pipeline.append({"$match": {"$or": [
+                {"bestScore": {"$lt": score}},
+                {"bestScore": score, "bestTime": {"$lt": timestamp}},
+                {"bestScore": score, "bestTime": timestamp, "_id": {"$lt": conversation_id}}
+            ]}})
+        pipeline += [
+            {"$sort": {"bestScore": -1, "bestTime": -1, "_id": -1}},
+            {"$limit": limit + 1}
+        ]
+        conversations.extend(collection.aggregate(pipeline))
+
+    conversations.sort(key=_conversation_order_key, reverse=True)
+    has_more = len(conversations) > limit
+    conversations = conversations[:limit]
+    next_cursor = encode_conversation_cursor(conversations[-1]) if has_more else None
+    return conversations, next_cursor
+
+
+def highlight_offsets(text, terms):
+    """[start, end) character offsets of the words in `text` matching a query term"""
+    offsets = []
+    for match in WORD_PATTERN.finditer(text or ""):
+        word = normalize_word(match.group())
+        if any(word.startswith(term) for term in terms):
+            offsets.append([match.start(), match.end()])
+    return offsets
+
+
+def backfill_search_tokens(db):
+    """Index the text of messages stored before searchTokens existed"""
+    updated = 0
+    for collection in (db.messages, db.group_messages):
+        batch = []
+        for message in collection.find({"searchTokens": {"$exists": False}}, {"text": 1, "isDeleted": 1}):
+            tokens = [] if message.get("isDeleted") else tokenize(message.get("text"))
+            batch.append(UpdateOne({"_id": message["_id"]}, {"$set": {"searchTokens": tokens}}))
+
+            if len(batch) >= BACKFILL_BATCH_SIZE:
+                updated += collection.bulk_write(batch, ordered=False).modified_count
+                batch = []
+
+        if batch:
+            updated += collection.bulk_write(batch, ordered=False).modified_count
+
+    return {"updated": updated}
@@ -0,0 +1,174 @@
+import threading
+import time
+from presence_backends import create_presence_backend
+
+# Registry of the Socket.IO connections of this worker.
+#
+# handle_connect verifies the JWT from the connection query string and binds
+# the user id and the token expiry to request.sid; event handlers then read
+# the caller from here instead of decoding the token sent with every event.
+# Once the token expires the session stops authorizing events until the
+# client re-authenticates with a fresh token (`reauth` event).
+#
+# A user may be connected from several devices (tabs, phones) at once: the
+# registry keeps both sid -> session and user -> {sids}, so every lookup is
+# O(1) and a user only goes offline when their last connection closes.
+# Whether a user is online anywhere (on any worker) is answered by the
+# presence backend (see presence_backends.py).
+
+# Ask clients to re-authenticate this many seconds before their token expires
+REAUTH_MARGIN = 300
+
+
+class SocketSessionRegistry:
+    """Thread-safe registry of socket sessions, indexed by sid and by user
+
+    A session is {"userId", "name", "expiresAt", "connectedAt", "lastSeen",
+    "device"} where device holds client metadata captured at connect (user
+    agent, transport). The user's name is kept so that sends can label their
+    messages without a lookup.
+    """
+
+    def __init__(self, presence=None):
+        self.presence = presence or create_presence_backend()
+        self._sessions = {}
+        self._user_sids = {}
+        self._lock = threading.Lock()
+        self.expired = 0
+
+    def bind(self, sid, user_id, expires_at, device=None, name=None):
+        """Attach an authenticated user to a socket (connect / reauth)
+
+        Returns True when this is the user's first connection on any worker
+        (they came online).
+        """
+        user_id = str(user_id)
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(sid)
+            previous_user = session["userId"] if session else None
+            if session and previous_user != user_id:
+                self._discard(sid, previous_user)
+                session = None
+
+            self._sessions[sid] = {
+                "userId": user_id,
+                "name": name if name is not None else (session or {}).get("name"),
+                "expiresAt": expires_at,
+                "connectedAt": session["connectedAt"] if session else now,
+                "lastSeen": now,
+                "device": device if device is not None else (session or {}).get("device", {}),
+                "reauthRequested": False
+            }
+
+            self._user_sids.setdefault(user_id, set()).add(sid)
+
+        # Shared state is updated outside the lock: it may be a network call
+        if previous_user == user_id:
+            return False
+        if previous_user is not None:
+            self.presence.remove_connection(previous_user, sid)
+        return self.presence.add_connection(user_id, sid)
+
+    def unbind(self, sid):
+        """Forget a socket (disconnect)
+
+        Returns (session, went_offline): session is None for an unknown sid and
+        went_offline is True when it was the user's last connection on any worker.
+        """
+        with self._lock:
+            session = self._sessions.pop(sid, None)
+            if session is None:
+                return None, False
+            self._discard(sid, session["userId"])
+        return session, self.presence.remove_connection(session["userId"], sid)
+
+    def _discard(self, sid, user_id):
+        # Caller holds the lock
+        sids = self._user_sids.get(user_id)
+        if sids is None:
+            return
+        sids.discard(sid)
+        if not sids:
+            del self._user_sids[user_id]
+
+    def touch(self, sid):
+        """Record activity on a socket (heartbeat); returns its user id or None"""
+        with self._lock:
+            session = self._sessions.get(sid)
+            if session is None:
+                return None
+            session["lastSeen"] = time.time()
+            return session["userId"]
+
+    def authenticate(self, sid, now=None):
+        """User id of a socket, or None if it is unknown or its token has expired
+
+        Returns (user_id, reauth): reauth is True the first time the token is
+        about to expire or has expired, so the caller can ask the client once.
+        """
+        now = now or time.time()
+        with self._lock:
+            session = self._sessions.get(sid)
+            if session is None:
+                return None, False
+
+            reauth = False
+            if session["expiresAt"] - REAUTH_MARGIN <= now and not session["reauthRequested"]:
+                session["reauthRequested"] = True
+                reauth = True
+
+            if session["expiresAt"] <= now:
+                self.expired += 1
+                return None, reauth
+            return session["userId"], reauth
+
+    def user_name(self, sid, default="Unknown"):
+        """Name of the user of a socket, as bound at connect"""
+        with self._lock:
+            session = self._sessions.get(sid)
+            name = session["name"] if session else None
+        return name if name is not None else default
+
+    def get(self, sid):
+        with self._lock:
+            session = self._sessions.get(sid)
+            return dict(session) if session else None
+
+    def is_online(self, user_id):
+        """Whether the user has at least one open connection, on any worker"""
+        return self.presence.is_online(user_id)
+
+    def online_among(self, user_ids):
+        """The subset of user_ids (strings) that is online, in one lookup"""
+        return self.presence.online_among(user_ids)
+
+    def online_count(self):
+        return self.presence.online_count()
+
+    def user_sids(self, user_id):
+        """Sids of the user's connections to this worker"""
+        with self._lock:
+            return set(self._user_sids.get(str(user_id), ()))
+
+    def devices(self, user_id):
+        """Connections of a user to this worker with their metadata, oldest first"""
+        with self._lock:
+            sessions = [
+                dict(self._sessions[sid], sid=sid)
+                for sid in self._user_sids.get(str(user_id), ())
+            ]
+        return sorted(sessions, key=lambda session: session["connectedAt"])
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "sessions": len(self._sessions),
+                "localUsers": len(self._user_sids),
+                "expiredEvents": self.expired
+            }
+        stats["onlineUsers"] = self.presence.online_count()
+        return stats
+
+
+socket_sessions = SocketSessionRegistry()
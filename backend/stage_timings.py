@@ -0,0 +1,80 @@
+import os
+import threading
+import time
+from collections import deque
+
+# Per-stage timing of a hot path (the send_message handlers).
+#
+# A handler starts a timer, marks the end of each of its stages and finishes
+# it; the durations of the last TIMING_WINDOW runs are kept per stage, and
+# /api/stats reports their count, average, p50, p99 and max. Runs slower than
+# SLOW_SEND_MS are printed with their breakdown.
+
+TIMING_WINDOW = int(os.getenv('TIMING_WINDOW', 1000))
+SLOW_SEND_MS = float(os.getenv('SLOW_SEND_MS', 250))
+
+
+class StageTimer:
+    """Durations of the stages of one run, in ms"""
+
+    def __init__(self):
+        self.started = self._last = time.perf_counter()
+        self.stages = {}
+
+    def stage(self, name):
+        """End the current stage, naming it"""
+        now = time.perf_counter()
+        self.stages[name] = self.stages.get(name, 0.0) + (now - self._last) * 1000
+        self._last = now
+
+    def total(self):
+        return (self._last - self.started) * 1000
+
+
+class StageTimings:
+    """Rolling per-stage durations of a code path"""
+
+    def __init__(self, name, window=TIMING_WINDOW, slow_ms=SLOW_SEND_MS):
+        self.name = name
+        self.window = window
+        self.slow_ms = slow_ms
+        self._samples = {}
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.slow = 0
+
+    def start(self):
+        return StageTimer()
+
+    def finish(self, timer):
+        """Record the stages of a finished run"""
+        total = timer.total()
+        with self._lock:
+            self.runs += 1
+            for stage, duration in list(timer.stages.items()) + [("total", total)]:
+                samples = self._samples.get(stage)
+                if samples is None:
+                    samples = self._samples[stage] = deque(maxlen=self.window)
+                samples.append(duration)
+            if total >= self.slow_ms:
+                self.slow += 1
+                breakdown = ", ".join(f"{stage}={duration:.1f}ms" for stage, duration in timer.stages.items())
+                print(f"Slow {self.name}: {total:.1f}ms ({breakdown})")
+
+    def stats(self):
+        """count / avgMs / p50Ms / p99Ms / maxMs of each stage over the window"""
+        with self._lock:
+            samples = {stage: sorted(durations) for stage, durations in self._samples.items()}
+            stats = {"runs": self.runs, "slow": self.slow, "slowThresholdMs": self.slow_ms, "stages": {}}
+        for stage, durations in samples.items():
+            stats["stages"][stage] = {
+                "count": len(durations),
+                "avgMs": round(sum(durations) / len(durations), 3),
+                "p50Ms": round(durations[len(durations) // 2], 3),
+                "p99Ms": round(durations[min(len(durations) - 1, int(len(durations) * 0.99))], 3),
+                "maxMs": round(durations[-1], 3)
+            }
+        return stats
+
+
+send_timings = StageTimings("send_message")
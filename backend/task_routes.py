@@ -23,10 +23,15 @@ def task_to_json(task):
     
     return task
 
+# Users whose sync log hears about a task change: its assignee and assigner
+def task_audience(*tasks):
+    return [user_id for task in tasks for user_id in (task.get("assignedTo"), task.get("assignedBy"))]
+
 # Create a new task
 @task_routes.route('/api/tasks', methods=['POST'])
 def create_task():
-    from app import tasks_collection
+    from app import db, tasks_collection
+    from user_events import record_event, TASK_CREATED
     data = request.get_json()
     
     # Validate required fields
@@ -59,8 +64,9 @@ def create_task():
     result = tasks_collection.insert_one(task)
     
     # Return the created task
-    created_task = tasks_collection.find_one({"_id": result.inserted_id})
-    return jsonify(task_to_json(created_task)), 201
+    created_task = task_to_json(tasks_collection.find_one({"_id": result.inserted_id}))
+    record_event(db, task_audience(created_task), TASK_CREATED, created_task)
+    return jsonify(created_task), 201
 
 # Get all tasks for a group
 @task_routes.route('/api/groups/<group_id>/tasks', methods=['GET'])
@@ -119,7 +125,8 @@ def get_task(task_id):
 # Update a task
 @task_routes.route('/api/tasks/<task_id>', methods=['PUT'])
 def update_task(task_id):
-    from app import tasks_collection
+    from app import db, tasks_collection
+    from user_events import record_event, TASK_UPDATED
     try:
         # Validate task_id
         if not ObjectId.is_valid(task_id):
@@ -160,16 +167,20 @@ def update_task(task_id):
         )
         
         # Get the updated task
-        updated_task = tasks_collection.find_one({"_id": ObjectId(task_id)})
+        updated_task = task_to_json(tasks_collection.find_one({"_id": ObjectId(task_id)}))
         
-        return jsonify(task_to_json(updated_task)), 200
+        # A reassigned task is also reported to its previous assignee
+        record_event(db, task_audience(task, updated_task), TASK_UPDATED, updated_task)
+        
+        return jsonify(updated_task), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 # Delete a task
 @task_routes.route('/api/tasks/<task_id>', methods=['DELETE'])
 def delete_task(task_id):
-    from app import tasks_collection
+    from app import db, tasks_collection
+    from user_events import record_event, TASK_DELETED
     try:
         # Validate task_id
         if not ObjectId.is_valid(task_id):
@@ -182,6 +193,7 @@ def delete_task(task_id):
         
         # Delete the task
         tasks_collection.delete_one({"_id": ObjectId(task_id)})
+        record_event(db, task_audience(task), TASK_DELETED, {"_id": task_id, "groupId": task.get("groupId")})
         
         return jsonify({"message": "Task deleted successfully"}), 200
     except Exception as e:
@@ -0,0 +1,171 @@
+import os
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from pymongo import ReturnDocument
+
+# Per-user append-only event log used by reconnecting clients to catch up.
+#
+# Every change a user should see (new, edited and deleted messages, group
+# joins and leaves, task changes) is appended to `user_events` for each
+# affected user, with a per-user sequence number taken from `event_counters`:
+#   {"userId": ObjectId, "seq": int, "type": str, "data": {...}, "timestamp": datetime}
+#
+# `data` is the payload the matching socket event carries, so a client can
+# replay synced events through its existing socket handlers. A client keeps
+# the last seq it has seen and asks for everything after it.
+#
+# Sequence numbers are reserved before the event is inserted, so two writers
+# can commit out of order for a moment. Sync therefore never delivers past a
+# missing seq: it waits for it, and once it is older than EVENT_GAP_GRACE (its
+# insert failed, or it has expired) it answers `reset` so the client reloads
+# through REST instead of silently skipping it.
+
+# How long events are kept (TTL index on timestamp)
+EVENT_RETENTION_DAYS = int(os.getenv('EVENT_RETENTION_DAYS', 30))
+
+DEFAULT_SYNC_LIMIT = 200
+MAX_SYNC_LIMIT = 1000
+
+EVENT_GAP_GRACE = timedelta(seconds=10)
+
+# Event types
+MESSAGE = "message"
+MESSAGE_EDITED = "message_edited"
+MESSAGE_DELETED = "message_deleted"
+GROUP_MESSAGE = "group_message"
+GROUP_JOINED = "group_joined"
+GROUP_LEFT = "group_left"
+GROUP_DELETED = "group_deleted"
+TASK_CREATED = "task_created"
+TASK_UPDATED = "task_updated"
+TASK_DELETED = "task_deleted"
+
+
+def _reserve_seqs(counters_collection, user_ids):
+    """Reserve the next seq of every given user, as {user_id: seq}
+
+    Each counter is incremented and read back atomically, so every
+    recipient gets its own seq even while other writers reserve too.
+    """
+    now = datetime.now(timezone.utc)
+    return {
+        user_id: counters_collection.find_one_and_update(
+            {"_id": user_id},
+            {"$inc": {"seq": 1}, "$set": {"reservedAt": now}},
+            projection={"seq": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )["seq"]
+        for user_id in user_ids
+    }
+
+
+def record_event(db, user_ids, event_type, data):
+    """Append an event to the log of every given user
+
+    Failures are logged and swallowed: the live socket event has already
+    been sent, the log only serves reconnecting clients.
+    """
+    try:
+        user_ids = [
+            ObjectId(user_id)
+            for user_id in dict.fromkeys(str(user_id) for user_id in user_ids if user_id)
+            if ObjectId.is_valid(user_id)
+        ]
+        if not user_ids:
+            return
+
+        seqs = _reserve_seqs(db.event_counters, user_ids)
+
+        # Stamped once the seqs are reserved, so the gap check of sync starts from the reservation
+        now = datetime.now(timezone.utc)
+        events = [{
+            "userId": user_id,
+            "seq": seq,
+            "type": event_type,
+            "data": data,
+            "timestamp": now
+        } for user_id, seq in seqs.items()]
+
+        if events:
+            db.user_events.insert_many(events, ordered=False)
+    except Exception as e:
+        print(f"Error recording {event_type} event: {e}")
+
+
+def parse_sync_args(args):
+    """(since_seq, limit) from request args or a socket payload, raising ValueError on bad input"""
+    since = args.get('since')
+    try:
+        since = int(since) if since is not None and since != '' else None
+        limit = int(args.get('limit', DEFAULT_SYNC_LIMIT))
+    except (TypeError, ValueError):
+        raise ValueError("'since' and 'limit' must be integers")
+    if since is not None and since < 0:
+        raise ValueError("'since' must not be negative")
+    return since, limit
+
+
+def sync_events(db, user_id, since_seq, limit=DEFAULT_SYNC_LIMIT):
+    """Events of a user after `since_seq`, oldest first
+
+    Returns {"events": [...], "lastSeq": int, "hasMore": bool, "reset": bool}.
+    `reset` is true when the event after since_seq is gone (expired, or its
+    insert failed): the client must then reload its state through the REST
+    endpoints and continue from lastSeq. A client without local state passes
+    since_seq=None to learn the current lastSeq after loading through REST.
+    """
+    user_id = ObjectId(user_id)
+    limit = max(1, min(int(limit), MAX_SYNC_LIMIT))
+
+    counter = db.event_counters.find_one({"_id": user_id}, {"seq": 1, "reservedAt": 1}) or {}
+    current_seq = counter.get("seq", 0)
+
+    if since_seq is None or since_seq >= current_seq:
+        return {"events": [], "lastSeq": current_seq, "hasMore": False, "reset": False}
+
+    events = list(db.user_events.find(
+        {"userId": user_id, "seq": {"$gt": since_seq}},
+        {"_id": 0, "seq": 1, "type": 1, "data": 1, "timestamp": 1}
+    ).sort("seq", 1).limit(limit))
+
+    # Deliver consecutive seqs only, stopping before one that is not there (yet)
+    delivered = []
+    expected = since_seq + 1
+    for event in events:
+        if event["seq"] != expected:
+            break
+        delivered.append({
+            "seq": event["seq"],
+            "type": event["type"],
+            "data": event["data"],
+            "timestamp": _as_utc(event["timestamp"]).isoformat()
+        })
+        expected += 1
+
+    last_seq = delivered[-1]["seq"] if delivered else since_seq
+    stopped = len(delivered) < len(events)
+    if stopped or (len(events) < limit and last_seq < current_seq):
+        # Seq last_seq + 1 is missing. Whatever was reserved after it is no
+        # older than it: past the grace, it will not be inserted any more.
+        reserved_after = events[len(delivered)]["timestamp"] if stopped else counter.get("reservedAt")
+        abandoned = (reserved_after is None or
+                     _as_utc(reserved_after) <= datetime.now(timezone.utc) - EVENT_GAP_GRACE)
+        if abandoned and not delivered:
+            return {"events": [], "lastSeq": current_seq, "hasMore": False, "reset": True}
+        # Still being inserted: the client already has it live and gets it from
+        # its next sync. An abandoned gap is reported by the next call instead.
+        return {"events": delivered, "lastSeq": last_seq, "hasMore": abandoned, "reset": False}
+
+    return {
+        "events": delivered,
+        "lastSeq": last_seq,
+        "hasMore": last_seq < current_seq,
+        "reset": False
+    }
+
+
+def _as_utc(value):
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
@@ -0,0 +1,172 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from bson import ObjectId
+
+# Process-wide cache of user profiles used to decorate messages (senderName,
+# department) without one users query per message.
+#
+# Admin flags are not cached: a promotion or demotion must apply at once on
+# every worker, so authorization reads them through get_user_roles.
+
+# Seconds a cached profile stays valid
+USER_PROFILE_TTL = int(os.getenv('USER_PROFILE_TTL', 300))
+
+# Maximum number of cached profiles; least recently used ones are evicted first
+USER_PROFILE_CACHE_SIZE = int(os.getenv('USER_PROFILE_CACHE_SIZE', 10000))
+
+# Fields kept in the cache (never the password hash)
+PROFILE_FIELDS = {"name": 1, "email": 1, "department": 1}
+
+# Fields read by authorization checks, always from the database
+ROLE_FIELDS = {"isAdmin": 1, "adminRole": 1}
+
+# Marks a cache miss, as opposed to a cached "user does not exist" (None)
+_MISSING = object()
+
+
+class UserProfileCache:
+    """Thread-safe, size-bounded LRU + TTL cache of user profiles keyed by user id string"""
+
+    def __init__(self, ttl=USER_PROFILE_TTL, max_size=USER_PROFILE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, user_id):
+        """Return the cached profile, None for a known missing user, or _MISSING"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return _MISSING
+
+            expires_at, profile = entry
+            if expires_at < time.monotonic():
+                del self._entries[user_id]
+                self.misses += 1
+                return _MISSING
+
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return profile
+
+    def set(self, user_id, profile):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, profile)
+            self._entries.move_to_end(user_id)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id):
+        with self._lock:
+            if self._entries.pop(str(user_id), None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Counters for monitoring the cache effectiveness"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxSize": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+
+profile_cache = UserProfileCache()
+
+
+def get_user_profiles(users_collection, user_ids):
+    """Resolve the profiles of many users with at most one $in query
+
+    Returns {user_id_str: profile or None}; None means the user does not exist.
+    """
+    profiles = {}
+    missing = []
+
+    for user_id in {str(user_id) for user_id in user_ids if user_id}:
+        profile = profile_cache.get(user_id)
+        if profile is _MISSING:
+            missing.append(user_id)
+        else:
+            profiles[user_id] = profile
+
+    if missing:
+        found = {}
+        object_ids = [ObjectId(user_id) for user_id in missing if ObjectId.is_valid(user_id)]
+        if object_ids:
+            for user in users_collection.find({"_id": {"$in": object_ids}}, PROFILE_FIELDS):
+                found[str(user["_id"])] = user
+
+        for user_id in missing:
+            profile = found.get(user_id)
+            profile_cache.set(user_id, profile)
+            profiles[user_id] = profile
+
+    return profiles
+
+
+def get_user_profile(users_collection, user_id):
+    """Resolve a single user profile (None if the user does not exist)"""
+    return get_user_profiles(users_collection, [user_id]).get(str(user_id))
+
+
+def get_user_names(users_collection, user_ids, default="Unknown"):
+    """Resolve display names for many users: {user_id_str: name}"""
+    return {
+        user_id: profile["name"] if profile else default
+        for user_id, profile in get_user_profiles(users_collection, user_ids).items()
+    }
+
+
+def get_user_name(users_collection, user_id, default="Unknown"):
+    """Resolve the display name of a single user"""
+    profile = get_user_profile(users_collection, user_id)
+    return profile["name"] if profile else default
+
+
+def get_user_roles(users_collection, user_id):
+    """isAdmin / adminRole of a user read from the database (None if the user does not exist)"""
+    if not ObjectId.is_valid(str(user_id)):
+        return None
+    return users_collection.find_one({"_id": ObjectId(user_id)}, ROLE_FIELDS)
+
+
+def get_cached_user_profile(user_id):
+    """(found, profile) from the cache alone, for callers that query the database themselves"""
+    profile = profile_cache.get(str(user_id))
+    if profile is _MISSING:
+        return False, None
+    return True, profile
+
+
+def cache_user_profile(user_id, profile):
+    """Store a profile loaded by the caller (None for a missing user)"""
+    profile_cache.set(str(user_id), profile)
+
+
+def invalidate_user_profile(user_id):
+    """Drop a user's cached profile after it changed"""
+    profile_cache.invalidate(user_id)
+
+
+def get_profile_cache_stats():
+    """Hit/miss counters of the process-wide profile cache"""
+    return profile_cache.stats()
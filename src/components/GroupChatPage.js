@@ -12,6 +12,22 @@ import TaskManagement from "./TaskManagement";
 import EmojiPicker from "emoji-picker-react";
 import UrgencySelector from "./UrgencySelector";
 import GiphyPicker from "./GiphyPicker";
+import { readHistoryPage, prependOlderMessages } from "../utils/historyPaging";
+
+// Keep only the first "has joined the group" message of each user
+const dropDuplicateJoinMessages = (groupMessages) => {
+  const joinMessagesByUser = new Map();
+  return groupMessages.filter((msg) => {
+    if (msg.isSystem && msg.text.includes("has joined the group")) {
+      const username = msg.text.replace(" has joined the group", "");
+      if (joinMessagesByUser.has(username)) {
+        return false;
+      }
+      joinMessagesByUser.set(username, true);
+    }
+    return true;
+  });
+};
 
 function GroupChatPage({ user, textSize }) {
   const [groups, setGroups] = useState([]);
@@ -38,6 +54,10 @@ function GroupChatPage({ user, textSize }) {
   const [searchTerm, setSearchTerm] = useState("");
   const [error, setError] = useState("");
   const messagesEndRef = useRef(null);
+  // Cursor of the next older history page per group (null once fully loaded)
+  const [olderCursors, setOlderCursors] = useState({});
+  const [loadingOlder, setLoadingOlder] = useState(false);
+  const keepScrollRef = useRef(false);
   const { getSocket } = useAuth();
   const socket = getSocket();
   const [messageIdCounter, setMessageIdCounter] = useState(1000);
@@ -1126,28 +1146,13 @@ function GroupChatPage({ user, textSize }) {
             `/api/groups/${selectedGroup.id}/messages`
           );
 
-          // Process messages to ensure we don't have duplicate join messages
-          const processedMessages = response.data;
-
-          // Create a Map to track unique join messages by username
-          const joinMessagesByUser = new Map();
-
-          // Filter out duplicate join messages, keeping only the most recent one for each user
-          const filteredMessages = processedMessages.filter((msg) => {
-            if (msg.isSystem && msg.text.includes("has joined the group")) {
-              // Extract username from the message
-              const username = msg.text.replace(" has joined the group", "");
-
-              // If we've seen this user's join message before, skip this one
-              if (joinMessagesByUser.has(username)) {
-                return false;
-              }
-
-              // Otherwise, record this as the first join message for this user
-              joinMessagesByUser.set(username, true);
-            }
-            return true;
-          });
+          // Latest page only; older pages are loaded on demand
+          const { messages: page, olderCursor } = readHistoryPage(response);
+          const filteredMessages = dropDuplicateJoinMessages(page);
+          setOlderCursors((prev) => ({
+            ...prev,
+            [selectedGroup.id]: olderCursor,
+          }));
 
           setMessages((prev) => ({
             ...prev,
@@ -1172,8 +1177,39 @@ function GroupChatPage({ user, textSize }) {
     }
   }, [selectedGroup, socket]);
 
-  // Scroll to bottom of messages
+  // Load the page of messages preceding the oldest one shown
+  const loadOlderMessages = async () => {
+    const groupId = selectedGroup?.id;
+    const cursor = groupId && olderCursors[groupId];
+    if (!cursor || loadingOlder) return;
+
+    setLoadingOlder(true);
+    try {
+      const response = await axios.get(`/api/groups/${groupId}/messages`, {
+        params: { before: cursor },
+      });
+      const { messages: page, olderCursor } = readHistoryPage(response);
+      keepScrollRef.current = true;
+      setMessages((prev) => ({
+        ...prev,
+        [groupId]: dropDuplicateJoinMessages(
+          prependOlderMessages(page, prev[groupId])
+        ),
+      }));
+      setOlderCursors((prev) => ({ ...prev, [groupId]: olderCursor }));
+    } catch (error) {
+      console.error("Error fetching older group messages:", error);
+    } finally {
+      setLoadingOlder(false);
+    }
+  };
+
+  // Scroll to bottom of messages (not when older messages were put on top)
   useEffect(() => {
+    if (keepScrollRef.current) {
+      keepScrollRef.current = false;
+      return;
+    }
     if (messagesEndRef.current) {
       messagesEndRef.current.scrollIntoView({ behavior: "smooth" });
     }
@@ -2534,6 +2570,15 @@ function GroupChatPage({ user, textSize }) {
             {activeTab === "chat" ? (
               <>
                 <div className="chat-messages slide-up stagger-2">
+                  {olderCursors[selectedGroup?.id] && (
+                    <button
+                      className="load-older-button"
+                      onClick={loadOlderMessages}
+                      disabled={loadingOlder}
+                    >
+                      {loadingOlder ? "Loading..." : "Load older messages"}
+                    </button>
+                  )}
                   {messages[selectedGroup?.id]?.map((msg) => (
                     <div
                       key={msg.id}
@@ -14,6 +14,7 @@ import EmojiPicker from "emoji-picker-react";
 import CategoryManager from "./CategoryManager";
 import UrgencySelector from "./UrgencySelector";
 import GiphyPicker from "./GiphyPicker";
+import { readHistoryPage, prependOlderMessages } from "../utils/historyPaging";
 
 function MessagingPage({ user, textSize }) {
   const [contacts, setContacts] = useState([]);
@@ -23,6 +24,10 @@ function MessagingPage({ user, textSize }) {
   const [searchTerm, setSearchTerm] = useState("");
   const [messageUrgency, setMessageUrgency] = useState("normal");
   const messagesEndRef = useRef(null);
+  // Cursor of the next older history page per contact (null once fully loaded)
+  const [olderCursors, setOlderCursors] = useState({});
+  const [loadingOlder, setLoadingOlder] = useState(false);
+  const keepScrollRef = useRef(false);
   const urgencySelectorRef = useRef(null);
   const { getSocket } = useAuth();
   const socket = getSocket();
@@ -1398,12 +1403,18 @@ function MessagingPage({ user, textSize }) {
     if (selectedContact) {
       const fetchMessages = async () => {
         try {
+          // Latest page only; older pages are loaded on demand
           const response = await axios.get(
             `/api/messages/${selectedContact.id}`
           );
+          const { messages: page, olderCursor } = readHistoryPage(response);
           setMessages((prev) => ({
             ...prev,
-            [selectedContact.id]: response.data,
+            [selectedContact.id]: page,
+          }));
+          setOlderCursors((prev) => ({
+            ...prev,
+            [selectedContact.id]: olderCursor,
           }));
         } catch (error) {
           console.error("Error fetching messages:", error);
@@ -1414,8 +1425,37 @@ function MessagingPage({ user, textSize }) {
     }
   }, [selectedContact]);
 
-  // Scroll to bottom of messages
+  // Load the page of messages preceding the oldest one shown
+  const loadOlderMessages = async () => {
+    const contactId = selectedContact?.id;
+    const cursor = contactId && olderCursors[contactId];
+    if (!cursor || loadingOlder) return;
+
+    setLoadingOlder(true);
+    try {
+      const response = await axios.get(`/api/messages/${contactId}`, {
+        params: { before: cursor },
+      });
+      const { messages: page, olderCursor } = readHistoryPage(response);
+      keepScrollRef.current = true;
+      setMessages((prev) => ({
+        ...prev,
+        [contactId]: prependOlderMessages(page, prev[contactId]),
+      }));
+      setOlderCursors((prev) => ({ ...prev, [contactId]: olderCursor }));
+    } catch (error) {
+      console.error("Error fetching older messages:", error);
+    } finally {
+      setLoadingOlder(false);
+    }
+  };
+
+  // Scroll to bottom of messages (not when older messages were put on top)
   useEffect(() => {
+    if (keepScrollRef.current) {
+      keepScrollRef.current = false;
+      return;
+    }
     if (messagesEndRef.current) {
       messagesEndRef.current.scrollIntoView({ behavior: "smooth" });
     }
@@ -2887,6 +2927,15 @@ function MessagingPage({ user, textSize }) {
               </div>
             </div>
             <div className="chat-messages slide-up stagger-1">
+              {olderCursors[selectedContact.id] && (
+                <button
+                  className="load-older-button"
+                  onClick={loadOlderMessages}
+                  disabled={loadingOlder}
+                >
+                  {loadingOlder ? "Loading..." : "Load older messages"}
+                </button>
+              )}
               {messages[selectedContact.id]?.map((msg) => (
                 <div
                   key={msg.id}
@@ -0,0 +1,38 @@
+/**
+ * Helpers for the paginated history endpoints
+ * (GET /api/messages/:contactId and GET /api/groups/:groupId/messages)
+ *
+ * The server returns the latest page of messages; the X-Before-Cursor and
+ * X-Has-More response headers tell whether older messages exist and where
+ * to continue from (?before=<cursor>).
+ */
+
+/**
+ * Reads a history response into its messages and the cursor of the older page
+ *
+ * @param {object} response - axios response of a history request
+ * @returns {{messages: Array, olderCursor: (string|null)}} olderCursor is null when nothing older exists
+ */
+export const readHistoryPage = (response) => {
+  const hasMore = response.headers["x-has-more"] === "true";
+  return {
+    messages: Array.isArray(response.data) ? response.data : [],
+    olderCursor: hasMore ? response.headers["x-before-cursor"] || null : null,
+  };
+};
+
+/**
+ * Puts an older page in front of the messages already loaded, skipping any
+ * message that is already there (e.g. received live meanwhile)
+ *
+ * @param {Array} olderMessages - Page loaded with ?before=
+ * @param {Array} currentMessages - Messages currently shown
+ * @returns {Array} Merged messages in chronological order
+ */
+export const prependOlderMessages = (olderMessages, currentMessages = []) => {
+  const loadedIds = new Set(currentMessages.map((msg) => msg?.id));
+  return [
+    ...olderMessages.filter((msg) => !loadedIds.has(msg?.id)),
+    ...currentMessages,
+  ];
+};
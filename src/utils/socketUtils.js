@@ -4,6 +4,7 @@
  */
 
 import { io } from "socket.io-client";
+import axios from "./axiosConfig";
 
 // Track socket connection state globally
 let isReconnecting = false;
@@ -51,10 +52,114 @@ export const createSocketConnection = (token) => {
   // Setup enhanced error handling and heartbeat
   setupEnhancedErrorHandling(socket);
   setupHeartbeat(socket);
+  setupPresenceDiffs(socket);
+  setupEventSync(socket);
+  setupReauth(socket);
 
   return socket;
 };
 
+/**
+ * The server sends status changes in batches ("presence_diff"); replay each
+ * change to the existing "user_status" listeners
+ *
+ * @param {object} socket - Socket.io instance
+ */
+const setupPresenceDiffs = (socket) => {
+  socket.on("presence_diff", ({ changes = [] } = {}) => {
+    changes.forEach((change) => {
+      socket.listeners("user_status").forEach((listener) => listener(change));
+    });
+  });
+};
+
+/**
+ * The server authenticates a socket once, at connect, and asks for a fresh
+ * token ("reauth_required") when that one is about to expire or has expired.
+ * Renew the stored token and hand it to the socket ("reauth"); an expired
+ * token cannot be renewed, and the 401 sends the user back to sign in
+ *
+ * @param {object} socket - Socket.io instance
+ */
+const setupReauth = (socket) => {
+  let renewing = false;
+
+  socket.on("reauth_required", async () => {
+    if (renewing) return;
+    renewing = true;
+
+    try {
+      const response = await axios.post("/api/auth/refresh");
+      const { token } = response.data;
+
+      localStorage.setItem("token", token);
+      axios.defaults.headers.common["Authorization"] = `Bearer ${token}`;
+
+      // Reconnections authenticate with the renewed token too
+      if (socket.io) {
+        socket.io.opts.query = { ...socket.io.opts.query, token };
+      }
+      socket.emit("reauth", { token });
+    } catch (err) {
+      console.error("Error renewing socket token:", err);
+    } finally {
+      renewing = false;
+    }
+  });
+
+  socket.on("reauth_ok", () => {
+    console.log("Socket token renewed");
+  });
+};
+
+// Socket events replayed for each type of synced event
+const SYNC_EVENT_NAMES = {
+  message: "receive_message",
+  message_edited: "message_edited",
+  message_deleted: "message_deleted",
+  group_message: "receive_group_message",
+  group_left: "group_user_left",
+  group_deleted: "group_deleted",
+};
+
+/**
+ * Catches up on the events missed while disconnected ("sync"). The first
+ * connection only learns the current seq (the pages load through REST);
+ * after each reconnection the missed events are replayed to the existing
+ * socket listeners, which ignore the ones they have already seen
+ *
+ * @param {object} socket - Socket.io instance
+ */
+const setupEventSync = (socket) => {
+  let lastSeq = null;
+
+  socket.on("connect", () => {
+    socket.emit("sync", lastSeq === null ? {} : { since: lastSeq });
+  });
+
+  socket.on("sync_result", ({ events = [], lastSeq: seq, hasMore, reset } = {}) => {
+    if (reset) {
+      // The missed events have expired: reload every page's state through REST
+      window.location.reload();
+      return;
+    }
+
+    events.forEach(({ type, data }) => {
+      const name = SYNC_EVENT_NAMES[type];
+      if (name) {
+        socket.listeners(name).forEach((listener) => listener(data));
+      }
+    });
+
+    if (typeof seq === "number") {
+      lastSeq = seq;
+    }
+    if (hasMore) {
+      socket.emit("sync", { since: lastSeq });
+    }
+  });
+};
+
 /**
  * Cleans up any existing socket connection to prevent memory leaks
  */